@@ -0,0 +1,179 @@
+"""
+This file contains the temperature compensated bias model for
+the ICM-20948 accelerometer and gyro.
+
+As the cabin heats up through a session the sensor biases drift,
+which directly moves the LED thresholds. During calibration the
+device sits still while its temperature changes and stationary
+samples are accumulated into temperature bins. A per-axis linear
+bias-vs-temperature model is then fitted and saved to flash.
+
+At boot the model is compiled into a lookup table of corrections
+relative to the temperature at power-on (when the gyro offset is
+measured), so each sample only costs a shift, a clamp and six
+subtractions.
+
+kward
+"""
+from array import array
+import json
+
+# Raw TEMP_OUT is binned in steps of 512 LSB (~1.5 degC)
+TEMP_BIN_SHIFT = 9
+TEMP_BIN_OFFSET = 20 << TEMP_BIN_SHIFT # Bin 0 starts at ~ -9.7 degC
+NUM_BINS = 64 # Up to ~ 88 degC
+
+# Corrected axes: accel x, y, z then gyro x, y, z
+NUM_AXES = 6
+
+# Main class
+class BiasModel:
+
+    # Initialize an empty model
+    def __init__(self):
+        # Fitted model, bias = slope * tempRaw + intercept (LSB)
+        self.slope = [0.0] * NUM_AXES
+        self.intercept = [0.0] * NUM_AXES
+        self.fitted = False
+
+        # Calibration accumulators per temperature bin
+        self.binCount = array('L', [0] * NUM_BINS)
+        self.binSum = array('l', [0] * (NUM_BINS * NUM_AXES))
+
+        # Compiled correction table
+        self.table = array('h', [0] * (NUM_BINS * NUM_AXES))
+
+    # Temperature bin of a raw TEMP_OUT reading
+    def tempBin(self, tempRaw):
+        b = (tempRaw + TEMP_BIN_OFFSET) >> TEMP_BIN_SHIFT
+        if b < 0:
+            return 0
+        elif b >= NUM_BINS:
+            return NUM_BINS - 1
+        return b
+
+    # Raw TEMP_OUT at the center of a bin
+    def binCenter(self, b):
+        return (b << TEMP_BIN_SHIFT) - TEMP_BIN_OFFSET + (1 << (TEMP_BIN_SHIFT - 1))
+
+    # Add a stationary calibration sample
+    def addSample(self, accel, gyro, tempRaw):
+        b = self.tempBin(tempRaw)
+        self.binCount[b] += 1
+
+        s = b * NUM_AXES
+        self.binSum[s] += accel[0]
+        self.binSum[s + 1] += accel[1]
+        self.binSum[s + 2] += accel[2]
+        self.binSum[s + 3] += gyro[0]
+        self.binSum[s + 4] += gyro[1]
+        self.binSum[s + 5] += gyro[2]
+
+    """
+    Fit bias vs temperature for every axis from the bin averages
+    (weighted least squares). Returns False if the calibration did
+    not cover enough of a temperature range.
+    """
+    def fit(self, minBins=3):
+        used = 0
+        lo = NUM_BINS
+        hi = -1
+        for b in range(NUM_BINS):
+            if self.binCount[b] > 0:
+                used += 1
+                lo = min(lo, b)
+                hi = max(hi, b)
+
+        if used < 2 or hi - lo + 1 < minBins:
+            print("Error in BiasModel.fit(): temperature range too small to fit")
+            return False
+
+        # Weighted mean temperature
+        n = 0
+        meanT = 0.0
+        for b in range(NUM_BINS):
+            c = self.binCount[b]
+            if c > 0:
+                n += c
+                meanT += c * self.binCenter(b)
+        meanT /= n
+
+        for axis in range(NUM_AXES):
+            meanY = 0.0
+            for b in range(NUM_BINS):
+                if self.binCount[b] > 0:
+                    meanY += self.binSum[b * NUM_AXES + axis]
+            meanY /= n
+
+            stt = 0.0
+            sty = 0.0
+            for b in range(NUM_BINS):
+                c = self.binCount[b]
+                if c > 0:
+                    dt = self.binCenter(b) - meanT
+                    dy = self.binSum[b * NUM_AXES + axis] / c - meanY
+                    stt += c * dt * dt
+                    sty += c * dt * dy
+
+            self.slope[axis] = sty / stt
+            self.intercept[axis] = meanY - self.slope[axis] * meanT
+
+        self.fitted = True
+        return True
+
+    # Build the correction table relative to the power-on temperature
+    def compile(self, tempRaw):
+        if not self.fitted:
+            return
+
+        t0 = self.tempBin(tempRaw)
+        for axis in range(NUM_AXES):
+            slope = self.slope[axis]
+            for b in range(NUM_BINS):
+                drift = slope * (self.binCenter(b) - self.binCenter(t0))
+                self.table[axis * NUM_BINS + b] = int(round(drift))
+
+    # Apply the correction in place to one sample
+    def correct(self, accel, gyro, tempRaw):
+        b = (tempRaw + TEMP_BIN_OFFSET) >> TEMP_BIN_SHIFT
+        if b < 0:
+            b = 0
+        elif b >= NUM_BINS:
+            b = NUM_BINS - 1
+
+        t = self.table
+        accel[0] -= t[b]
+        accel[1] -= t[b + NUM_BINS]
+        accel[2] -= t[b + 2 * NUM_BINS]
+        gyro[0] -= t[b + 3 * NUM_BINS]
+        gyro[1] -= t[b + 4 * NUM_BINS]
+        gyro[2] -= t[b + 5 * NUM_BINS]
+
+    # Save the fitted model to flash
+    def save(self, filename="bias.json"):
+        with open(filename, "w") as f:
+            json.dump({"slope": self.slope, "intercept": self.intercept}, f)
+
+        print("Bias model saved to: " + filename)
+
+    # Load a fitted model from flash, returns False (no compensation) if there is none or it is invalid
+    def load(self, filename="bias.json"):
+        try:
+            with open(filename) as f:
+                model = json.load(f)
+            slope = [float(v) for v in model["slope"]]
+            intercept = [float(v) for v in model["intercept"]]
+        except OSError:
+            return False
+        except (ValueError, KeyError, TypeError) as e:
+            print("Error in BiasModel.load(): invalid " + filename + ": " + str(e))
+            return False
+
+        if len(slope) != NUM_AXES or len(intercept) != NUM_AXES:
+            print("Error in BiasModel.load(): invalid model in " + filename)
+            return False
+
+        self.slope = slope
+        self.intercept = intercept
+        self.fitted = True
+        return True
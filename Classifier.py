@@ -0,0 +1,173 @@
+"""
+This file contains the lookup-table classifier that turns a raw
+acceleration sample into a complete LED frame.
+
+For the current ride mode a GRID x GRID table is precomputed over
+quantized lateral and longitudinal acceleration (+-2g). Each entry
+is a frame code holding the lit level of all four bars and the
+warning code, so classifying a sample is two shifts, two clamps and
+one indexed read (the compiled classifyFrame kernel in Kernels.py).
+The table is rebuilt only when the ride mode or its thresholds
+change. A new slip warning threshold (the learned grip limit) only
+rewrites the columns whose warning changed.
+
+Frame code layout (fits in a MicroPython small int):
+    bits  0-5   left bar level
+    bits  6-11  right bar level
+    bits 12-17  up (braking) bar level
+    bits 18-23  down (forward) bar level
+    bits 24-25  warning code
+
+kward
+"""
+from array import array
+from Kernels import classifyFrame
+
+ACCEL_LSB_PER_G = 16384 # ICM-20948 at +-2g full scale
+
+# Bars
+LEFT = 0
+RIGHT = 1
+UP = 2 # Braking
+DOWN = 3 # Forward acceleration
+NUM_BARS = 4
+
+# Frame code fields
+LEVEL_BITS = 6
+LEVEL_MASK = (1 << LEVEL_BITS) - 1
+MAX_LEDS_PER_BAR = LEVEL_MASK
+LAT_MASK = (1 << (2 * LEVEL_BITS)) - 1 # Left and right levels
+LONG_MASK = LAT_MASK << (2 * LEVEL_BITS) # Up and down levels
+WARN_SHIFT = 4 * LEVEL_BITS
+WARN_NONE = 0
+WARN_SLIP_LEFT = 1
+WARN_SLIP_RIGHT = 2
+WARN_FLAG = 1 << WARN_SHIFT # Any code >= WARN_FLAG carries a warning
+
+# Table grid, raw int16 acceleration >> GRID_SHIFT
+GRID_BITS = 6
+GRID = 1 << GRID_BITS
+GRID_SHIFT = 16 - GRID_BITS
+GRID_OFFSET = 32768 # Raw value of the first row/column
+
+# Index of the first threshold in table greater than value (bisect_right)
+def bisectRight(table, value):
+    lo = 0
+    hi = len(table)
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if value < table[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+# Raw acceleration at the center of a row or column
+def cellCenter(i):
+    return (i << GRID_SHIFT) - GRID_OFFSET + (1 << (GRID_SHIFT - 1))
+
+# Frame code of four bar levels and a warning
+def frameCode(left, right, up, down, warn=WARN_NONE):
+    return left | (right << LEVEL_BITS) | (up << (2 * LEVEL_BITS)) | (down << (3 * LEVEL_BITS)) | (warn << WARN_SHIFT)
+
+# Level of one bar in a frame code
+def barLevel(code, bar):
+    return (code >> (bar * LEVEL_BITS)) & LEVEL_MASK
+
+# Main class
+class FrameClassifier:
+
+    """
+    Initialize classifier
+
+    ledsPerBar: number of LEDs in each of the four bars
+    """
+    def __init__(self, ledsPerBar):
+        if ledsPerBar > MAX_LEDS_PER_BAR:
+            print("Error in FrameClassifier.__init__(): at most " + str(MAX_LEDS_PER_BAR) + " LEDs per bar")
+            ledsPerBar = MAX_LEDS_PER_BAR
+
+        self.n = ledsPerBar
+        self.table = array('L', [0] * (GRID * GRID))
+
+        # Lateral thresholds and slip warning of the current table
+        self.lat = []
+        self.warnLat = 0
+
+    # Raw acceleration thresholds of each LED in a bar
+    def thresholds(self, first, tolerance):
+        table = [int(first * ACCEL_LSB_PER_G)]
+        for i in range(1, self.n):
+            table.append(int((i + 0.5) * tolerance * ACCEL_LSB_PER_G))
+        return table
+
+    """
+    Rebuild the table for a ride mode
+
+    The first lateral LED lights at one tolerance and the first
+    longitudinal LED at half a tolerance (as in the original display),
+    every further LED at (i + 0.5) tolerances. Past warnLat (raw) the
+    whole lateral bar is lit and a slip warning is set.
+    """
+    def build(self, latTolerance, longTolF, longTolR, warnLat):
+        self.lat = self.thresholds(latTolerance, latTolerance)
+        self.warnLat = warnLat
+        brake = self.thresholds(longTolF * 0.5, longTolF)
+        accel = self.thresholds(longTolR * 0.5, longTolR)
+
+        # Level of every column (lateral) and row (longitudinal) at the cell center
+        latCodes = []
+        longCodes = []
+        for i in range(GRID):
+            value = cellCenter(i)
+            latCodes.append(self.latCode(value))
+
+            if value >= 0:
+                longCodes.append(frameCode(0, 0, 0, bisectRight(accel, value)))
+            else:
+                longCodes.append(frameCode(0, 0, bisectRight(brake, -value), 0))
+
+        # Lateral and longitudinal fields never overlap, so cells are ORed
+        table = self.table
+        for row in range(GRID):
+            longCode = longCodes[row]
+            base = row << GRID_BITS
+            for col in range(GRID):
+                table[base + col] = longCode | latCodes[col]
+
+    # Lateral levels and slip warning of a raw lateral value
+    def latCode(self, value):
+        n = self.n
+
+        if value >= 0:
+            if value >= self.warnLat:
+                return frameCode(n, 0, 0, 0, WARN_SLIP_LEFT)
+            return frameCode(bisectRight(self.lat, value), 0, 0, 0)
+
+        if -value >= self.warnLat:
+            return frameCode(0, n, 0, 0, WARN_SLIP_RIGHT)
+        return frameCode(0, bisectRight(self.lat, -value), 0, 0)
+
+    """
+    Move the slip warning of the current table
+
+    Only the columns between the old and the new warnLat (raw) change,
+    so a learned grip limit moving by a fraction of a cell rewrites at
+    most a column per side instead of the whole table.
+    """
+    def setWarning(self, warnLat):
+        lo = min(self.warnLat, warnLat)
+        hi = max(self.warnLat, warnLat)
+        self.warnLat = warnLat
+
+        table = self.table
+        for col in range(GRID):
+            value = cellCenter(col)
+            if lo <= abs(value) < hi:
+                latCode = self.latCode(value)
+                for i in range(col, GRID * GRID, GRID):
+                    table[i] = (table[i] & LONG_MASK) | latCode
+
+    # Frame code of a raw sample (ax positive = left, ay positive = forward)
+    def classify(self, ax, ay):
+        return classifyFrame(self.table, ax, ay)
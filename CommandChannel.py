@@ -0,0 +1,69 @@
+"""
+This file contains a non-blocking command channel for tuning
+GMonitor over the USB REPL while monitor() is running.
+
+stdin is registered with select.poll and checked once per frame
+with a zero timeout (ipoll, which does not allocate a result
+list). Characters are collected into a preallocated line buffer
+and a complete line is handed back to the monitor, which applies
+it between two samples.
+
+kward
+"""
+import select
+import sys
+
+MAX_LINE = 64 # Longest accepted command
+MAX_CHARS_PER_CHECK = 16 # Bound the time spent reading per frame
+
+# Main class
+class CommandChannel:
+
+    # Initialize channel
+    def __init__(self):
+        self.poller = select.poll()
+        self.poller.register(sys.stdin, select.POLLIN)
+
+        self.line = bytearray(MAX_LINE)
+        self.length = 0
+        self.overflow = False
+
+    # True if a character can be read without blocking
+    def ready(self):
+        for event in self.poller.ipoll(0):
+            return True
+        return False
+
+    """
+    Check for input without blocking
+
+    Returns a complete command line (str) or None
+    """
+    def check(self):
+        chars = 0
+        while chars < MAX_CHARS_PER_CHECK and self.ready():
+            c = sys.stdin.read(1)
+            chars += 1
+
+            # End of line
+            if c == "\n" or c == "\r":
+                if self.length == 0:
+                    continue
+
+                length = self.length
+                self.length = 0
+
+                if self.overflow:
+                    self.overflow = False
+                    print("Error in CommandChannel.check(): command too long")
+                    return None
+
+                return bytes(self.line[:length]).decode()
+
+            if self.length < MAX_LINE:
+                self.line[self.length] = ord(c)
+                self.length += 1
+            else:
+                self.overflow = True
+
+        return None
@@ -0,0 +1,284 @@
+"""
+This file contains the on-device data logger of GMonitor.
+
+While the logger is running, decimated IMU samples are packed into
+fixed-size binary records in one of two preallocated block buffers.
+log() never touches the filesystem: a full buffer is handed over and
+write(), called from its own low-priority scheduler stage, adds the
+CRC32 and writes it to flash while log() fills the other buffer. A
+block is either complete and verifiable or missing, and files are
+flushed after every block so they can be read while logging. If a
+block is still waiting when the next one is full, the new records
+are dropped (and counted) rather than stalling the sampling.
+
+Each session is split into segment files in the logs directory:
+    logs/s<session>_<segment>.gml
+
+Segment layout:
+    header  HEADER_FORMAT: magic "GMLG", version, record size,
+            log rate (Hz), session, segment, session time (ms) of
+            the first record
+    blocks  BLOCK_FORMAT: record count, reserved, CRC32 of the
+            records, followed by count records
+
+Record layout (RECORD_FORMAT, little endian):
+    time (ms since the session started), ax, ay, az, gx, gy, gz,
+    mx, my, mz (raw LSB), ride mode index, flags
+
+A segment is closed after SEGMENT_BLOCKS blocks and never changes
+again. The decoding functions at the end of this file only need
+struct and binascii, so they also run on the host.
+
+kward
+"""
+import struct
+import time
+import os
+from binascii import crc32
+
+LOG_DIR = "logs"
+FILE_MAGIC = b"GMLG"
+FILE_VERSION = 1
+
+HEADER_FORMAT = "<4sBBHHHL"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+BLOCK_FORMAT = "<HHL"
+BLOCK_HEADER_SIZE = struct.calcsize(BLOCK_FORMAT)
+RECORD_FORMAT = "<L9hBB"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+# Records per block and blocks per segment (~60 KB segments)
+BLOCK_RECORDS = 128
+SEGMENT_BLOCKS = 20
+
+# Record flags
+FLAG_SPIN = 0x01 # Spin-out warning active
+
+# Stop logging when the filesystem has less free space than this
+MIN_FREE_BYTES = 2 * SEGMENT_BLOCKS * (BLOCK_HEADER_SIZE + BLOCK_RECORDS * RECORD_SIZE)
+
+# File name of a segment
+def segmentName(session, segment, directory=LOG_DIR):
+    return "%s/s%04d_%03d.gml" % (directory, session, segment)
+
+# Main class
+class DataLogger:
+
+    """
+    Initialize logger
+
+    rateHz: rate at which log() is called
+    directory: directory of the segment files
+    """
+    def __init__(self, rateHz=100, directory=LOG_DIR):
+        self.directory = directory
+        self.setRate(rateHz)
+
+        # Preallocated block buffers, log() fills one while the other waits for write()
+        size = BLOCK_HEADER_SIZE + BLOCK_RECORDS * RECORD_SIZE
+        self.buffers = (bytearray(size), bytearray(size))
+        self.block = self.buffers[0]
+        self.count = 0
+        self.pending = None
+        self.pendingCount = 0
+        self.dropped = 0
+
+        self.file = None
+        self.session = 0
+        self.segment = 0
+        self.blocks = 0
+        self.startMs = 0
+        self.records = 0
+
+    # Change the log rate (takes effect for the next segment header)
+    def setRate(self, rateHz):
+        if rateHz <= 0 or rateHz > 1000:
+            raise ValueError("log rate must be 1 - 1000 Hz")
+        self.rateHz = rateHz
+
+    # True while a session is being logged
+    def active(self):
+        return self.file is not None
+
+    # Number of the next session (one more than the highest on flash)
+    def nextSession(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            os.mkdir(self.directory)
+            return 1
+
+        session = 0
+        for name in names:
+            if name.startswith("s") and name.endswith(".gml"):
+                try:
+                    session = max(session, int(name[1:5]))
+                except ValueError:
+                    pass
+
+        return session + 1
+
+    # Start logging a new session
+    def start(self):
+        if self.file is not None:
+            self.stop()
+
+        self.session = self.nextSession()
+        self.segment = 0
+        self.records = 0
+        self.count = 0
+        self.pending = None
+        self.dropped = 0
+        self.startMs = time.ticks_ms()
+
+        if self.openSegment():
+            print("Logging session " + str(self.session) + " at " + str(self.rateHz) + " Hz")
+
+    # Open the next segment file, False if flash is full
+    def openSegment(self):
+        try:
+            stat = os.statvfs(self.directory)
+            if stat[0] * stat[3] < MIN_FREE_BYTES:
+                print("Error in DataLogger.openSegment(): flash is full, logging stopped")
+                self.file = None
+                return False
+        except (OSError, AttributeError):
+            pass
+
+        # Segments are opened from write(), log() may already have buffered the first record
+        if self.count > 0:
+            timeMs = struct.unpack_from("<L", self.block, BLOCK_HEADER_SIZE)[0]
+        else:
+            timeMs = time.ticks_diff(time.ticks_ms(), self.startMs)
+        self.file = open(segmentName(self.session, self.segment, self.directory), "wb")
+        self.file.write(struct.pack(HEADER_FORMAT, FILE_MAGIC, FILE_VERSION, RECORD_SIZE, self.rateHz, self.session, self.segment, timeMs))
+        self.blocks = 0
+        return True
+
+    """
+    Add one record
+
+    values: ax, ay, az, gx, gy, gz (raw LSB)
+    mag: mx, my, mz (raw LSB)
+    modeIdx: index of the current ride mode
+    flags: FLAG_* bits
+    """
+    def log(self, values, mag, modeIdx, flags=0):
+        if self.file is None:
+            return
+
+        timeMs = time.ticks_diff(time.ticks_ms(), self.startMs)
+        struct.pack_into(RECORD_FORMAT, self.block, BLOCK_HEADER_SIZE + self.count * RECORD_SIZE, timeMs,
+            values[0], values[1], values[2], values[3], values[4], values[5],
+            int(mag[0]), int(mag[1]), int(mag[2]), modeIdx, flags)
+
+        self.count += 1
+        self.records += 1
+        if self.count == BLOCK_RECORDS:
+            self.seal()
+
+    # Hand the full block to write() and continue in the other buffer
+    def seal(self):
+        if self.pending is not None:
+            # write() fell a whole block behind, drop the records instead of stalling
+            self.dropped += self.count
+            self.records -= self.count
+            self.count = 0
+            return
+
+        self.pending = self.block
+        self.pendingCount = self.count
+        self.block = self.buffers[1] if self.block is self.buffers[0] else self.buffers[0]
+        self.count = 0
+
+    # Write the block handed over by log() to flash (low-priority stage, at least every BLOCK_RECORDS records)
+    def write(self):
+        pending = self.pending
+        if pending is None:
+            return
+
+        if self.file is not None:
+            self.writeBlock(pending, self.pendingCount)
+        self.pending = None
+
+    # Write count records of buffer as one block
+    def writeBlock(self, buffer, count):
+        size = BLOCK_HEADER_SIZE + count * RECORD_SIZE
+        block = memoryview(buffer)
+        struct.pack_into(BLOCK_FORMAT, buffer, 0, count, 0, crc32(block[BLOCK_HEADER_SIZE:size]) & 0xFFFFFFFF)
+
+        self.file.write(block[:size])
+        self.file.flush()
+
+        # Close full segments and continue in a new one
+        self.blocks += 1
+        if self.blocks == SEGMENT_BLOCKS:
+            self.file.close()
+            self.segment += 1
+            self.openSegment()
+
+    # Stop logging, writing out the last partial block
+    def stop(self):
+        if self.file is None:
+            return
+
+        self.write()
+        if self.file is not None and self.count > 0:
+            self.writeBlock(self.block, self.count)
+        self.count = 0
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        print("Logged " + str(self.records) + " records in " + str(self.segment + 1) + " segments")
+        if self.dropped:
+            print("Dropped " + str(self.dropped) + " records while a block was waiting for flash")
+
+
+"""
+Decode a segment header
+
+Returns a dict, raises ValueError if data is not a segment
+"""
+def parseHeader(data):
+    if len(data) < HEADER_SIZE:
+        raise ValueError("segment header incomplete")
+
+    magic, version, recordSize, rateHz, session, segment, startMs = struct.unpack_from(HEADER_FORMAT, data, 0)
+    if magic != FILE_MAGIC or version != FILE_VERSION or recordSize != RECORD_SIZE:
+        raise ValueError("not a version " + str(FILE_VERSION) + " GMonitor log segment")
+
+    return {"rateHz": rateHz, "session": session, "segment": segment, "startMs": startMs}
+
+"""
+Iterate over the complete blocks of a segment
+
+data: segment bytes (or a part of them starting at offset)
+offset: file offset of the first block to read
+
+Yields (next offset, records memoryview) for each complete block and
+stops at the first incomplete one, so the last offset is where
+reading can resume once more data was written. Raises ValueError
+if a complete block fails its checksum.
+"""
+def readBlocks(data, offset=HEADER_SIZE):
+    view = memoryview(data)
+    while offset + BLOCK_HEADER_SIZE <= len(view):
+        count, reserved, crc = struct.unpack_from(BLOCK_FORMAT, view, offset)
+        start = offset + BLOCK_HEADER_SIZE
+        end = start + count * RECORD_SIZE
+        if count == 0 or count > BLOCK_RECORDS:
+            raise ValueError("invalid block at offset " + str(offset))
+        if end > len(view):
+            return
+
+        records = view[start:end]
+        if crc32(records) & 0xFFFFFFFF != crc:
+            raise ValueError("checksum mismatch at offset " + str(offset))
+
+        offset = end
+        yield offset, records
+
+# Decode the records of a block into tuples (time ms, ax, ay, az, gx, gy, gz, mx, my, mz, mode, flags)
+def decodeRecords(records):
+    return [struct.unpack_from(RECORD_FORMAT, records, i) for i in range(0, len(records), RECORD_SIZE)]
@@ -0,0 +1,435 @@
+"""
+This file contains the g-g diagram and friction circle analysis of
+logged sessions (run on a computer).
+
+A session (or lap) of the session store, logged or streamed, is
+reduced in one vectorized pass to a histogram over lateral g,
+longitudinal g and ride mode, from which everything else is derived:
+
+    - g-g scatter density on a grid of up to 256 x 256 cells
+    - Friction circle utilization percentiles per ride mode (combined g
+      as a fraction of the mode's maxLatForce)
+    - Time spent at each LED level per direction and ride mode, with
+      the mode's own tolerances
+    - Braking, acceleration and cornering events: runs beyond a
+      threshold, merged across short gaps, with their peak g
+
+Samples are binned by the high byte of the raw value, i.e. at 1/64 g
+(256 LSB). On the fallback path this lets the standard library do
+every per-sample step in C (strided slices, bytes.translate,
+bytes.find and a Counter over packed cell codes). With NumPy the same
+bins are computed with array operations. Both give identical results,
+and a one hour session at 1 kHz is analysed in well under a second.
+
+Axes are the monitor's: ax positive = left, ay positive = forward
+(negative = braking).
+
+Usage:
+    python GGAnalysis.py STORE                 Report on every session in STORE
+    python GGAnalysis.py STORE -s 3 -l 2       Report on lap 2 of session 3
+    python GGAnalysis.py -b                    Benchmark an hour at 1 kHz (both paths when NumPy is present)
+
+kward
+"""
+import argparse
+import json
+import sys
+import time
+from array import array
+from collections import Counter
+
+from RideModes import DEFAULT_PROFILES, MODE_NAME, MODE_LAT_TOL, MODE_LONG_TOL_F, MODE_LONG_TOL_R, MODE_MAX_LAT, compileProfiles
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ACCEL_LSB_PER_G = 16384 # ICM-20948 at +-2g full scale
+CELL_SHIFT = 8 # Raw value >> CELL_SHIFT is the cell
+CELLS_PER_G = ACCEL_LSB_PER_G >> CELL_SHIFT
+CELLS = 256 # Cells per axis, +-2g
+
+# Color names of LedController, so modes.json is validated the same way on a host
+COLOR_NAMES = ("red", "green", "blue", "purple", "yellow", "cyan")
+
+# Event kinds
+EVENT_BRAKE = "brake"
+EVENT_ACCEL = "accel"
+EVENT_LEFT = "left"
+EVENT_RIGHT = "right"
+
+PERCENTILES = (50, 90, 95, 99, 100)
+
+# Signed value of each cell byte
+SIGNED = tuple(b - 256 if b >= 128 else b for b in range(256))
+
+# Cell byte to a byte that sorts like the signed cell
+ORDERED = bytes(b ^ 0x80 for b in range(256))
+
+# Positions of the longitudinal, lateral and mode bytes in a native uint32 cell code
+CODE_BYTES = (0, 1, 2) if sys.byteorder == "little" else (3, 2, 1)
+
+"""
+Load and compile ride mode profiles on a host
+
+Same validation as on the monitor, falls back to the built-in
+profiles if the file is missing or invalid.
+"""
+def loadProfiles(filename="modes.json"):
+    colors = {name: None for name in COLOR_NAMES}
+    try:
+        with open(filename) as f:
+            return compileProfiles(json.load(f), colors)[0]
+    except OSError:
+        pass
+    except (ValueError, KeyError, TypeError) as e:
+        print("Error in loadProfiles(): invalid " + filename + ": " + str(e))
+
+    return compileProfiles(DEFAULT_PROFILES, colors)[0]
+
+# High (cell) bytes of an int16 column as bytes, without NumPy
+def cellBytes(column):
+    view = memoryview(column).cast("B")
+    return bytes(view[1::2] if sys.byteorder == "little" else view[0::2])
+
+# Start and end of the runs of non-zero bytes in mask
+def maskRuns(mask):
+    runs = []
+    end = len(mask)
+    pos = mask.find(1)
+    while pos >= 0:
+        stop = mask.find(0, pos)
+        if stop < 0:
+            stop = end
+        runs.append((pos, stop))
+        pos = mask.find(1, stop)
+    return runs
+
+# Start and end of the runs of True in a NumPy bool array
+def numpyRuns(mask):
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], mask.view(numpy.int8), [0]))))
+    return list(zip(edges[0::2].tolist(), edges[1::2].tolist()))
+
+"""
+Peak raw value of values[start:end], without NumPy
+
+ordered: cell bytes of values translated with ORDERED
+The highest (sign > 0) or lowest cell is found over the bytes first,
+then only the samples in that cell are compared.
+"""
+def peakValue(values, ordered, start, end, sign):
+    cell = max(ordered[start:end]) if sign > 0 else min(ordered[start:end])
+    peak = None
+    pos = ordered.find(cell, start, end)
+    while pos >= 0:
+        value = values[pos]
+        if peak is None or (value > peak if sign > 0 else value < peak):
+            peak = value
+        pos = ordered.find(cell, pos + 1, end)
+    return peak
+
+# Merge runs separated by at most gap rows, keep those of at least length rows
+def mergeRuns(runs, gap, length):
+    merged = []
+    for start, end in runs:
+        if merged and start - merged[-1][1] <= gap:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged if end - start >= length]
+
+# Main class
+class GGAnalysis:
+
+    """
+    Analyse one session or lap
+
+    ax, ay: raw lateral and longitudinal acceleration (int16 columns:
+            memoryview, array('h') or NumPy array)
+    mode: ride mode index of each sample (uint8 column), None for all 0
+    rateHz: sample rate
+    modes: compiled ride modes (default loadProfiles())
+    useNumpy: use NumPy when it is installed
+    """
+    def __init__(self, ax, ay, mode, rateHz, modes=None, useNumpy=True):
+        self.rateHz = rateHz
+        self.modes = modes if modes is not None else loadProfiles()
+        self.numpy = useNumpy and numpy is not None
+        self.n = len(ax)
+
+        if self.numpy:
+            self.ax = numpy.asarray(ax, dtype=numpy.int16)
+            self.ay = numpy.asarray(ay, dtype=numpy.int16)
+            self.latCells = self.ax >> CELL_SHIFT
+            self.longCells = self.ay >> CELL_SHIFT
+        else:
+            self.ax = memoryview(ax).cast("B").cast("h")
+            self.ay = memoryview(ay).cast("B").cast("h")
+            self.latCells = cellBytes(ax)
+            self.longCells = cellBytes(ay)
+
+        self.hist = self.histogram(mode)
+
+    """
+    Count the samples in every (mode, lateral cell, longitudinal cell)
+
+    Returns {code: count} with code = mode << 16 | lateral cell byte
+    << 8 | longitudinal cell byte, for the occupied cells only.
+    """
+    def histogram(self, mode):
+        n = self.n
+        if self.numpy:
+            code = (self.latCells.astype(numpy.uint32) & 0xFF) << 8 | (self.longCells.astype(numpy.uint32) & 0xFF)
+            if mode is not None:
+                code |= numpy.asarray(mode, dtype=numpy.uint32) << 16
+            counts = numpy.bincount(code)
+            cells = numpy.flatnonzero(counts)
+            return dict(zip(cells.tolist(), counts[cells].tolist()))
+
+        codes = bytearray(4 * n)
+        codes[CODE_BYTES[0]::4] = self.longCells
+        codes[CODE_BYTES[1]::4] = self.latCells
+        if mode is not None:
+            codes[CODE_BYTES[2]::4] = memoryview(mode).cast("B")
+        return Counter(memoryview(codes).cast("I"))
+
+    # Ride modes present, in index order
+    def modeIndices(self):
+        return sorted(set(code >> 16 for code in self.hist))
+
+    # Name of a ride mode index
+    def modeName(self, modeIdx):
+        return self.modes[modeIdx][MODE_NAME] if modeIdx < len(self.modes) else "mode " + str(modeIdx)
+
+    # Occupied cells as (modeIdx, lateral g, longitudinal g at the cell center, count)
+    def cells(self):
+        half = 0.5 / CELLS_PER_G
+        for code, count in self.hist.items():
+            yield (code >> 16, SIGNED[(code >> 8) & 0xFF] / CELLS_PER_G + half,
+                SIGNED[code & 0xFF] / CELLS_PER_G + half, count)
+
+    """
+    g-g scatter density
+
+    bins: cells per axis (a power of two up to 256), over +-2g
+    modeIdx: only this ride mode (None for all)
+    Returns bins rows (braking at row 0 up to forward) of bins columns
+    (right at column 0 up to left), each the fraction of samples in it.
+    """
+    def density(self, bins=32, modeIdx=None):
+        if bins < 1 or bins > CELLS or CELLS % bins:
+            raise ValueError("bins must be a power of two up to " + str(CELLS))
+
+        shift = (CELLS // bins).bit_length() - 1
+        grid = [[0] * bins for i in range(bins)]
+        total = 0
+        for code, count in self.hist.items():
+            if modeIdx is not None and code >> 16 != modeIdx:
+                continue
+            row = (SIGNED[code & 0xFF] + CELLS // 2) >> shift
+            col = (SIGNED[(code >> 8) & 0xFF] + CELLS // 2) >> shift
+            grid[row][col] += count
+            total += count
+
+        if total:
+            grid = [[count / total for count in row] for row in grid]
+        return grid
+
+    """
+    Friction circle utilization percentiles
+
+    Returns {modeIdx: [utilization at each of percentiles]}, where
+    utilization is combined g over the mode's maxLatForce.
+    """
+    def utilization(self, percentiles=PERCENTILES):
+        byMode = {}
+        for modeIdx, lat, lon, count in self.cells():
+            byMode.setdefault(modeIdx, []).append(((lat * lat + lon * lon) ** 0.5, count))
+
+        result = {}
+        for modeIdx, values in byMode.items():
+            limit = self.modes[modeIdx][MODE_MAX_LAT] if modeIdx < len(self.modes) else DEFAULT_PROFILES["maxLatForce"]
+            values.sort()
+            total = sum(count for g, count in values)
+
+            result[modeIdx] = []
+            i = 0
+            seen = values[0][1]
+            for p in percentiles:
+                target = p * total / 100
+                while seen < target and i + 1 < len(values):
+                    i += 1
+                    seen += values[i][1]
+                result[modeIdx].append(values[i][0] / limit)
+        return result
+
+    """
+    Time at each LED level
+
+    Levels are round(g / tolerance) with the tolerances of the mode,
+    as on the display. Returns {modeIdx: {direction: [seconds at level
+    0, 1, ...]}} for the directions left, right, brake and accel.
+    """
+    def timeAtLevel(self):
+        result = {}
+        for modeIdx, lat, lon, count in self.cells():
+            mode = self.modes[modeIdx] if modeIdx < len(self.modes) else self.modes[0]
+            levels = result.setdefault(modeIdx, {EVENT_LEFT: [], EVENT_RIGHT: [], EVENT_BRAKE: [], EVENT_ACCEL: []})
+
+            for direction, g, tolerance in ((EVENT_LEFT if lat > 0 else EVENT_RIGHT, abs(lat), mode[MODE_LAT_TOL]),
+                    (EVENT_ACCEL if lon > 0 else EVENT_BRAKE, abs(lon), mode[MODE_LONG_TOL_R] if lon > 0 else mode[MODE_LONG_TOL_F])):
+                level = int(g / tolerance + 0.5)
+                times = levels[direction]
+                if level >= len(times):
+                    times.extend([0] * (level + 1 - len(times)))
+                times[level] += count
+
+        for levels in result.values():
+            for direction in levels:
+                levels[direction] = [count / self.rateHz for count in levels[direction]]
+        return result
+
+    """
+    Braking, acceleration and cornering events
+
+    thresholdG: g (rounded to 1/64 g) beyond which a sample is part of
+                an event, per kind (dict) or for all kinds
+    minS: shortest event kept
+    gapS: runs closer than this are merged into one event
+    Returns [(kind, first row, end row, peak g)] in time order.
+    """
+    def events(self, thresholdG=0.3, minS=0.2, gapS=0.1):
+        if not isinstance(thresholdG, dict):
+            thresholdG = {kind: thresholdG for kind in (EVENT_BRAKE, EVENT_ACCEL, EVENT_LEFT, EVENT_RIGHT)}
+
+        gap = int(gapS * self.rateHz)
+        length = max(1, int(minS * self.rateHz))
+        events = []
+        for cellsOf, values, kinds in ((self.longCells, self.ay, ((EVENT_BRAKE, -1), (EVENT_ACCEL, 1))),
+                (self.latCells, self.ax, ((EVENT_LEFT, 1), (EVENT_RIGHT, -1)))):
+            ordered = None if self.numpy else cellsOf.translate(ORDERED)
+
+            for kind, sign in kinds:
+                if kind not in thresholdG:
+                    continue
+
+                # Beyond threshold: cell >= k forward/left, cell < -k braking/right
+                k = int(round(thresholdG[kind] * CELLS_PER_G))
+                if self.numpy:
+                    runs = numpyRuns(cellsOf >= k if sign > 0 else cellsOf < -k)
+                else:
+                    table = bytes((SIGNED[b] >= k if sign > 0 else SIGNED[b] < -k) for b in range(256))
+                    runs = maskRuns(cellsOf.translate(table))
+
+                for start, end in mergeRuns(runs, gap, length):
+                    if self.numpy:
+                        peak = values[start:end].max() if sign > 0 else values[start:end].min()
+                    else:
+                        peak = peakValue(values, ordered, start, end, sign)
+                    events.append((kind, start, end, int(peak) / ACCEL_LSB_PER_G))
+
+        events.sort(key=lambda event: event[1])
+        return events
+
+    # Print a report of the session
+    def report(self, percentiles=PERCENTILES):
+        print("%d samples, %.1f s" % (self.n, self.n / self.rateHz))
+
+        utilization = self.utilization(percentiles)
+        levels = self.timeAtLevel()
+        for modeIdx in self.modeIndices():
+            print("  %-10s utilization %s" % (self.modeName(modeIdx),
+                "  ".join("p%d %3.0f%%" % (p, 100 * u) for p, u in zip(percentiles, utilization[modeIdx]))))
+            for direction in (EVENT_LEFT, EVENT_RIGHT, EVENT_BRAKE, EVENT_ACCEL):
+                print("  %10s %-5s %s" % ("", direction, " ".join("%7.1f" % s for s in levels[modeIdx][direction])))
+
+        events = self.events()
+        counts = Counter(event[0] for event in events)
+        print("  events: " + ", ".join("%d %s" % (counts[kind], kind) for kind in (EVENT_BRAKE, EVENT_ACCEL, EVENT_LEFT, EVENT_RIGHT)))
+        for kind in (EVENT_BRAKE, EVENT_LEFT, EVENT_RIGHT):
+            peaks = [abs(event[3]) for event in events if event[0] == kind]
+            if peaks:
+                print("  %-5s peak %.2fg, mean peak %.2fg" % (kind, max(peaks), sum(peaks) / len(peaks)))
+
+# Analysis of a session (or one of its laps) of a session store
+def fromStore(store, session, lap=None, modes=None, useNumpy=True):
+    rateHz = [s[1] for s in store.sessions() if s[0] == session][0]
+    if lap is None:
+        first, end = store.sessionRows(session)
+    else:
+        first, end = store.lapRows(session, lap)
+
+    view = store.array if useNumpy and numpy is not None else store.column
+    return GGAnalysis(view("ax", first, end), view("ay", first, end), view("mode", first, end), rateHz, modes, useNumpy)
+
+# A synthetic hour at rateHz: 90 s laps of corners and braking zones in two ride modes
+def syntheticHour(rateHz=1000):
+    import math
+    import random
+
+    lapRows = 90 * rateHz
+    ax = array("h", bytes(2 * lapRows))
+    ay = array("h", bytes(2 * lapRows))
+    for i in range(lapRows):
+        t = i / rateHz
+        corner = math.sin(2 * math.pi * t / 15)
+        ax[i] = int((1.1 * corner * abs(corner) + random.gauss(0, 0.05)) * ACCEL_LSB_PER_G)
+        ay[i] = int((-0.9 * max(0, math.cos(2 * math.pi * t / 15)) ** 8 + 0.2 + random.gauss(0, 0.05)) * ACCEL_LSB_PER_G)
+
+    laps = 3600 // 90
+    mode = array("B", bytes(laps * lapRows))
+    mode[laps * lapRows // 2:] = array("B", [3]) * (laps * lapRows - laps * lapRows // 2)
+    return ax * laps, ay * laps, mode
+
+def benchmark():
+    rateHz = 1000
+    ax, ay, mode = syntheticHour(rateHz)
+    modes = loadProfiles()
+
+    print("\ng-g analysis benchmark (%d samples)" % len(ax))
+    print("=======================================")
+
+    results = []
+    for useNumpy in ((False, True) if numpy is not None else (False,)):
+        start = time.perf_counter()
+        analysis = GGAnalysis(ax, ay, mode, rateHz, modes, useNumpy)
+        result = (analysis.density(), analysis.utilization(), analysis.timeAtLevel(), analysis.events())
+        elapsed = time.perf_counter() - start
+        results.append(result)
+        print("%-8s %8.1f ms, %d cells, %d events" % ("numpy" if useNumpy else "array", elapsed * 1000, len(analysis.hist), len(result[3])))
+
+    if len(results) > 1:
+        print("numpy and array results: " + ("identical" if results[0] == results[1] else "DIFFERENT"))
+    analysis.report()
+
+def main():
+    parser = argparse.ArgumentParser(description="g-g diagram and friction circle analysis")
+    parser.add_argument("store", nargs="?", help="session store directory (SessionStore.py)")
+    parser.add_argument("-s", "--session", type=int, help="only this session")
+    parser.add_argument("-l", "--lap", type=int, help="only this lap of the session")
+    parser.add_argument("-m", "--modes", default="modes.json", help="ride modes file")
+    parser.add_argument("-b", "--bench", action="store_true", help="benchmark an hour at 1 kHz")
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark()
+        return
+    if args.store is None:
+        parser.error("a store directory is needed")
+    if args.lap is not None and args.session is None:
+        parser.error("--lap needs --session")
+
+    from SessionStore import SessionStore
+
+    modes = loadProfiles(args.modes)
+    with SessionStore(args.store) as store:
+        for session, rateHz, first, end in store.sessions():
+            if args.session is not None and session != args.session:
+                continue
+            print("\nSession %d%s" % (session, "" if args.lap is None else ", lap %d" % args.lap))
+            if end > first:
+                fromStore(store, session, args.lap, modes).report()
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,26 @@ in that order.
 Author: Kyle Ward (kward)
 """
 
-from LEDController import LedController # RGB LED Controller
+from LedController import LedController # RGB LED Controller
 from machine import Pin # RPi Pico Hardware Interface
-from temperature import getTemp # Get current temperature
+from temperature import TempSampler # Background board temperature sampler
+from SpinDetector import SpinDetector # Spin-out (oversteer) detection
+from SessionStats import SessionStats # Incremental session statistics
+from VibrationAnalyzer import VibrationAnalyzer # Vibration spectrum analysis
+from BiasModel import BiasModel # Temperature compensated IMU bias
+from CommandChannel import CommandChannel # Live tuning over the USB REPL
+from GripEstimator import GripEstimator # Adaptive grip limit
+from PwmGauge import PwmGauge # Proportional PWM LED display
+from LedBackends import GpioBar, ShiftRegisterBar, NeoPixelBar # LED bar graph outputs
+from Scheduler import RateScheduler, TimerScheduler, Decimator # Multi-rate loop scheduling
+from DataLogger import DataLogger, FLAG_SPIN # On-device data logger
+from HeapMonitor import HeapMonitor # Zero-GC steady-state mode
+from Telemetry import TelemetryStream # Live telemetry over USB
+from RideModes import loadModes, updateMode, saveModes, modeProfile, MODE_NAME, MODE_LAT_TOL, MODE_LONG_TOL_F, \
+    MODE_LONG_TOL_R, MODE_LAT_WARN, MODE_COLOR, MODE_MAX_LAT, MODE_LAT_TOL_LSB, MODE_LONG_TOL_F_LSB, \
+    MODE_LONG_TOL_R_LSB # Ride mode profiles
 import icm20948 # IMU API
+from array import array # Preallocated sample buffers
 import time # sleep and timing operations
 import sys # python system operations
 
@@ -20,9 +36,6 @@ class GMonitor:
     
     # Initialize class
     def __init__(self):
-        # 2013 V6 Mustang maximum lateral force tolerance
-        self.maxLatForce = 0.95
-        
         # Set ride mode button Pin
         self.btnModeSel = Pin(1, Pin.IN, Pin.PULL_UP)
         
@@ -30,77 +43,129 @@ class GMonitor:
         self.btnStartLogger = Pin(18, Pin.IN, Pin.PULL_UP)
         self.enableLogger = False
         
-        # Create map of LEDs
-        self.lights = {
+        # GPIO of each LED
+        self.lightPins = {
     
-        # Vertical leds ('M' = middle led)
-        "2U": Pin(16, Pin.OUT),
-        "1U": Pin(17, Pin.OUT),
-        "M": LedController(9,8,0),
-        "1D": Pin(19, Pin.OUT),
-        "2D": Pin(20, Pin.OUT),
+        # Vertical leds
+        "2U": 16,
+        "1U": 17,
+        "1D": 19,
+        "2D": 20,
     
         # Horizontal leds
-        "2L": Pin(13, Pin.OUT),
-        "1L": Pin(12, Pin.OUT),
-        "1R": Pin(11, Pin.OUT),
-        "2R": Pin(10, Pin.OUT),
+        "2L": 13,
+        "1L": 12,
+        "1R": 11,
+        "2R": 10,
         
         # Other various signal lights
-        "logger": Pin(14, Pin.OUT) 
+        "logger": 14
     }
-        # Define ride modes
-        self.modes = {
-            
-            # For showing off the device in a low-acceleration environment
-            "tech-demo": {
-                "latTolerance": 0.25, # Lateral acceleration tolerance
-                "longTolF": 0.4, # Braking tolerance
-                "longTolR": 0.2, # Forward acceleration tolerance
-                "color": "purple", # Display color for RGB led
-                "name": "tech-demo" # Name of the mode
-            },
-            
-            # For normal usage
-            "normal": {
-                "latTolerance": 0.3,    
-                "longTolF": 0.6,
-                "longTolR": 0.25,
-                "color": "yellow",
-                "name": "normal"
-            },
-            
-            # For usage when the vehicle will be driven hard on normal roads
-            "sport": {
-                "latTolerance": 0.35,
-                "longTolF": 1.0,
-                "longTolR": 0.27,
-                "color": "cyan",
-                "name": "sport"
-            },
-            
-            # For usage on a track or closed course
-            "race": {
-                "latTolerance": 0.4,
-                "longTolF": 1.2,
-                "longTolR": 0.3,
-                "color": "red",
-                "name": "race"
-            }
+        
+        # Create map of LEDs ('M' = middle RGB led)
+        self.lights = {"M": LedController(9,8,0)}
+        for name in self.lightPins:
+            self.lights[name] = Pin(self.lightPins[name], Pin.OUT)
             
-        }
+        # Direction LED display, see setDisplayMode()
+        self.displayMode = "discrete"
+        self.display = GpioBar(self.lights)
+        
+        # Load ride modes from flash, compiled into tuples of thresholds
+        self.modes, self.rideModeIdx = loadModes(self.lights["M"].colors)
+        self.modeNames = tuple(mode[MODE_NAME] for mode in self.modes)
+        self.rideMode = self.modes[self.rideModeIdx]
         
-        # Define default ride mode
-        self.rideMode = self.modes["normal"]
+        # Per session and per ride mode statistics
+        self.stats = SessionStats(self.modeNames)
         
         # Set center LED to indicate ride mode
-        self.lights["M"].colors[self.rideMode["color"]]()
+        self.rideMode[MODE_COLOR]()
+        self.buildDisplay()
         
         # Create IMU
         self.imu = icm20948.ICM20948()
         
-        # Set system poll rate (Hz) of IMU
+        # IMU temperature at power-on (when the gyro offset was measured)
+        self.imu.GyroAccelRead()
+        self.startupTemp = icm20948.Temp[0]
+        
+        # Sample board temperature in the background
+        self.tempSampler = TempSampler()
+        self.tempSampler.start()
+        
+        # Load temperature compensated bias model if one was calibrated
+        self.biasModel = BiasModel()
+        if self.biasModel.load():
+            self.biasModel.compile(self.startupTemp)
+        else:
+            self.biasModel = None
+        
+        # Set system poll rate (Hz) of IMU, sampled at the IMU's output data rate
         self.pollRateHz = 1000 # 1kHz (1ms)
+        self.imu.setSampleRate(self.pollRateHz)
+        
+        # The magnetometer is read by the IMU's I2C master, the mag stage only fetches its last sample
+        self.imu.magStart()
+        self.imu.magFetch()
+        
+        # Rates of the slower loop stages (Hz)
+        self.displayRateHz = 60
+        self.logRateHz = 100
+        self.inputRateHz = 20
+        self.magRateHz = 20 # Output data rate of the magnetometer
+        self.writeRateHz = 10 # Logger blocks fill at logRateHz / 128, at most every 0.128 s
+        self.gripRateHz = 1 # Grip estimates are refreshed once a second
+        
+        # Acquisition runs every tick, every other consumer is a stage with its own rate.
+        # Ticks are paced by ticks_us deadlines or by a hardware timer, see setTiming()
+        self.timing = "deadline"
+        self.scheduler = RateScheduler(self.pollRateHz)
+        self.scheduler.addStage("display", self.displayRateHz, self.updateDisplay)
+        self.scheduler.addStage("log", self.logRateHz, self.updateLog)
+        self.scheduler.addStage("input", self.inputRateHz, self.handleInput)
+        self.scheduler.addStage("mag", self.magRateHz, self.imu.magFetch)
+        self.scheduler.addStage("write", self.writeRateHz, self.writeLog)
+        self.scheduler.addStage("grip", self.gripRateHz, self.updateGrip)
+        
+        # Garbage is only collected in idle ticks (lowest priority stage), see setGcMode()
+        self.gcMode = "idle"
+        self.heap = HeapMonitor()
+        self.scheduler.addStage("gc", 200, self.heap.idle)
+        
+        # Decimating filters between acquisition and the display and logger
+        self.displayFilter = Decimator(3)
+        self.displayMeans = array('l', [0] * 3)
+        self.logFilter = Decimator(6)
+        self.logMeans = array('l', [0] * 6)
+        
+        # Data logger (started by the logger button)
+        self.logger = DataLogger(self.logRateHz)
+        
+        # Live telemetry, sent from acquisition every telemetryEvery ticks (0 = off)
+        self.telemetryRateHz = 0
+        self.telemetryEvery = 0
+        self.telemetryCount = 0
+        self.telemetryFilter = Decimator(6)
+        self.telemetryMeans = array('l', [0] * 6)
+        self.telemetry = TelemetryStream()
+        
+        # Create spin-out detector
+        self.spinDetector = SpinDetector(self.pollRateHz)
+        self.spinning = False
+        
+        # Learn the grip limit of each ride mode from the session
+        self.grip = GripEstimator(self.modeNames, [mode[MODE_MAX_LAT] for mode in self.modes], self.pollRateHz)
+        if self.grip.load():
+            for i in range(len(self.modes)):
+                self.applyGripLimit(i)
+        
+        # Non-blocking command channel for live tuning
+        self.commands = CommandChannel()
+        
+        # Optional vibration analyzer (disabled by default)
+        self.vibration = None
+        self.vibrationAxis = 2 # Z axis
         
         print("GMonitor initialized")
         
@@ -108,21 +173,20 @@ class GMonitor:
     def nextRideMode(self):
         print("Mode Select Button Pressed!")
         
-        # Set ride mode to the next in the dict
-        tempList = list(self.modes)
-
-        # Set new ride mode
-        nextIdx = tempList.index(self.rideMode['name'])+1
+        # Set new ride mode to the next in the dict
+        nextIdx = self.rideModeIdx + 1
         
         # Check if next mode is out of bounds
         if nextIdx > len(self.modes)-1:
             nextIdx = 0
         
-        self.rideMode = self.modes[tempList[nextIdx]]
-        print("\nRide mode switched to: " + str(self.rideMode))
+        self.rideModeIdx = nextIdx
+        self.rideMode = self.modes[nextIdx]
+        self.buildDisplay()
+        print("\nRide mode switched to: " + self.rideMode[MODE_NAME])
         
         # Update center LED to indicate ride mode
-        self.lights["M"].colors[self.rideMode["color"]]()
+        self.rideMode[MODE_COLOR]()
         
         
     # Test LED functionality and Pin correctness
@@ -141,63 +205,39 @@ class GMonitor:
         self.lights['M'].test()
         
             
-    # Compute acceleration values
+    # Read acceleration values, kept as raw LSB (16384 per g) so that no sample is boxed as a float
     def pollAcceleration(self):
-        accelOffset = 16384 # From LSB to g
-        
         self.imu.GyroAccelRead()
+        
+        # Correct temperature drift of the biases
+        if self.biasModel is not None:
+            self.biasModel.correct(icm20948.Accel, icm20948.Gyro, icm20948.Temp[0])
     
-        self.ax = icm20948.Accel[0] / accelOffset # Longitudinal Acceleration
-        self.ay = icm20948.Accel[1] / accelOffset # Lateral Acceleration 
-        self.az = icm20948.Accel[2] / accelOffset # Vertical acceleration
-        
-    # Flash all LEDs in the direction in which it is exceeding
-    # 1.25x the tolerance
-    def flashWarning(self, side, delay):
-        numBlinks = 2
-        
-        if delay < 0.05:
-            delay = 0.050
-        elif delay > 0.2:
-            delay = 0.200
-        
-        # Upward LEDs
-        if side == "up":
-            # Flash warning to user
-            for i in range(numBlinks):
-                self.lights["M"].toggle()
-                self.lights["1U"].toggle()
-                self.lights["2U"].toggle()
-                
-                time.sleep(delay)
-        # Left LEDs
-        if side == "left":
-            # Flash warning to user
-            for i in range(numBlinks):
-                self.lights["1L"].toggle()
-                self.lights["2L"].toggle()
-                time.sleep(delay)
-                
-        # Right LEDs
-        if side == "right":
-            # Flash warning to user
-            for i in range(numBlinks):
-                self.lights["1R"].toggle()
-                self.lights["2R"].toggle()
-                time.sleep(delay)
-                
-        # Down (Rearward) LEDs
-        if side == "down":
-            # Flash warning to user
-            for i in range(numBlinks):
-                self.lights["M"].toggle()
-                self.lights["1D"].toggle()
-                self.lights["2D"].toggle()
-                
-                time.sleep(delay)  
+        self.ax = icm20948.Accel[0] # Lateral acceleration
+        self.ay = icm20948.Accel[1] # Longitudinal acceleration
+        self.az = icm20948.Accel[2] # Vertical acceleration
+        
+    # Calibrate the temperature bias model. The device must be kept
+    # still while its temperature changes (e.g. while the cabin warms up)
+    def calibrateBias(self, seconds=600):
+        print("\nCalibrating bias model for " + str(seconds) + " s, keep the device still...")
+        
+        model = BiasModel()
+        end = time.time() + seconds
+        
+        while time.time() < end:
+            self.imu.GyroAccelRead()
+            model.addSample(icm20948.Accel, icm20948.Gyro, icm20948.Temp[0])
+            time.sleep(0.1)
+            
+        # Fit and store the model
+        if not model.fit():
+            return
+        
+        model.save()
+        model.compile(self.startupTemp)
+        self.biasModel = model
         
-        self.cleanup(clearAll=False)
-                
     # Handle button press for data logger
     def handleLoggerBtn(self):
         press_start = time.time()
@@ -209,10 +249,20 @@ class GMonitor:
         if self.enableLogger:
             self.lights["logger"].value(1)
             print("\nData Logger started!")
+            
+            # Start a new statistics session and log
+            self.stats.reset()
+            self.logFilter.mean(self.logMeans)
+            self.logger.start()
         else:
             self.lights["logger"].value(0)
             print("\nData Logger terminated!")
             
+            # Keep the log, session summary and learned grip on flash
+            self.logger.stop()
+            self.stats.save()
+            self.grip.save()
+            
         # Check if button is being held down
         while self.btnStartLogger.value() == 0:
             # Do nothing
@@ -223,130 +273,264 @@ class GMonitor:
     # latTolerance = lateral g's per led
     # longTolF = longitudinal g's per front led
     # longTolR = longitudinal g's per rear led
+    # The leds of a side flash when approaching the slip angle
     def monitor(self):
         print("\nMonitoring...")
         
-        print("\nRide mode: " + str(self.rideMode))
+        print("\nRide mode: " + self.rideMode[MODE_NAME])
+        
+        # Everything is allocated by now, stop automatic garbage collection
+        if self.gcMode == "idle":
+            self.heap.start(self.scheduler.ticks)
+        
+        self.scheduler.start()
         
         while True:
-            # Check for ride-mode button press
-            if self.btnModeSel.value() == 0:
-                # Set callback behavior for mode select button
-                self.btnModeSel.irq(self.nextRideMode())
-                time.sleep(0.5)
-                
+            # Sample at the poll rate, then run at most one slower stage that is due
+            # (the scheduler is looked up every tick, setTiming() may replace it)
+            scheduler = self.scheduler
+            now = scheduler.wait()
+            self.acquire()
+            scheduler.run(now)
             
-            # Check for startLogger button press
-            if self.btnStartLogger.value() == 0:
-                # Set button call back to toggle logger
-                self.btnStartLogger.irq(self.handleLoggerBtn())
-                
-                
+    # Full rate stage: read the IMU and update everything that needs every sample
+    def acquire(self):
+        # Current ride mode (only ever swapped as a whole)
+        mode = self.rideMode
+        
+        # Get current acceleration forces
+        self.pollAcceleration()
+        
+        # Feed the display and logger filters
+        self.displayFilter.add(icm20948.Accel)
+        self.displayFilter.tick()
+        if self.enableLogger:
+            self.logFilter.add(icm20948.Accel)
+            self.logFilter.add(icm20948.Gyro, 3)
+            self.logFilter.tick()
+        
+        # Stream telemetry at its own (decimated) rate, not as a stage: at the
+        # poll rate it would be due every tick and starve all other stages
+        if self.telemetryEvery:
+            self.telemetryFilter.add(icm20948.Accel)
+            self.telemetryFilter.add(icm20948.Gyro, 3)
+            self.telemetryFilter.tick()
+            self.telemetryCount += 1
+            if self.telemetryCount >= self.telemetryEvery:
+                self.telemetryCount = 0
+                self.telemetryFilter.mean(self.telemetryMeans)
+                self.telemetry.send(self.telemetryMeans, icm20948.Mag, self.rideModeIdx, FLAG_SPIN if self.spinning else 0)
+        
+        # Feed vibration analyzer and run one slice of its FFT
+        if self.vibration is not None:
+            self.vibration.add(icm20948.Accel[self.vibrationAxis])
+            self.vibration.step()
+        
+        # Check for spin-out using gyro yaw rate
+        self.spinning = self.spinDetector.update(icm20948.Gyro[2], self.ax, self.ay)
+        if self.spinning:
+            return
+        
+        # Update session statistics
+        self.stats.update(self.rideModeIdx, self.ax, self.ay, self.az, mode[MODE_LAT_TOL_LSB], mode[MODE_LONG_TOL_F_LSB], mode[MODE_LONG_TOL_R_LSB])
+        
+        # Learn grip limit, the grip stage moves the slip warning after it
+        self.grip.update(self.rideModeIdx, self.ax)
             
-            # Set center LED to indicate ride mode
-            self.lights["M"].colors[self.rideMode["color"]]()
+    # Display stage: show the mean acceleration since the last frame
+    def updateDisplay(self):
+        if self.displayFilter.mean(self.displayMeans) == 0:
+            return
+        
+        if self.spinning:
+            # Flash warning
+            self.display.renderSpin()
+        else:
+            # Show the frame of the raw acceleration (LSB) from the mode's lookup table
+            self.display.render(self.displayMeans[0], self.displayMeans[1])
             
-            # Get current acceleration forces
-            self.pollAcceleration()
+    # Logging stage: buffer the mean of the samples since the last record
+    def updateLog(self):
+        if not self.enableLogger or self.logFilter.mean(self.logMeans) == 0:
+            return
+        
+        self.logger.log(self.logMeans, icm20948.Mag, self.rideModeIdx, FLAG_SPIN if self.spinning else 0)
+        
+    # Write stage: the flash write and flush of a full logger block, kept out of the logging stage
+    def writeLog(self):
+        self.logger.write()
+        
+    # Grip stage: refresh the learned limit of the current mode, the slip warning follows it
+    def updateGrip(self):
+        self.grip.refresh(self.rideModeIdx)
+        self.applyGripLimit(self.rideModeIdx)
+        
+    # Input stage: tuning commands and buttons
+    def handleInput(self):
+        # Apply tuning commands between samples
+        line = self.commands.check()
+        if line is not None:
+            self.handleCommand(line)
             
-            # Set tolerances
-            latTolerance = self.rideMode['latTolerance']
-            longTolF = self.rideMode['longTolF']
-            longTolR = self.rideMode['longTolR']
+        # Check for ride-mode button press
+        if self.btnModeSel.value() == 0:
+            # Set callback behavior for mode select button
+            self.btnModeSel.irq(self.nextRideMode())
+            time.sleep(0.5)
+            
+        
+        # Check for startLogger button press
+        if self.btnStartLogger.value() == 0:
+            # Set button call back to toggle logger
+            self.btnStartLogger.irq(self.handleLoggerBtn())
+            
+    """
+    Handle a tuning command from the USB REPL
 
+    get <param>              Print a parameter
+    set <param> <value>      Change a parameter
+    stats                    Print session statistics
+    info                     Print system information
+    save                     Save ride modes to flash
+
+    <param> is pollRateHz, displayRateHz, logRateHz, telemetryRateHz, timing, gc, mode, display, or a ride mode field (latTolerance,
+    longTolF, longTolR, maxLatForce, color) of the current mode.
+    Prefix a field with a mode name to change another mode,
+    e.g. "set race.latTolerance 0.45"
+    """
+    def handleCommand(self, line):
+        args = line.split()
+        if len(args) == 0:
+            return
+        
+        cmd = args[0]
+        
+        if cmd == "stats":
+            self.stats.dump()
+        elif cmd == "info":
+            self.printInfo()
+        elif cmd == "save":
+            saveModes(self.modes, self.rideModeIdx, priors=self.grip.priors)
+        elif cmd == "get" and len(args) == 2:
+            value = self.getParam(args[1])
+            if value is None:
+                print("err unknown parameter " + args[1])
+            else:
+                print("ok " + args[1] + "=" + str(value))
+        elif cmd == "set" and len(args) == 3:
+            try:
+                self.setParam(args[1], args[2])
+                print("ok " + args[1] + "=" + str(self.getParam(args[1])))
+            except ValueError as e:
+                print("err " + str(e))
+        else:
+            print("err usage: get <param> | set <param> <value> | stats | info | save")
             
-            # Compute time delay
-            delay = 1 / self.pollRateHz
+    # Split "[mode.]field" into (mode index, field)
+    def parseParam(self, param):
+        if "." in param:
+            name, field = param.split(".", 1)
+            if not name in self.modeNames:
+                raise ValueError("unknown mode " + name)
+            return self.modeNames.index(name), field
+        return self.rideModeIdx, param
+    
+    # Get a tunable parameter, None if it does not exist
+    def getParam(self, param):
+        if param == "pollRateHz":
+            return self.pollRateHz
+        elif param == "displayRateHz":
+            return self.displayRateHz
+        elif param == "logRateHz":
+            return self.logRateHz
+        elif param == "telemetryRateHz":
+            return self.telemetryRateHz
+        elif param == "timing":
+            return self.timing
+        elif param == "gc":
+            return self.gcMode
+        elif param == "mode":
+            return self.rideMode[MODE_NAME]
+        elif param == "display":
+            return self.displayMode
+        
+        try:
+            idx, field = self.parseParam(param)
+        except ValueError:
+            return None
+        
+        return modeProfile(self.modes[idx], self.grip.priors[idx]).get(field)
+    
+    # Set a tunable parameter, raises ValueError if it is invalid
+    def setParam(self, param, value):
+        if param == "pollRateHz":
+            self.setPollRateHz(int(value))
+            return
+        elif param == "displayRateHz":
+            self.setDisplayRateHz(int(value))
+            return
+        elif param == "logRateHz":
+            self.setLogRateHz(int(value))
+            return
+        elif param == "telemetryRateHz":
+            self.setTelemetryRateHz(int(value))
+            return
+        elif param == "timing":
+            self.setTiming(value)
+            return
+        elif param == "gc":
+            self.setGcMode(value)
+            return
+        elif param == "mode":
+            if not value in self.modeNames:
+                raise ValueError("unknown mode " + value)
+            self.setRideMode(value)
+            return
+        elif param == "display":
+            self.setDisplayMode(value)
+            return
+        
+        idx, field = self.parseParam(param)
+        
+        if not field == "color":
+            value = float(value)
+        
+        self.replaceMode(idx, updateMode(self.modes[idx], field, value, self.lights["M"].colors))
+        
+        # A configured grip limit restarts learning from that value
+        if field == "maxLatForce":
+            self.grip.priors[idx] = value
+            self.grip.limit[idx] = value
             
-            # Check lateral acceleration
-            if self.ax > latTolerance or self.ax < -latTolerance:
-                # Check direction
-                if self.ax < 0:
-                    # Right
-                    numLeds = round(abs(self.ax / latTolerance))
-                    
-                    # Approaching slip angle
-                    if self.ax <= -(self.maxLatForce - 0.1):
-                        warningDelay = 0.1 / abs(self.ax/latTolerance)
-                        
-                        # Flash warning
-                        self.flashWarning("right", warningDelay)
-                        
-                    else:
-                        if numLeds == 1:
-                            self.lights["1R"].toggle()
-                            time.sleep(delay)
-                            self.lights["1R"].toggle()
-                        elif numLeds >= 2:
-                            self.lights["1R"].toggle()
-                            self.lights['2R'].toggle()
-                            time.sleep(delay)
-                            self.lights['1R'].toggle()
-                            self.lights['2R'].toggle()
-                        
-                    
-                    
-                # Left
-                else: 
-                    numLeds = round(abs(self.ax / latTolerance))
-                    
-                    # Approaching slip angle
-                    if self.ax >= self.maxLatForce - 0.1:
-                        warningDelay = 0.1 / abs(self.ax/latTolerance)
-                        
-                        # Flash warning
-                        self.flashWarning("left", warningDelay)
-                    else:
-                        if numLeds == 1:
-                            self.lights["1L"].toggle()
-                            time.sleep(delay)
-                            self.lights["1L"].toggle()
-                        elif numLeds >= 2:
-                            self.lights["1L"].toggle()
-                            self.lights['2L'].toggle()
-                            time.sleep(delay)
-                            self.lights['1L'].toggle()
-                            self.lights['2L'].toggle()
-                            
-            # Check direction of acceleration
-            if self.ay > 0:
-                # Forward
-                numLeds = round(abs(self.ay/longTolR))
-                
-                if numLeds == 1:
-                    self.lights["1D"].toggle()
-                    time.sleep(delay)
-                    self.lights["1D"].toggle()
-                elif numLeds >= 2:
-                    self.lights["1D"].toggle()
-                    self.lights['2D'].toggle()
-                    time.sleep(delay)
-                    self.lights['1D'].toggle()
-                    self.lights['2D'].toggle()
-                    
-            # Braking
-            elif self.ay <= 0:
-                numLeds = round(abs(self.ay/longTolF))
-                
-                if numLeds == 1:
-                    self.lights["1U"].toggle()
-                    time.sleep(delay)
-                    self.lights["1U"].toggle()
-                elif numLeds >= 2:
-                    self.lights["1U"].toggle()
-                    self.lights['2U'].toggle()
-                    time.sleep(delay)
-                    self.lights['1U'].toggle()
-                    self.lights['2U'].toggle()
-                    
+    # Swap in a recompiled mode as a whole (warningOnly: only the slip warning changed, patch the display instead of rebuilding it)
+    def replaceMode(self, idx, mode, warningOnly=False):
+        self.modes = self.modes[:idx] + (mode,) + self.modes[idx+1:]
         
-                        
-            # Reset middle LED
-            self.lights["M"].clear()
-
+        if idx == self.rideModeIdx:
+            self.rideMode = mode
+            if warningOnly:
+                self.display.setWarning(mode[MODE_LAT_WARN])
+            else:
+                self.buildDisplay()
+            
+    # Apply the learned grip limit of a mode once it moved by 0.01g
+    def applyGripLimit(self, idx):
+        limit = self.grip.getLimit(idx)
+        mode = self.modes[idx]
+        
+        if abs(limit - mode[MODE_MAX_LAT]) >= 0.01:
+            try:
+                mode = updateMode(mode, "maxLatForce", limit, self.lights["M"].colors)
+            except ValueError:
+                # A learned limit at or below the mode's tolerance keeps the last valid one
+                return
+            self.replaceMode(idx, mode, True)
             
     # Free system resources and disable all GPIO
     def cleanup(self, clearAll=True):
+        # Turn off direction LEDs
+        self.display.clear()
+        
         # Disable all GPIO
         for pin in self.lights:
             # Check if pin is rgb led
@@ -363,13 +547,38 @@ class GMonitor:
             
             self.lights[pin].value(0)
             
+        # Stop the sample timer, close the log and collect garbage automatically again
+        self.scheduler.stop()
+        self.logger.stop()
+        self.heap.stop()
+        
+        # Stop background temperature sampling
+        if clearAll:
+            self.tempSampler.stop()
+            
             
     # Print system info to console
     def printInfo(self):
         print("\n\nGMonitor System Information:")
         print("=======================================")
-        print("IMU Poll Rate: " + str(self.pollRateHz) + " Hz")
-        print("Ride Mode: " + str(self.rideMode))
+        print("IMU Poll Rate: " + str(self.pollRateHz) + " Hz (" + self.timing + " timing)")
+        self.scheduler.report()
+        self.heap.report(self.scheduler.ticks)
+        print("Data Logger: " + ("logging session " + str(self.logger.session) if self.logger.active() else "stopped"))
+        print("Telemetry: " + (str(self.telemetryRateHz) + " Hz, " + str(self.telemetry.sent) + " frames sent" if self.telemetryEvery else "off"))
+        print("Ride Mode: " + self.rideMode[MODE_NAME])
+        print("Display: " + self.displayMode)
+        print("IMU Temperature: %.1f C" % self.imu.tempCelsius())
+        print("Board Temperature: %.1f C" % self.tempSampler.celsius())
+        print("Bias Compensation: " + ("enabled" if self.biasModel is not None else "not calibrated"))
+        print("Grip Limit: %.2f g (configured %.2f g)" % (self.grip.getLimit(self.rideModeIdx), self.grip.priors[self.rideModeIdx]))
+        
+        # Session statistics
+        self.stats.dump()
+        
+        # Vibration spectrum
+        if self.vibration is not None:
+            self.vibration.report()
         
             
     """
@@ -377,14 +586,164 @@ class GMonitor:
     """
     def setRideMode(self, mode):
         # Check if mode is valid
-        if not mode in self.modes:
+        if not mode in self.modeNames:
             print("Error in setRideMode(): invalid mode")
             return
         else:
-            self.rideMode = self.modes[mode]
+            self.rideModeIdx = self.modeNames.index(mode)
+            self.rideMode = self.modes[self.rideModeIdx]
+            self.rideMode[MODE_COLOR]()
+            self.buildDisplay()
                 
     def setPollRateHz(self, pollRate):
+        # Check if poll rate is valid
+        if pollRate <= 0:
+            raise ValueError("poll rate must be positive")
+        
         self.pollRateHz = pollRate
+        self.imu.setSampleRate(pollRate)
+        self.scheduler.setRate(pollRate)
+        self.spinDetector = SpinDetector(pollRate)
+        
+        if self.vibration is not None:
+            self.vibration = VibrationAnalyzer(pollRate)
+        
+        self.grip.setSampleRate(pollRate)
+        
+        if self.telemetryRateHz > pollRate:
+            self.setTelemetryRateHz(pollRate)
+        else:
+            self.setTelemetryRateHz(self.telemetryRateHz)
+        
+    def setDisplayRateHz(self, displayRate):
+        self.scheduler.stage("display").setRate(displayRate)
+        self.displayRateHz = displayRate
+        
+    """
+    Switch how acquisition ticks are paced
+
+    deadline: the loop waits for ticks_us deadlines
+    timer: hard-periodic ticks from machine.Timer, the loop only picks them up
+    """
+    def setTiming(self, timing):
+        # Check if timing is valid
+        if not timing in ("deadline", "timer"):
+            raise ValueError("timing must be deadline or timer")
+        
+        if timing == self.timing:
+            return
+        
+        if timing == "timer":
+            scheduler = TimerScheduler(self.pollRateHz)
+        else:
+            scheduler = RateScheduler(self.pollRateHz)
+        
+        # Keep the stages, restart pacing and overrun accounting
+        self.scheduler.stop()
+        scheduler.stages = self.scheduler.stages
+        scheduler.ticks = self.scheduler.ticks
+        scheduler.resetTiming()
+        scheduler.start()
+        
+        self.scheduler = scheduler
+        self.timing = timing
+        
+    """
+    Switch garbage collection
+
+    auto: MicroPython collects whenever its allocation threshold is reached
+    idle: automatic collection is disabled while monitoring and the heap
+    is collected in idle ticks only (steady-state mode)
+    """
+    def setGcMode(self, gcMode):
+        # Check if gc mode is valid
+        if not gcMode in ("auto", "idle"):
+            raise ValueError("gc must be auto or idle")
+        
+        if gcMode == "idle":
+            self.heap.start(self.scheduler.ticks)
+        else:
+            self.heap.stop()
+            
+        self.gcMode = gcMode
+        
+    def setLogRateHz(self, logRate):
+        self.logger.setRate(logRate)
+        self.scheduler.stage("log").setRate(logRate)
+        self.logRateHz = logRate
+        
+    # Stream telemetry frames over USB at up to the poll rate (0 = off)
+    def setTelemetryRateHz(self, telemetryRate):
+        # Check if telemetry rate is valid
+        if telemetryRate < 0 or telemetryRate > self.pollRateHz:
+            raise ValueError("telemetry rate must be 0 - " + str(self.pollRateHz) + " Hz")
+        
+        if telemetryRate > 0 and self.telemetryRateHz == 0:
+            self.telemetry.start()
+            self.telemetryFilter.mean(self.telemetryMeans)
+        
+        self.telemetryRateHz = telemetryRate
+        self.telemetryEvery = self.pollRateHz // telemetryRate if telemetryRate > 0 else 0
+        self.telemetryCount = 0
+        
+    """
+    Switch the direction LED display
+
+    discrete: the original "+" layout, one GPIO per LED
+    gauge: the "+" layout with PWM brightness proportional to g
+    shift: bars of ledsPerBar LEDs on a 74HC595 shift register chain
+    neopixel: bars of ledsPerBar LEDs on a WS2812 strip
+    """
+    def setDisplayMode(self, displayMode, ledsPerBar=8):
+        # Check if display mode is valid
+        if not displayMode in ("discrete", "gauge", "shift", "neopixel"):
+            raise ValueError("display must be discrete, gauge, shift or neopixel")
+        
+        if displayMode == self.displayMode:
+            return
+        
+        # Backends on their own pins are created first, so a missing driver
+        # (ValueError) leaves the current display running
+        display = None
+        if displayMode == "shift":
+            display = ShiftRegisterBar(ledsPerBar)
+        elif displayMode == "neopixel":
+            display = NeoPixelBar(ledsPerBar)
+        
+        # Release the current display, handing the "+" pins back to GPIO
+        self.display.deinit()
+        if self.displayMode == "gauge":
+            for name in self.lightPins:
+                if name != "logger":
+                    self.lights[name] = Pin(self.lightPins[name], Pin.OUT)
+        
+        if displayMode == "discrete":
+            display = GpioBar(self.lights)
+        elif displayMode == "gauge":
+            display = PwmGauge(self.lightPins)
+                    
+        self.display = display
+        self.displayMode = displayMode
+        self.buildDisplay()
+        
+    # Rebuild display lookup tables for the current ride mode (on mode or threshold changes only)
+    def buildDisplay(self):
+        mode = self.rideMode
+        self.display.build(mode[MODE_LAT_TOL], mode[MODE_LONG_TOL_F], mode[MODE_LONG_TOL_R], mode[MODE_LAT_WARN])
+            
+    # Enable or disable vibration analysis on an axis (0 = x, 1 = y, 2 = z)
+    def setVibrationAnalysis(self, enable, axis=2):
+        # Check if axis is valid
+        if not axis in (0, 1, 2):
+            print("Error in setVibrationAnalysis(): invalid axis")
+            return
+        
+        self.vibrationAxis = axis
+        
+        if enable:
+            self.vibration = VibrationAnalyzer(self.pollRateHz)
+        else:
+            self.vibration = None
                 
 def main():
     
@@ -0,0 +1,217 @@
+"""
+This file contains an on-line grip limit estimator for GMonitor.
+
+The maximum lateral force a car can hold depends on tires, weather
+and surface, so a constant slip-warning threshold is only ever right
+on one day. This estimator learns it from the session instead:
+
+    - Lateral g is low-pass filtered so that short spikes (curbs,
+      bumps) do not count as grip
+    - While cornering, the sustained lateral g is added to a fixed-bin
+      histogram per ride mode, the same quantity the slip warning
+      compares against the limit. Old samples are halved away once a
+      mode's histogram is full, so it tracks the conditions of the day
+    - Once a second a high percentile of the histogram is taken as the
+      observed grip. The mode's limit moves slowly up towards it, but
+      only moves down once the driver has spent some time near the
+      limit: a gentle driver has not found the grip, so the limit
+      stays where it is
+    - The limit stays within bounds of the configured profile value
+      (the prior). The prior is never replaced by the learned limit,
+      which is only kept in grip.json, so the bounds do not drift
+      from session to session
+
+Memory is fixed and each update is O(1): it filters and bins the
+raw sample in integer arithmetic, so no float is boxed per sample.
+Decay and the percentile walk run in refresh(), once a second from
+a low-priority scheduler stage. Learned limits are saved to flash
+and reloaded at boot.
+
+kward
+"""
+from array import array
+import math
+import json
+
+ACCEL_LSB_PER_G = 16384 # ICM-20948 at +-2g full scale
+
+# Sustained lateral g histogram, HIST_BINS bins of BIN_G g
+HIST_BINS = 80
+BINS_PER_G = 40
+BIN_G = 1 / BINS_PER_G
+
+# The filtered lateral acceleration is raw LSB with FILTER_BITS fraction bits,
+# its coefficient has ALPHA_BITS
+FILTER_BITS = 4
+ALPHA_BITS = 12
+
+# Halve a mode's histogram once it holds this many samples
+HIST_CAP = 60000
+
+# Main class
+class GripEstimator:
+
+    """
+    Initialize estimator
+
+    modeNames: ride mode names, one estimate is kept per mode
+    priors: configured maxLatForce of each mode (g)
+    sampleRateHz: rate at which update() is called, refresh() is called once a second
+    filterMs: time constant of the spike rejection filter
+    percentile: fraction of sustained samples below the grip estimate
+    """
+    def __init__(self, modeNames, priors, sampleRateHz=1000, filterMs=150, percentile=0.995):
+        self.modeNames = modeNames
+        self.numModes = len(modeNames)
+        self.percentile = percentile
+
+        self.filterMs = filterMs
+        self.setSampleRate(sampleRateHz)
+        self.latF = 0
+
+        # Only count samples while cornering (0.3 g, filtered units)
+        self.floor = int(0.3 * ACCEL_LSB_PER_G) << FILTER_BITS
+
+        # Lowering the limit needs nearSeconds of samples above nearScale of it
+        self.nearScale = 0.85
+        self.nearSeconds = 3
+
+        # Adaptation: fraction of the gap closed per estimate, bounds around the prior
+        self.rate = 0.05
+        self.minScale = 0.7
+        self.maxScale = 1.4
+
+        self.hist = array('L', [0] * (self.numModes * HIST_BINS))
+        self.total = array('L', [0] * self.numModes)
+        self.priors = array('f', priors)
+        self.limit = array('f', priors)
+
+    # Set the rate at which update() is called
+    def setSampleRate(self, sampleRateHz):
+        # Exponential filter coefficient for the sustained g (fixed point)
+        self.alpha = max(1, int((1 - math.exp(-1000 / (self.filterMs * sampleRateHz))) * (1 << ALPHA_BITS) + 0.5))
+        self.sampleRateHz = sampleRateHz
+
+    """
+    Add one sample
+
+    modeIdx: index of the current ride mode
+    ax: raw lateral acceleration (LSB)
+    """
+    def update(self, modeIdx, ax):
+        # Reject spikes
+        self.latF += ((ax << FILTER_BITS) - self.latF) * self.alpha >> ALPHA_BITS
+
+        lateral = abs(self.latF)
+
+        if lateral > self.floor:
+            b = lateral * BINS_PER_G // (ACCEL_LSB_PER_G << FILTER_BITS)
+            if b >= HIST_BINS:
+                b = HIST_BINS - 1
+
+            self.hist[modeIdx * HIST_BINS + b] += 1
+            self.total[modeIdx] += 1
+
+    # Halve the histogram of a mode
+    def decay(self, modeIdx):
+        total = 0
+        for b in range(modeIdx * HIST_BINS, (modeIdx + 1) * HIST_BINS):
+            self.hist[b] >>= 1
+            total += self.hist[b]
+        self.total[modeIdx] = total
+
+    # Observed grip (g) of a mode, 0 if there is not enough data yet
+    def observed(self, modeIdx):
+        total = self.total[modeIdx]
+        if total < self.sampleRateHz:
+            return 0.0
+
+        # Walk down from the top bin until the tail holds 1 - percentile
+        tail = int(total * (1 - self.percentile))
+        count = 0
+        for b in range(HIST_BINS - 1, -1, -1):
+            count += self.hist[modeIdx * HIST_BINS + b]
+            if count > tail:
+                return (b + 1) * BIN_G
+
+        return 0.0
+
+    # Samples of a mode at or above g
+    def samplesAbove(self, modeIdx, g):
+        first = int(g / BIN_G)
+        if first >= HIST_BINS:
+            first = HIST_BINS - 1
+
+        count = 0
+        for b in range(modeIdx * HIST_BINS + first, (modeIdx + 1) * HIST_BINS):
+            count += self.hist[b]
+        return count
+
+    # Forget old samples and move a mode's limit towards the observed grip, called once a second
+    def refresh(self, modeIdx):
+        for i in range(self.numModes):
+            if self.total[i] >= HIST_CAP:
+                self.decay(i)
+
+        observed = self.observed(modeIdx)
+        if observed == 0.0:
+            return
+
+        # Below the limit only counts once the driver got near it
+        if observed < self.limit[modeIdx]:
+            near = self.samplesAbove(modeIdx, self.limit[modeIdx] * self.nearScale)
+            if near < self.nearSeconds * self.sampleRateHz:
+                return
+
+        limit = self.limit[modeIdx] + (observed - self.limit[modeIdx]) * self.rate
+
+        # Stay within bounds of the configured value
+        prior = self.priors[modeIdx]
+        if limit < prior * self.minScale:
+            limit = prior * self.minScale
+        elif limit > prior * self.maxScale:
+            limit = prior * self.maxScale
+
+        self.limit[modeIdx] = limit
+
+    # Learned maxLatForce of a mode (g)
+    def getLimit(self, modeIdx):
+        return self.limit[modeIdx]
+
+    # Save learned limits to flash
+    def save(self, filename="grip.json"):
+        limits = {}
+        for i in range(self.numModes):
+            limits[self.modeNames[i]] = self.limit[i]
+
+        with open(filename, "w") as f:
+            json.dump(limits, f)
+
+        print("Grip limits saved to: " + filename)
+
+    # Load learned limits from flash (modes missing from the file keep their prior, an invalid file keeps all priors)
+    def load(self, filename="grip.json"):
+        try:
+            with open(filename) as f:
+                limits = json.load(f)
+            if not isinstance(limits, dict):
+                raise TypeError("expected an object of mode limits")
+            learned = {}
+            for name in self.modeNames:
+                if name in limits:
+                    learned[name] = float(limits[name])
+                    if not math.isfinite(learned[name]):
+                        raise ValueError("limit of mode " + name + " is not finite")
+        except OSError:
+            return False
+        except (ValueError, TypeError, KeyError) as e:
+            print("Error in GripEstimator.load(): invalid " + filename + ": " + str(e))
+            return False
+
+        for i in range(self.numModes):
+            name = self.modeNames[i]
+            if name in learned:
+                prior = self.priors[i]
+                self.limit[i] = min(max(learned[name], prior * self.minScale), prior * self.maxScale)
+
+        return True
@@ -0,0 +1,293 @@
+"""
+This file contains the heap accounting of GMonitor's zero-GC
+steady-state mode.
+
+MicroPython collects garbage whenever an allocation crosses its
+threshold, which can put a multi-millisecond pause in the middle of
+a corner. In steady-state mode all buffers are preallocated at
+startup, automatic collection is disabled while monitoring, and
+idle() runs gc.collect() from a low-priority scheduler stage, i.e.
+only in ticks where no other stage is due, once free memory falls
+below a threshold. (MicroPython still collects on its own if an
+allocation fails, which is counted as an emergency collection.)
+
+Between two collections the heap only grows, so the growth seen by
+idle() is the number of bytes the loop allocated. It is reported per
+1000 iterations together with the heap high-water mark.
+
+Run this file on a host to audit the hot path with tracemalloc: it
+fails if the components or the whole monitor loop (acquisition and
+every stage, running on the simulated board) keep any memory
+allocated from one iteration to the next. CPython cannot see
+transient allocations, deviceAudit() counts those on the Pico.
+
+kward
+"""
+import gc
+
+try:
+    import micropython
+except ImportError:
+    micropython = None
+
+BLOCK_BYTES = 16 # MicroPython heap block size
+BOXED_BYTES = 32 # Largest CPython int or float object, see audit()
+
+# Main class
+class HeapMonitor:
+
+    """
+    Initialize monitor
+
+    thresholdBytes: collect in an idle slot once less memory is free
+    """
+    def __init__(self, thresholdBytes=49152):
+        self.thresholdBytes = thresholdBytes
+        self.enabled = False
+        self.reset()
+
+    # Clear the counters
+    def reset(self):
+        self.allocated = 0
+        self.highWater = 0
+        self.collections = 0
+        self.emergencies = 0
+        self.lastAlloc = 0
+        self.startIterations = 0
+
+    # Collect once and disable automatic collection (iterations: loop count at the start)
+    def start(self, iterations=0):
+        gc.collect()
+        gc.disable()
+        self.enabled = True
+        self.reset()
+        self.startIterations = iterations
+        self.lastAlloc = gc.mem_alloc()
+        self.highWater = self.lastAlloc
+
+    # Enable automatic collection again
+    def stop(self):
+        gc.enable()
+        self.enabled = False
+
+    # Account the heap growth since the last call and collect if memory runs low
+    def idle(self):
+        if not self.enabled:
+            return
+
+        alloc = gc.mem_alloc()
+        if alloc >= self.lastAlloc:
+            self.allocated += alloc - self.lastAlloc
+        else:
+            # The heap shrank, MicroPython had to collect on a failed allocation
+            self.emergencies += 1
+
+        if alloc > self.highWater:
+            self.highWater = alloc
+
+        if gc.mem_free() < self.thresholdBytes:
+            gc.collect()
+            self.collections += 1
+            alloc = gc.mem_alloc()
+
+        self.lastAlloc = alloc
+
+    # Print heap statistics over serial (iterations: current loop count)
+    def report(self, iterations):
+        if not self.enabled:
+            print("Heap: automatic GC, %d bytes free" % gc.mem_free())
+            return
+
+        iterations -= self.startIterations
+        perThousand = self.allocated * 1000 // iterations if iterations > 0 else 0
+        print("Heap: high-water %d bytes, %d bytes free" % (self.highWater, gc.mem_free()))
+        print("Allocated per 1000 iterations: %d bytes (%d blocks)" % (perThousand, perThousand // BLOCK_BYTES))
+        print("Idle collections: %d, emergency collections: %d" % (self.collections, self.emergencies))
+
+        if micropython is not None:
+            micropython.mem_info()
+
+
+"""
+Host audit of the hot path
+
+tracemalloc cannot see MicroPython's heap, and on CPython every int
+and float is boxed, so it cannot count transient allocations either.
+What it does catch is memory that survives an iteration: growing
+lists, buffers created per call, cached strings. Each component is
+warmed up, then run for 1000 iterations between two snapshots, and
+any growth attributed to a component file fails the audit.
+
+Single boxed numbers (BOXED_BYTES or less) are not counted: whether
+an int attribute holds a cached small int or a new object depends on
+where the loop is when a snapshot is taken, while on the Pico the
+same ints are small ints that are never allocated. The components
+keep samples as raw ints, so no float is boxed either.
+"""
+def audit(name, step, iterations=1000, ignore=()):
+    import tracemalloc
+
+    for i in range(100):
+        step(i)
+
+    tracemalloc.start()
+    before = retainedBytes(tracemalloc.take_snapshot(), ignore)
+    for i in range(iterations):
+        step(i)
+    after = retainedBytes(tracemalloc.take_snapshot(), ignore)
+    tracemalloc.stop()
+
+    growth = after - before
+    ok = growth <= 0
+    print("%-20s %6d bytes retained per %d iterations %s" % (name, growth, iterations, "ok" if ok else "FAIL"))
+    return ok
+
+# Bytes held by the components in a snapshot (not this driver, tracemalloc itself, ignored host models or boxed numbers)
+def retainedBytes(snapshot, ignore):
+    skip = ("HeapMonitor.py", "tracemalloc.py") + tuple(ignore)
+    total = 0
+    for trace in snapshot.traces:
+        if trace.size > BOXED_BYTES and not trace.traceback[0].filename.endswith(skip):
+            total += trace.size
+    return total
+
+"""
+Device audit of the monitor loop (run on the Pico)
+
+Runs ticks iterations of the loop (acquisition and the stage that is
+due) with automatic collection disabled and reads gc.mem_alloc()
+around each part, which counts every allocation, transient or not.
+Acquisition keeps every sample as a raw int and must not allocate at
+all, so any byte there fails the audit. The stages are reported
+separately: the once a second grip stage works in floats and a
+handled command allocates, the others should show nothing. Start the
+data logger or telemetry first to include them:
+
+    >>> import GMonitor, HeapMonitor
+    >>> HeapMonitor.deviceAudit(GMonitor.GMonitor())
+"""
+def deviceAudit(monitor, ticks=1000):
+    scheduler = monitor.scheduler
+    scheduler.start()
+
+    # Warm up first frames and stage deadlines
+    for i in range(100):
+        now = scheduler.wait()
+        monitor.acquire()
+        scheduler.run(now)
+
+    acquired = 0
+    staged = 0
+    gc.collect()
+    gc.disable()
+    for i in range(ticks):
+        now = scheduler.wait()
+        before = gc.mem_alloc()
+        monitor.acquire()
+        middle = gc.mem_alloc()
+        scheduler.run(now)
+        acquired += middle - before
+        staged += gc.mem_alloc() - middle
+    gc.enable()
+
+    ok = acquired == 0
+    print("Acquisition: %d bytes allocated in %d ticks %s" % (acquired, ticks, "ok" if ok else "FAIL"))
+    print("Stages: %d bytes allocated in %d ticks" % (staged, ticks))
+    return ok
+
+# Discards telemetry frames during the host audit
+class NullStream:
+    def write(self, data):
+        return len(data)
+
+def main():
+    import tempfile
+    import Simulator
+
+    # The whole monitor loop runs on the simulated board (registered before any device module is imported)
+    sim = Simulator.install()
+
+    from array import array
+    import math
+    from Classifier import FrameClassifier
+    from Scheduler import Decimator
+    from SessionStats import SessionStats
+    from GripEstimator import GripEstimator
+    from SpinDetector import SpinDetector
+    from VibrationAnalyzer import VibrationAnalyzer
+
+    # Synthetic raw samples of a slalom
+    accel = [array('l', [int(12000 * math.sin(i / 50)), int(4000 * math.cos(i / 80)), 16384]) for i in range(256)]
+
+    classifier = FrameClassifier(8)
+    classifier.build(0.3, 0.6, 0.25, 14000)
+    decimator = Decimator(3)
+    means = array('l', [0] * 3)
+    stats = SessionStats(("normal",))
+    grip = GripEstimator(("normal",), (0.95,))
+    spin = SpinDetector()
+    vibration = VibrationAnalyzer(1000)
+
+    def classify(i):
+        a = accel[i & 255]
+        classifier.classify(a[0], a[1])
+
+    def decimate(i):
+        decimator.add(accel[i & 255])
+        decimator.tick()
+        if i & 15 == 0:
+            decimator.mean(means)
+
+    def statistics(i):
+        a = accel[i & 255]
+        stats.update(0, a[0], a[1], a[2], 4915, 9830, 4096)
+
+    def gripEstimate(i):
+        a = accel[i & 255]
+        grip.update(0, a[0])
+        if i % 1000 == 0:
+            grip.refresh(0)
+
+    def spinDetect(i):
+        a = accel[i & 255]
+        spin.update(200, a[0], a[1])
+
+    def vibrationStep(i):
+        vibration.add(accel[i & 255][2])
+        vibration.step()
+
+    # Acquisition, display, logging (to a temporary directory), telemetry, input and gc stages
+    from GMonitor import GMonitor
+    monitor = GMonitor()
+    monitor.commands = Simulator.ScriptedCommands((), sim.clock)
+    monitor.setVibrationAnalysis(True)
+    monitor.logger.directory = tempfile.mkdtemp()
+    monitor.enableLogger = True
+    monitor.logger.start()
+    monitor.setTelemetryRateHz(100)
+    monitor.telemetry.out = NullStream()
+    sim.imu.load(Simulator.packBursts([array('h', [a[0] for a in accel]), array('h', [a[1] for a in accel]),
+        16384, 40, -25, 300, 0]) * 1000)
+    monitor.scheduler.start()
+
+    def monitorTick(i):
+        scheduler = monitor.scheduler
+        now = scheduler.wait()
+        monitor.acquire()
+        scheduler.run(now)
+
+    print("\nGMonitor hot path allocation audit")
+    print("=======================================")
+
+    ok = True
+    for name, step in (("classify", classify), ("decimate", decimate), ("statistics", statistics),
+                       ("grip", gripEstimate), ("spin", spinDetect), ("vibration", vibrationStep)):
+        ok = audit(name, step) and ok
+    ok = audit("monitor loop", monitorTick, ignore=("Simulator.py",)) and ok
+    monitor.logger.stop()
+
+    if not ok:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
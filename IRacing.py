@@ -0,0 +1,386 @@
+"""
+This file imports iRacing telemetry (.ibt) to replay sim sessions
+through GMonitor (run on a computer).
+
+An .ibt file is a header, a table of variables (name, type, offset in
+the record, unit) and then one fixed-size record per sample at the
+sim's tick rate (60 Hz). IbtReader parses the header and variable
+table once and memory-maps the file, after which a channel is
+gathered straight out of the records with a strided slice per byte
+(or a strided NumPy view when NumPy is installed), so only the
+channels used are ever touched.
+
+The acceleration and rotation rate channels are:
+
+    - Resampled to the monitor's rate by linear interpolation, chunk
+      by chunk on one continuous time base, so an hour long session
+      streams in constant memory
+    - Converted to the raw LSB counts of the ICM-20948 (16384 LSB/g,
+      32.8 LSB/dps) in the monitor's axes: ax positive = left,
+      ay positive = forward, az = vertical including gravity, and
+      gx, gy, gz the rates about them (pitch, roll and yaw rate)
+    - Packed into 14 byte register bursts (Simulator.packBursts())
+      for the host replay of GMonitor, or written as a session with
+      one lap per sim lap into a session store (SessionStore.py)
+
+iRacing's car axes are x forward, y left, z up, the same as the
+monitor's. Use -f for a board mounted the other way round.
+
+Usage:
+    python IRacing.py FILE.ibt                         Print the header, channels and laps
+    python IRacing.py FILE.ibt --replay                Replay the session through GMonitor at 1 kHz
+    python IRacing.py FILE.ibt --replay -l 3 -m race   Replay lap 3 in race mode
+    python IRacing.py FILE.ibt -s STORE -r 1000        Add the session to a session store
+
+kward
+"""
+import argparse
+import mmap
+import struct
+import sys
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# irsdk_header: ver, status, tickRate, sessionInfoUpdate, sessionInfoLen, sessionInfoOffset,
+# numVars, varHeaderOffset, numBuf, bufLen, pad[2], then varBuf[4] of (tickCount, bufOffset, pad[2])
+HEADER_FORMAT = "<12i"
+HEADER_SIZE = 112
+VAR_BUF_FORMAT = "<4i"
+VAR_BUF_OFFSET = 48
+
+# irsdk_diskSubHeader: sessionStartDate, sessionStartTime, sessionEndTime, sessionLapCount, sessionRecordCount
+DISK_HEADER_FORMAT = "<qddii"
+DISK_HEADER_OFFSET = HEADER_SIZE
+
+# irsdk_varHeader: type, offset, count, countAsTime, name, desc, unit
+VAR_HEADER_FORMAT = "<iii?3x32s64s32s"
+VAR_HEADER_SIZE = 144
+
+# Variable types: struct format
+VAR_TYPES = {
+    0: "c", # char
+    1: "?", # bool
+    2: "i", # int
+    3: "I", # bitField
+    4: "f", # float
+    5: "d" # double
+}
+
+# Channels used (m/s^2 including gravity, rad/s)
+LONG_ACCEL = "LongAccel"
+LAT_ACCEL = "LatAccel"
+VERT_ACCEL = "VertAccel"
+YAW_RATE = "YawRate"
+ROLL_RATE = "RollRate"
+PITCH_RATE = "PitchRate"
+LAP = "Lap"
+
+STANDARD_GRAVITY = 9.80665
+ACCEL_LSB_PER_G = 16384 # ICM-20948 at +-2g full scale
+GYRO_LSB_PER_DPS = 32.8 # ICM-20948 at +-1000 dps full scale
+DEG_PER_RAD = 57.29577951308232
+TEMP_RAW = 3005 # TEMP_OUT of 30 C
+
+CHUNK_RECORDS = 600 # Records resampled at a time (10 s at 60 Hz)
+
+# Main class
+class IbtReader:
+
+    # Initialize reader, path: .ibt file
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.map) < DISK_HEADER_OFFSET + struct.calcsize(DISK_HEADER_FORMAT):
+            self.close()
+            raise ValueError("Error in IbtReader(): " + path + " is too short for an .ibt header")
+
+        (self.version, status, self.tickRate, infoUpdate, self.infoLength, self.infoOffset,
+            numVars, varHeaderOffset, numBuf, self.recordSize, pad0, pad1) = struct.unpack_from(HEADER_FORMAT, self.map, 0)
+        tickCount, self.recordOffset, pad0, pad1 = struct.unpack_from(VAR_BUF_FORMAT, self.map, VAR_BUF_OFFSET)
+        (self.startDate, self.startTime, self.endTime,
+            self.lapCount, recordCount) = struct.unpack_from(DISK_HEADER_FORMAT, self.map, DISK_HEADER_OFFSET)
+
+        if self.tickRate <= 0 or self.recordSize <= 0:
+            self.close()
+            raise ValueError("Error in IbtReader(): " + path + " has no telemetry records")
+
+        # The record count is only written when iRacing closes the file
+        available = (len(self.map) - self.recordOffset) // self.recordSize
+        self.records = min(recordCount, available) if recordCount > 0 else available
+
+        # name: (type, offset, count, unit, description)
+        self.vars = {}
+        for i in range(numVars):
+            varType, offset, count, countAsTime, name, desc, unit = struct.unpack_from(
+                VAR_HEADER_FORMAT, self.map, varHeaderOffset + i * VAR_HEADER_SIZE)
+            self.vars[cString(name)] = (varType, offset, count, cString(unit), cString(desc))
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Session info YAML (track, car, drivers)
+    def sessionInfo(self):
+        return cString(self.map[self.infoOffset:self.infoOffset + self.infoLength])
+
+    """
+    One channel of records first to end
+
+    name: variable name, only its first element is read for arrays
+    Returns an array (a NumPy array when NumPy is installed) of the
+    variable's type.
+    """
+    def channel(self, name, first=0, end=None):
+        if name not in self.vars:
+            raise KeyError("Error in channel(): no variable " + name + " in " + self.path)
+        varType, offset, count, unit, desc = self.vars[name]
+        typecode = VAR_TYPES[varType]
+        if end is None or end > self.records:
+            end = self.records
+        count = max(0, end - first)
+        start = self.recordOffset + first * self.recordSize + offset
+
+        if numpy is not None:
+            view = numpy.ndarray((count,), dtype="<" + typecode, buffer=self.map, offset=start, strides=(self.recordSize,))
+            return view.copy()
+
+        # Gather byte k of every record with one strided slice each
+        width = struct.calcsize(typecode)
+        data = bytearray(count * width)
+        stop = start + count * self.recordSize
+        for k in range(width):
+            data[k::width] = self.map[start + k:stop:self.recordSize]
+        values = array(typecode if typecode not in "c?" else "B")
+        values.frombytes(data)
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values
+
+    # Whether the file has a variable
+    def has(self, name):
+        return name in self.vars
+
+    """
+    Laps of the session
+
+    Returns (lap, first, end) record ranges, taken from the Lap
+    channel. Records before the first lap (in the pits) belong to none.
+    """
+    def laps(self):
+        if not self.has(LAP):
+            return []
+        laps = self.channel(LAP)
+        ranges = []
+        first = 0
+        for i in range(1, len(laps) + 1):
+            if i == len(laps) or laps[i] != laps[first]:
+                if laps[first] > 0:
+                    ranges.append((int(laps[first]), first, i))
+                first = i
+        return ranges
+
+
+# Zero terminated bytes to str
+def cString(data):
+    return bytes(data).split(b"\0", 1)[0].decode("latin-1")
+
+# Values times scale, rounded and clamped to int16
+def toRaw(values, scale):
+    if numpy is not None:
+        return numpy.clip(numpy.rint(numpy.asarray(values) * scale), -32768, 32767).astype("<i2")
+    return array("h", [min(32767, max(-32768, round(value * scale))) for value in values])
+
+"""
+Resample channels linearly from inRate to outRate
+
+channels: records first to end + 1 (one past end for the last interval)
+first: record index of channels[*][0]
+Returns the resampled channels at the output samples j with
+first <= j * inRate / outRate < end. The time base is the same for
+every call, so consecutive ranges join without a gap or a repeat.
+"""
+def resample(channels, inRate, outRate, first, end):
+    j = -(-first * outRate // inRate)
+    stop = -(-end * outRate // inRate)
+    last = len(channels[0]) - 1
+    if stop <= j or last < 0:
+        return [[] for channel in channels]
+
+    if numpy is not None:
+        positions = numpy.arange(j, stop) * (inRate / outRate) - first
+        records = numpy.arange(last + 1)
+        return [numpy.interp(positions, records, channel) for channel in channels]
+
+    # Shared record index and weight of each output sample
+    step = inRate / outRate
+    indices = []
+    weights = []
+    for k in range(j, stop):
+        # Held at the last record at the end of the file, as numpy.interp()
+        position = min(k * step - first, last)
+        i = min(int(position), last - 1) if last > 0 else 0
+        indices.append(i)
+        weights.append(position - i)
+
+    if last == 0:
+        return [[channel[0]] * len(indices) for channel in channels]
+    resampled = []
+    for channel in channels:
+        resampled.append([channel[i] + (channel[i + 1] - channel[i]) * w for i, w in zip(indices, weights)])
+    return resampled
+
+"""
+Raw IMU channels of records first to end, chunk by chunk
+
+rateHz: output rate (the monitor's poll rate)
+latSign: -1 when ax positive is right on the board
+Yields [ax, ay, az, gx, gy, gz] int16 arrays per chunk, in LSB.
+gx is the pitch rate (about the lateral axis), gy the roll rate;
+both are used when the file has them, else 0.
+"""
+def rawChunks(reader, rateHz=1000, first=0, end=None, latSign=1, chunkRecords=CHUNK_RECORDS):
+    if end is None or end > reader.records:
+        end = reader.records
+    accelScale = ACCEL_LSB_PER_G / STANDARD_GRAVITY
+    gyroScale = GYRO_LSB_PER_DPS * DEG_PER_RAD
+    names = (LAT_ACCEL, LONG_ACCEL, VERT_ACCEL, PITCH_RATE, ROLL_RATE, YAW_RATE)
+    scales = (latSign * accelScale, accelScale, accelScale, latSign * gyroScale, gyroScale, gyroScale)
+    for name in names[:3] + names[5:]:
+        if not reader.has(name):
+            raise KeyError("Error in rawChunks(): no variable " + name + " in " + reader.path)
+
+    for start in range(first, end, chunkRecords):
+        stop = min(start + chunkRecords, end)
+        # One record past the chunk for the last interval
+        picked = [(i, reader.channel(name, start, stop + 1)) for i, name in enumerate(names) if reader.has(name)]
+        resampled = resample([channel for i, channel in picked], reader.tickRate, rateHz, start, stop)
+        if not len(resampled[0]):
+            continue
+
+        raw = [None] * len(names)
+        for (i, channel), values in zip(picked, resampled):
+            raw[i] = toRaw(values, scales[i])
+        for i in range(len(names)):
+            if raw[i] is None:
+                raw[i] = array("h", bytes(2 * len(resampled[0])))
+        yield raw
+
+# Register bursts of records first to end, chunk by chunk (for Simulator.replay())
+def bursts(reader, rateHz=1000, first=0, end=None, latSign=1):
+    from Simulator import packBursts
+
+    for ax, ay, az, gx, gy, gz in rawChunks(reader, rateHz, first, end, latSign):
+        yield packBursts((ax, ay, az, gx, gy, gz, TEMP_RAW))
+
+"""
+Add the records first to end as one session to a session store
+
+store: SessionStore opened for appending
+Every sim lap in the range becomes a lap of the session, the time
+column counts from the first record. Returns the session number.
+"""
+def toStore(store, reader, rateHz=1000, first=0, end=None, latSign=1):
+    if end is None or end > reader.records:
+        end = reader.records
+
+    # Split the range at the lap boundaries
+    ranges = []
+    position = first
+    for lap, lapFirst, lapEnd in reader.laps():
+        lapFirst, lapEnd = max(lapFirst, first), min(lapEnd, end)
+        if lapFirst >= lapEnd:
+            continue
+        if lapFirst > position:
+            ranges.append((False, position, lapFirst))
+        ranges.append((True, lapFirst, lapEnd))
+        position = lapEnd
+    if position < end:
+        ranges.append((False, position, end))
+
+    number = store.beginSession(rateHz)
+    row = 0
+    for isLap, rangeFirst, rangeEnd in ranges:
+        if isLap:
+            store.markLap()
+        else:
+            store.endLap()
+        for raw in rawChunks(reader, rateHz, rangeFirst, rangeEnd, latSign):
+            count = len(raw[0])
+            times = array("I", [(row + k) * 1000 // rateHz for k in range(count)])
+            columns = [times] + raw
+            if sys.byteorder != "little":
+                # NumPy columns are little endian already
+                for column in columns:
+                    if isinstance(column, array):
+                        column.byteswap()
+            columns += [bytes(2 * count)] * 3 + [bytes(count)] * 2 # No magnetometer, mode and flags 0
+            store.appendColumns(columns)
+            row += count
+    store.endSession()
+    return number
+
+# Print the header, the channels used and the laps of a file
+def printInfo(reader):
+    print("\n%s" % reader.path)
+    print("=======================================")
+    print("Version %d, %d Hz, %d records of %d bytes (%.1f s), %d variables" % (reader.version, reader.tickRate,
+        reader.records, reader.recordSize, reader.records / reader.tickRate, len(reader.vars)))
+    for name in (LONG_ACCEL, LAT_ACCEL, VERT_ACCEL, YAW_RATE, ROLL_RATE, PITCH_RATE, LAP):
+        if reader.has(name):
+            varType, offset, count, unit, desc = reader.vars[name]
+            print("  %-10s %-6s %s" % (name, unit, desc))
+        else:
+            print("  %-10s missing" % name)
+    for lap, first, end in reader.laps():
+        print("  Lap %3d: records %7d - %7d (%.1f s)" % (lap, first, end, (end - first) / reader.tickRate))
+
+def main():
+    parser = argparse.ArgumentParser(description="Import iRacing telemetry (.ibt) for GMonitor")
+    parser.add_argument("file", help=".ibt telemetry file")
+    parser.add_argument("-r", "--rate", type=int, default=1000, help="sample rate in Hz (default 1000)")
+    parser.add_argument("-l", "--lap", type=int, help="only this lap")
+    parser.add_argument("-f", "--flip", action="store_true", help="board mounted with ax positive = right")
+    parser.add_argument("-s", "--store", help="add the session to this session store")
+    parser.add_argument("-m", "--mode", help="ride mode for the replay")
+    parser.add_argument("--replay", action="store_true", help="replay through GMonitor (Simulator.py)")
+    args = parser.parse_args()
+
+    with IbtReader(args.file) as reader:
+        first, end = 0, reader.records
+        if args.lap is not None:
+            ranges = [lap for lap in reader.laps() if lap[0] == args.lap]
+            if not ranges:
+                parser.error("no lap " + str(args.lap))
+            first, end = ranges[0][1], ranges[0][2]
+        latSign = -1 if args.flip else 1
+
+        if args.store is not None:
+            from SessionStore import SessionStore
+
+            with SessionStore(args.store, "a") as store:
+                number = toStore(store, reader, args.rate, first, end, latSign)
+            print("Added session %d to %s" % (number, args.store))
+        elif args.replay:
+            from Simulator import replay
+
+            commands = [(0, "set mode " + args.mode)] if args.mode else []
+            replay(bursts(reader, args.rate, first, end, latSign), args.rate, commands)
+        else:
+            printInfo(reader)
+
+if __name__ == "__main__":
+    main()
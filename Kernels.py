@@ -0,0 +1,581 @@
+"""
+This file contains the compiled hot-path kernels of GMonitor.
+
+The per-sample work that runs at the poll rate is factored into
+small type-annotated functions that MicroPython compiles to machine
+code:
+
+    decodeBurst     14 byte accel/gyro/temp burst to signed raw values
+                    (@micropython.viper)
+    classifyFrame   LED frame code lookup of Classifier.py
+                    (@micropython.viper)
+    ahrsUpdate      Mahony AHRS quaternion update of icm20948.py
+                    (@micropython.native, viper has no float support)
+    frameChecksum   Fletcher-16 of a telemetry frame (Telemetry.py)
+                    (@micropython.viper, CRC32 would allocate a long int)
+    fftButterflies  A budget of radix-2 butterflies of the fixed-point
+                    FFT of VibrationAnalyzer.py (@micropython.viper)
+
+Each kernel has a pure-Python reference version with identical
+results (the *Py functions), which is what runs on CPython. Run this
+file to check that both versions agree bit for bit and to time them.
+
+kward
+"""
+from array import array
+import struct
+import math
+
+try:
+    import micropython
+    from micropython import const
+except ImportError:
+    micropython = None
+
+    def const(x):
+        return x
+
+# Burst layout: ax, ay, az, gx, gy, gz, temp (big endian int16)
+BURST_VALUES = const(7)
+
+# Frame table grid, must match Classifier.py (checked by main())
+_GRID_BITS = const(6)
+_GRID_MAX = const(63)
+_GRID_SHIFT = const(10)
+_GRID_OFFSET = const(32768)
+
+# Fixed-point fraction bits of the FFT twiddles, must match VibrationAnalyzer.py (checked by main())
+_FFT_Q = const(14)
+
+# FFT progress array (viper functions take at most 4 arguments)
+FFT_N = const(0) # Window length
+FFT_SIZE = const(1) # Butterfly size of the current stage
+FFT_START = const(2) # First index of the current butterfly group
+FFT_K = const(3) # Butterfly within the group
+FFT_OPS = const(4) # Butterflies per call
+FFT_STRIDE = const(5) # Twiddle stride of the current stage (n / size)
+FFT_STATE_LEN = const(6)
+
+"""
+Decode a burst read into raw values (reference version)
+
+buf: 14 byte burst from ACCEL_XOUT_H
+raw: int32 array of 7, receives ax, ay, az, gx, gy, gz, temp
+offset: int32 array of the 3 gyro offsets
+"""
+def decodeBurstPy(buf, raw, offset):
+    for i in range(BURST_VALUES):
+        v = (buf[2 * i] << 8) | buf[2 * i + 1]
+        v -= (v & 0x8000) << 1
+        if i >= 3 and i < 6:
+            v -= offset[i - 3]
+        raw[i] = v
+
+# Frame code of a raw sample from a Classifier.py table (reference version)
+def classifyFramePy(table, ax, ay):
+    col = (ax + _GRID_OFFSET) >> _GRID_SHIFT
+    if col < 0:
+        col = 0
+    elif col > _GRID_MAX:
+        col = _GRID_MAX
+
+    row = (ay + _GRID_OFFSET) >> _GRID_SHIFT
+    if row < 0:
+        row = 0
+    elif row > _GRID_MAX:
+        row = _GRID_MAX
+
+    return table[(row << _GRID_BITS) + col]
+
+"""
+One Mahony AHRS step (reference version)
+
+q: float array of the quaternion q0, q1, q2, q3, updated in place
+gx, gy, gz: angular rate (rad/s)
+ax, ay, az: acceleration (any unit)
+mx, my, mz: magnetic field (any unit)
+kp, ki: proportional and integral gain
+halfT: half the sample period (s)
+"""
+def ahrsUpdatePy(q, gx, gy, gz, ax, ay, az, mx, my, mz, kp, ki, halfT):
+    q0 = q[0]
+    q1 = q[1]
+    q2 = q[2]
+    q3 = q[3]
+
+    q0q0 = q0 * q0
+    q0q1 = q0 * q1
+    q0q2 = q0 * q2
+    q0q3 = q0 * q3
+    q1q1 = q1 * q1
+    q1q2 = q1 * q2
+    q1q3 = q1 * q3
+    q2q2 = q2 * q2
+    q2q3 = q2 * q3
+    q3q3 = q3 * q3
+
+    norm = 1 / math.sqrt(ax * ax + ay * ay + az * az)
+    ax = ax * norm
+    ay = ay * norm
+    az = az * norm
+
+    norm = 1 / math.sqrt(mx * mx + my * my + mz * mz)
+    mx = mx * norm
+    my = my * norm
+    mz = mz * norm
+
+    # Reference direction of flux
+    hx = 2 * mx * (0.5 - q2q2 - q3q3) + 2 * my * (q1q2 - q0q3) + 2 * mz * (q1q3 + q0q2)
+    hy = 2 * mx * (q1q2 + q0q3) + 2 * my * (0.5 - q1q1 - q3q3) + 2 * mz * (q2q3 - q0q1)
+    hz = 2 * mx * (q1q3 - q0q2) + 2 * my * (q2q3 + q0q1) + 2 * mz * (0.5 - q1q1 - q2q2)
+    bx = math.sqrt((hx * hx) + (hy * hy))
+    bz = hz
+
+    # Estimated direction of gravity and flux
+    vx = 2 * (q1q3 - q0q2)
+    vy = 2 * (q0q1 + q2q3)
+    vz = q0q0 - q1q1 - q2q2 + q3q3
+    wx = 2 * bx * (0.5 - q2q2 - q3q3) + 2 * bz * (q1q3 - q0q2)
+    wy = 2 * bx * (q1q2 - q0q3) + 2 * bz * (q0q1 + q2q3)
+    wz = 2 * bx * (q0q2 + q1q3) + 2 * bz * (0.5 - q1q1 - q2q2)
+
+    # Error is the cross product between measured and estimated directions
+    ex = (ay * vz - az * vy) + (my * wz - mz * wy)
+    ey = (az * vx - ax * vz) + (mz * wx - mx * wz)
+    ez = (ax * vy - ay * vx) + (mx * wy - my * wx)
+
+    if ex != 0.0 and ey != 0.0 and ez != 0.0:
+        gx = gx + kp * ex + ex * ki * halfT
+        gy = gy + kp * ey + ey * ki * halfT
+        gz = gz + kp * ez + ez * ki * halfT
+
+    q0 = q0 + (-q1 * gx - q2 * gy - q3 * gz) * halfT
+    q1 = q1 + (q0 * gx + q2 * gz - q3 * gy) * halfT
+    q2 = q2 + (q0 * gy - q1 * gz + q3 * gx) * halfT
+    q3 = q3 + (q0 * gz + q1 * gy - q2 * gx) * halfT
+
+    norm = 1 / math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+    q[0] = q0 * norm
+    q[1] = q1 * norm
+    q[2] = q2 * norm
+    q[3] = q3 * norm
+
+"""
+Fletcher-16 checksum of buf[start:end] (reference version)
+
+The sums are only reduced at the end, so the running sums never
+leave the small int range for frames of up to 4 KB.
+"""
+def frameChecksumPy(buf, start, end):
+    sum1 = 0
+    sum2 = 0
+    for i in range(start, end):
+        sum1 += buf[i]
+        sum2 += sum1
+    return ((sum2 % 255) << 8) | (sum1 % 255)
+
+"""
+Run up to state[FFT_OPS] butterflies of an in-place radix-2 FFT (reference version)
+
+re, im: int32 arrays of the bit-reversed window, transformed in place
+twiddle: int32 array of cos, sin pairs (Q14) of the n/2 twiddle angles
+state: int32 progress array (FFT_* fields), updated in place
+Every stage scales by 1/2. Returns 1 once the last stage completed.
+"""
+def fftButterfliesPy(re, im, twiddle, state):
+    n = state[FFT_N]
+    size = state[FFT_SIZE]
+    start = state[FFT_START]
+    k = state[FFT_K]
+    stride = state[FFT_STRIDE]
+    half = size >> 1
+
+    ops = state[FFT_OPS]
+    while ops > 0:
+        i = start + k
+        j = i + half
+        w = (k * stride) << 1
+        c = twiddle[w]
+        s = twiddle[w + 1]
+
+        # Twiddle e^(-j*2*pi*w/n) = cos - j*sin
+        tr = (c * re[j] + s * im[j]) >> _FFT_Q
+        ti = (c * im[j] - s * re[j]) >> _FFT_Q
+
+        xr = re[i]
+        xi = im[i]
+        re[j] = (xr - tr) >> 1
+        im[j] = (xi - ti) >> 1
+        re[i] = (xr + tr) >> 1
+        im[i] = (xi + ti) >> 1
+
+        ops -= 1
+        k += 1
+        if k == half:
+            k = 0
+            start += size
+            if start >= n:
+                # Next stage
+                start = 0
+                size <<= 1
+                stride >>= 1
+                if size > n:
+                    state[FFT_SIZE] = size
+                    state[FFT_START] = 0
+                    state[FFT_K] = 0
+                    return 1
+                half = size >> 1
+
+    state[FFT_SIZE] = size
+    state[FFT_START] = start
+    state[FFT_K] = k
+    state[FFT_STRIDE] = stride
+    return 0
+
+
+if micropython is not None:
+
+    @micropython.viper
+    def decodeBurst(buf: ptr8, raw: ptr32, offset: ptr32):
+        i = 0
+        while i < BURST_VALUES:
+            v = (buf[2 * i] << 8) | buf[2 * i + 1]
+            v -= (v & 0x8000) << 1
+            if i >= 3:
+                if i < 6:
+                    v -= offset[i - 3]
+            raw[i] = v
+            i += 1
+
+    @micropython.viper
+    def classifyFrame(table: ptr32, ax: int, ay: int) -> int:
+        col = (ax + _GRID_OFFSET) >> _GRID_SHIFT
+        if col < 0:
+            col = 0
+        elif col > _GRID_MAX:
+            col = _GRID_MAX
+
+        row = (ay + _GRID_OFFSET) >> _GRID_SHIFT
+        if row < 0:
+            row = 0
+        elif row > _GRID_MAX:
+            row = _GRID_MAX
+
+        return table[(row << _GRID_BITS) + col]
+
+    @micropython.native
+    def ahrsUpdate(q, gx, gy, gz, ax, ay, az, mx, my, mz, kp, ki, halfT):
+        q0 = q[0]
+        q1 = q[1]
+        q2 = q[2]
+        q3 = q[3]
+
+        q0q0 = q0 * q0
+        q0q1 = q0 * q1
+        q0q2 = q0 * q2
+        q0q3 = q0 * q3
+        q1q1 = q1 * q1
+        q1q2 = q1 * q2
+        q1q3 = q1 * q3
+        q2q2 = q2 * q2
+        q2q3 = q2 * q3
+        q3q3 = q3 * q3
+
+        norm = 1 / math.sqrt(ax * ax + ay * ay + az * az)
+        ax = ax * norm
+        ay = ay * norm
+        az = az * norm
+
+        norm = 1 / math.sqrt(mx * mx + my * my + mz * mz)
+        mx = mx * norm
+        my = my * norm
+        mz = mz * norm
+
+        hx = 2 * mx * (0.5 - q2q2 - q3q3) + 2 * my * (q1q2 - q0q3) + 2 * mz * (q1q3 + q0q2)
+        hy = 2 * mx * (q1q2 + q0q3) + 2 * my * (0.5 - q1q1 - q3q3) + 2 * mz * (q2q3 - q0q1)
+        hz = 2 * mx * (q1q3 - q0q2) + 2 * my * (q2q3 + q0q1) + 2 * mz * (0.5 - q1q1 - q2q2)
+        bx = math.sqrt((hx * hx) + (hy * hy))
+        bz = hz
+
+        vx = 2 * (q1q3 - q0q2)
+        vy = 2 * (q0q1 + q2q3)
+        vz = q0q0 - q1q1 - q2q2 + q3q3
+        wx = 2 * bx * (0.5 - q2q2 - q3q3) + 2 * bz * (q1q3 - q0q2)
+        wy = 2 * bx * (q1q2 - q0q3) + 2 * bz * (q0q1 + q2q3)
+        wz = 2 * bx * (q0q2 + q1q3) + 2 * bz * (0.5 - q1q1 - q2q2)
+
+        ex = (ay * vz - az * vy) + (my * wz - mz * wy)
+        ey = (az * vx - ax * vz) + (mz * wx - mx * wz)
+        ez = (ax * vy - ay * vx) + (mx * wy - my * wx)
+
+        if ex != 0.0 and ey != 0.0 and ez != 0.0:
+            gx = gx + kp * ex + ex * ki * halfT
+            gy = gy + kp * ey + ey * ki * halfT
+            gz = gz + kp * ez + ez * ki * halfT
+
+        q0 = q0 + (-q1 * gx - q2 * gy - q3 * gz) * halfT
+        q1 = q1 + (q0 * gx + q2 * gz - q3 * gy) * halfT
+        q2 = q2 + (q0 * gy - q1 * gz + q3 * gx) * halfT
+        q3 = q3 + (q0 * gz + q1 * gy - q2 * gx) * halfT
+
+        norm = 1 / math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        q[0] = q0 * norm
+        q[1] = q1 * norm
+        q[2] = q2 * norm
+        q[3] = q3 * norm
+
+    @micropython.viper
+    def frameChecksum(buf: ptr8, start: int, end: int) -> int:
+        sum1 = 0
+        sum2 = 0
+        i = start
+        while i < end:
+            sum1 += buf[i]
+            sum2 += sum1
+            i += 1
+        return ((sum2 % 255) << 8) | (sum1 % 255)
+
+    @micropython.viper
+    def fftButterflies(re: ptr32, im: ptr32, twiddle: ptr32, state: ptr32) -> int:
+        n = state[FFT_N]
+        size = state[FFT_SIZE]
+        start = state[FFT_START]
+        k = state[FFT_K]
+        stride = state[FFT_STRIDE]
+        half = size >> 1
+
+        ops = state[FFT_OPS]
+        while ops > 0:
+            i = start + k
+            j = i + half
+            w = (k * stride) << 1
+            c = twiddle[w]
+            s = twiddle[w + 1]
+
+            tr = (c * re[j] + s * im[j]) >> _FFT_Q
+            ti = (c * im[j] - s * re[j]) >> _FFT_Q
+
+            xr = re[i]
+            xi = im[i]
+            re[j] = (xr - tr) >> 1
+            im[j] = (xi - ti) >> 1
+            re[i] = (xr + tr) >> 1
+            im[i] = (xi + ti) >> 1
+
+            ops -= 1
+            k += 1
+            if k == half:
+                k = 0
+                start += size
+                if start >= n:
+                    start = 0
+                    size <<= 1
+                    stride >>= 1
+                    if size > n:
+                        state[FFT_SIZE] = size
+                        state[FFT_START] = 0
+                        state[FFT_K] = 0
+                        return 1
+                    half = size >> 1
+
+        state[FFT_SIZE] = size
+        state[FFT_START] = start
+        state[FFT_K] = k
+        state[FFT_STRIDE] = stride
+        return 0
+
+else:
+    decodeBurst = decodeBurstPy
+    classifyFrame = classifyFramePy
+    ahrsUpdate = ahrsUpdatePy
+    frameChecksum = frameChecksumPy
+    fftButterflies = fftButterfliesPy
+
+
+"""
+Conformance check and benchmark
+
+Every kernel is run against its reference version (and the decoder
+against struct) on the same pseudo-random inputs, and the outputs
+must match bit for bit.
+"""
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    # CPython fallback for running on a host
+    from time import perf_counter
+
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+# Small xorshift generator, same sequence on every interpreter
+class XorShift:
+    def __init__(self, seed=0x2545F491):
+        self.state = seed
+
+    def next(self):
+        x = self.state
+        x ^= (x << 13) & 0xFFFFFFFF
+        x ^= x >> 17
+        x ^= (x << 5) & 0xFFFFFFFF
+        self.state = x
+        return x
+
+# Time count calls of fn(*args) in us per call
+def timeCalls(fn, args, count=1000):
+    start = ticks_us()
+    for i in range(count):
+        fn(*args)
+    return ticks_diff(ticks_us(), start) / count
+
+# Twiddle table and progress array of an n point FFT with ops butterflies per call
+def fftSetup(n, ops):
+    twiddle = array('i', [0] * n)
+    for k in range(n >> 1):
+        twiddle[2 * k] = int(round(math.cos(2 * math.pi * k / n) * (1 << _FFT_Q)))
+        twiddle[2 * k + 1] = int(round(math.sin(2 * math.pi * k / n) * (1 << _FFT_Q)))
+    state = array('i', [0] * FFT_STATE_LEN)
+    state[FFT_N] = n
+    state[FFT_OPS] = ops
+    return twiddle, state
+
+# Restart a progress array at the first stage
+def fftRestart(state):
+    state[FFT_SIZE] = 2
+    state[FFT_START] = 0
+    state[FFT_K] = 0
+    state[FFT_STRIDE] = state[FFT_N] >> 1
+
+def main():
+    from Classifier import FrameClassifier, GRID_BITS, GRID_SHIFT, GRID_OFFSET
+    from VibrationAnalyzer import Q
+
+    rng = XorShift()
+    failures = 0
+
+    print("\nGMonitor kernel conformance")
+    print("=======================================")
+    print("Compiled kernels: " + ("yes" if micropython is not None else "no (CPython, reference only)"))
+
+    # Table constants must match the classifier
+    if (_GRID_BITS, _GRID_SHIFT, _GRID_OFFSET) != (GRID_BITS, GRID_SHIFT, GRID_OFFSET):
+        print("classifyFrame: grid constants differ from Classifier.py FAIL")
+        failures += 1
+    if _FFT_Q != Q:
+        print("fftButterflies: fixed-point bits differ from VibrationAnalyzer.py FAIL")
+        failures += 1
+
+    # Decoder against struct and the reference version
+    buf = bytearray(2 * BURST_VALUES)
+    raw = array('i', [0] * BURST_VALUES)
+    ref = array('i', [0] * BURST_VALUES)
+    offset = array('i', [12, -7, 300])
+    bad = 0
+    for n in range(2000):
+        for i in range(len(buf)):
+            buf[i] = rng.next() & 0xFF
+        decodeBurst(buf, raw, offset)
+        decodeBurstPy(buf, ref, offset)
+        expected = list(struct.unpack(">7h", buf))
+        for i in range(3):
+            expected[3 + i] -= offset[i]
+        if raw != ref or list(raw) != expected:
+            bad += 1
+    print("decodeBurst: %d mismatches in 2000 bursts %s" % (bad, "ok" if bad == 0 else "FAIL"))
+    failures += bad
+
+    # Frame lookup, including samples beyond the table range
+    classifier = FrameClassifier(8)
+    classifier.build(0.3, 0.6, 0.25, 14000)
+    table = classifier.table
+    bad = 0
+    for n in range(5000):
+        ax = (rng.next() & 0x1FFFF) - 65536
+        ay = (rng.next() & 0x1FFFF) - 65536
+        if classifyFrame(table, ax, ay) != classifyFramePy(table, ax, ay):
+            bad += 1
+    print("classifyFrame: %d mismatches in 5000 samples %s" % (bad, "ok" if bad == 0 else "FAIL"))
+    failures += bad
+
+    # AHRS, quaternion compared as raw float bytes after every step
+    q = array('f', [1.0, 0.0, 0.0, 0.0])
+    qRef = array('f', [1.0, 0.0, 0.0, 0.0])
+    bad = 0
+    for n in range(500):
+        v = [((rng.next() & 0xFFFF) - 32768) / 32768 for i in range(9)]
+        v[5] += 1.0 # Keep gravity and the magnetic field away from zero
+        v[6] += 1.0
+        ahrsUpdate(q, v[0], v[1], v[2], v[3], v[4], v[5], v[6], v[7], v[8], 4.5, 1.0, 0.0005)
+        ahrsUpdatePy(qRef, v[0], v[1], v[2], v[3], v[4], v[5], v[6], v[7], v[8], 4.5, 1.0, 0.0005)
+        if bytes(q) != bytes(qRef):
+            bad += 1
+    print("ahrsUpdate: %d mismatches in 500 steps %s" % (bad, "ok" if bad == 0 else "FAIL"))
+    failures += bad
+
+    # Checksum against the textbook Fletcher-16 (reduced every byte)
+    frame = bytearray(64)
+    bad = 0
+    for n in range(1000):
+        for i in range(len(frame)):
+            frame[i] = rng.next() & 0xFF
+        start = rng.next() & 15
+        end = 32 + (rng.next() & 31)
+        sum1 = 0
+        sum2 = 0
+        for i in range(start, end):
+            sum1 = (sum1 + frame[i]) % 255
+            sum2 = (sum2 + sum1) % 255
+        expected = (sum2 << 8) | sum1
+        if frameChecksum(frame, start, end) != expected or frameChecksumPy(frame, start, end) != expected:
+            bad += 1
+    print("frameChecksum: %d mismatches in 1000 frames %s" % (bad, "ok" if bad == 0 else "FAIL"))
+    failures += bad
+
+    # FFT of random windows, compared after every call (uneven budget crosses stage boundaries)
+    n = 256
+    twiddle, state = fftSetup(n, 37)
+    stateRef = array('i', state)
+    re = array('i', [0] * n)
+    im = array('i', [0] * n)
+    bad = 0
+    for window in range(20):
+        for i in range(n):
+            re[i] = (rng.next() & 0x7FFF) - 16384
+            im[i] = 0
+        reRef = array('i', re)
+        imRef = array('i', im)
+        fftRestart(state)
+        fftRestart(stateRef)
+        done = 0
+        while not done:
+            done = fftButterflies(re, im, twiddle, state)
+            if done != fftButterfliesPy(reRef, imRef, twiddle, stateRef) or re != reRef or im != imRef or state != stateRef:
+                bad += 1
+                break
+    print("fftButterflies: %d mismatches in 20 windows %s" % (bad, "ok" if bad == 0 else "FAIL"))
+    failures += bad
+
+    # Throughput
+    print("\nus per call (compiled / reference):")
+    print("decodeBurst: %.1f / %.1f" % (timeCalls(decodeBurst, (buf, raw, offset)), timeCalls(decodeBurstPy, (buf, raw, offset))))
+    print("classifyFrame: %.1f / %.1f" % (timeCalls(classifyFrame, (table, 1234, -5678)), timeCalls(classifyFramePy, (table, 1234, -5678))))
+    args = (q, 0.01, 0.02, 0.03, 0.1, 0.2, 0.97, 0.3, 0.1, 0.5, 4.5, 1.0, 0.0005)
+    print("ahrsUpdate: %.1f / %.1f" % (timeCalls(ahrsUpdate, args, 200), timeCalls(ahrsUpdatePy, args, 200)))
+    print("frameChecksum: %.1f / %.1f" % (timeCalls(frameChecksum, (frame, 2, 27)), timeCalls(frameChecksumPy, (frame, 2, 27))))
+
+    # 64 butterflies per call, restarted before the transform completes
+    state[FFT_OPS] = 64
+    stateRef[FFT_OPS] = 64
+    fftRestart(state)
+    fftRestart(stateRef)
+    print("fftButterflies (64): %.1f / %.1f" % (timeCalls(fftButterflies, (re, im, twiddle, state), 10),
+        timeCalls(fftButterfliesPy, (reRef, imRef, twiddle, stateRef), 10)))
+
+    if failures > 0:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
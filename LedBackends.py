@@ -0,0 +1,249 @@
+"""
+This file contains the LED bar-graph output backends for GMonitor.
+
+The display is four bars (left, right, up/braking, down/forward)
+of N LEDs each. Every frame the levels of all four bars and the slip
+warning are read from the lookup table of Classifier.py in one
+indexed read, and the LEDs are only written when the frame changes.
+A backend then shows the four levels:
+
+    GpioBar         The original nine LED "+" layout, one GPIO per LED
+    ShiftRegisterBar A chain of 74HC595 shift registers on SPI
+    NeoPixelBar     A WS2812 strip using the neopixel module
+
+The shift register and WS2812 backends precompute the bytes of
+every bar at every level, so a frame is four slice copies and one
+bulk transfer no matter how many LEDs are attached.
+
+kward
+"""
+from machine import Pin, SPI
+from Classifier import FrameClassifier, NUM_BARS, LEVEL_BITS, LEVEL_MASK, LAT_MASK, WARN_FLAG
+from Kernels import classifyFrame
+import time
+
+try:
+    import neopixel
+except ImportError:
+    neopixel = None
+
+# Warning blink half period (ms, power of 2)
+BLINK_MS = 64
+
+# Common frame classification for all backends
+class LedBar:
+
+    """
+    Initialize bar graph
+
+    ledsPerBar: number of LEDs in each of the four bars
+    """
+    def __init__(self, ledsPerBar):
+        self.n = ledsPerBar
+
+        # Frame code of every quantized (lateral, longitudinal) sample
+        self.classifier = FrameClassifier(ledsPerBar)
+        self.table = self.classifier.table
+
+        # Levels of the frame on the LEDs and its frame code (-1 forces the next frame out)
+        self.levels = bytearray(NUM_BARS)
+        self.shown = bytearray(b"\xff" * NUM_BARS)
+        self.shownCode = -1
+
+    """
+    Build the frame table for a ride mode
+
+    latTolerance, longTolF, longTolR: g per LED
+    warnLat: raw lateral acceleration of the slip warning
+    """
+    def build(self, latTolerance, longTolF, longTolR, warnLat):
+        self.classifier.build(latTolerance, longTolF, longTolR, warnLat)
+        self.shownCode = -1
+
+    # Move the slip warning (raw lateral acceleration) without rebuilding the frame table
+    def setWarning(self, warnLat):
+        self.classifier.setWarning(warnLat)
+        self.shownCode = -1
+
+    """
+    Update the display for one sample
+
+    ax: raw lateral acceleration (LSB, positive = left)
+    ay: raw longitudinal acceleration (LSB, positive = forward)
+    """
+    def render(self, ax, ay):
+        # Quantize and look up the whole frame (compiled kernel)
+        code = classifyFrame(self.table, ax, ay)
+
+        # Blink the lateral bar on a slip warning
+        if code >= WARN_FLAG and not time.ticks_ms() & BLINK_MS:
+            code &= ~LAT_MASK
+
+        if code != self.shownCode:
+            self.showCode(code)
+
+    # Unpack a frame code into bar levels and show it
+    def showCode(self, code):
+        levels = self.levels
+        for b in range(NUM_BARS):
+            levels[b] = (code >> (b * LEVEL_BITS)) & LEVEL_MASK
+
+        if levels != self.shown:
+            self.show(levels)
+            self.shown[:] = levels
+        self.shownCode = code
+
+    # Blink every bar (spin-out warning)
+    def renderSpin(self):
+        level = self.n if time.ticks_ms() & BLINK_MS else 0
+        for b in range(NUM_BARS):
+            self.levels[b] = level
+
+        if self.levels != self.shown:
+            self.show(self.levels)
+            self.shown[:] = self.levels
+        self.shownCode = -1
+
+    # Turn every LED off
+    def clear(self):
+        for b in range(NUM_BARS):
+            self.levels[b] = 0
+        self.show(self.levels)
+        self.shown[:] = self.levels
+        self.shownCode = -1
+
+    # Release hardware
+    def deinit(self):
+        self.clear()
+
+    # Show the levels of the four bars, overridden by each backend (the bare class has no LEDs and shows nothing)
+    def show(self, levels):
+        pass
+
+
+# Original "+" layout, one GPIO pin per LED
+class GpioBar(LedBar):
+
+    """
+    Initialize backend
+
+    lights: map of LED name to Pin
+    """
+    def __init__(self, lights):
+        LedBar.__init__(self, 2)
+
+        self.pins = (
+            (lights["1L"], lights["2L"]),
+            (lights["1R"], lights["2R"]),
+            (lights["1U"], lights["2U"]),
+            (lights["1D"], lights["2D"])
+        )
+
+    # Only bars whose level changed are written
+    def show(self, levels):
+        for b in range(NUM_BARS):
+            level = levels[b]
+            if level != self.shown[b]:
+                pins = self.pins[b]
+                pins[0].value(level >= 1)
+                pins[1].value(level >= 2)
+
+
+# Chain of 74HC595 shift registers
+class ShiftRegisterBar(LedBar):
+
+    """
+    Initialize backend
+
+    The chain holds the four bars in order (left, right, up, down),
+    each starting on a new register. Bytes are shifted out last
+    register first, LSB of each register = first LED of its bar.
+
+    ledsPerBar: LEDs in each bar
+    spiId, sck, mosi: SPI bus wired to SH_CP and DS
+    latch: GPIO wired to ST_CP
+    """
+    def __init__(self, ledsPerBar=8, spiId=0, sck=2, mosi=3, latch=5):
+        LedBar.__init__(self, ledsPerBar)
+
+        self.spi = SPI(spiId, baudrate=10000000, sck=Pin(sck), mosi=Pin(mosi))
+        self.latch = Pin(latch, Pin.OUT, value=0)
+
+        # Registers per bar and the frame buffer for the whole chain
+        self.barBytes = (ledsPerBar + 7) >> 3
+        self.buf = bytearray(NUM_BARS * self.barBytes)
+
+        # Bytes of one bar at every level (registers in shift-out order)
+        self.images = []
+        for level in range(ledsPerBar + 1):
+            image = bytearray(self.barBytes)
+            for i in range(level):
+                image[self.barBytes - 1 - (i >> 3)] |= 1 << (i & 7)
+            self.images.append(bytes(image))
+
+    # One slice copy per bar, one SPI transfer and a latch pulse
+    def show(self, levels):
+        buf = self.buf
+        size = self.barBytes
+        images = self.images
+
+        # Last bar is shifted out first
+        for b in range(NUM_BARS):
+            start = (NUM_BARS - 1 - b) * size
+            buf[start:start + size] = images[levels[b]]
+
+        self.spi.write(buf)
+        self.latch.value(1)
+        self.latch.value(0)
+
+    # Release hardware
+    def deinit(self):
+        self.clear()
+        self.spi.deinit()
+
+
+# WS2812 (NeoPixel) strip
+class NeoPixelBar(LedBar):
+
+    """
+    Initialize backend
+
+    The strip holds the four bars in order (left, right, up, down).
+    LEDs fade from green to red along each bar.
+
+    ledsPerBar: LEDs in each bar
+    pin: GPIO of the strip's data line
+    brightness: maximum channel value (0 - 255)
+    """
+    def __init__(self, ledsPerBar=8, pin=22, brightness=64):
+        if neopixel is None:
+            raise ValueError("neopixel module not available")
+
+        LedBar.__init__(self, ledsPerBar)
+
+        self.strip = neopixel.NeoPixel(Pin(pin), NUM_BARS * ledsPerBar)
+        self.barBytes = ledsPerBar * self.strip.bpp
+
+        # Bytes of one bar at every level, in the strip's colour order
+        order = self.strip.ORDER
+        self.images = []
+        for level in range(ledsPerBar + 1):
+            image = bytearray(self.barBytes)
+            for i in range(level):
+                frac = i / max(1, ledsPerBar - 1)
+                rgb = (int(brightness * frac), int(brightness * (1 - frac)), 0)
+                for c in range(3):
+                    image[i * self.strip.bpp + order[c]] = rgb[c]
+            self.images.append(bytes(image))
+
+    # One slice copy per bar and one strip write
+    def show(self, levels):
+        buf = self.strip.buf
+        size = self.barBytes
+        images = self.images
+
+        for b in range(NUM_BARS):
+            start = b * size
+            buf[start:start + size] = images[levels[b]]
+
+        self.strip.write()
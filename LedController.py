@@ -37,6 +37,16 @@ class LedController:
         self.red = Pin(rPin, Pin.OUT)
         self.green = Pin(gPin, Pin.OUT)
         self.blue = Pin(bPin, Pin.OUT)
+        
+        # Map of color names to display methods
+        self.colors = {
+            'red': self.solidRed,
+            'green': self.solidGreen,
+            'blue': self.solidBlue,
+            'purple': self.solidPurple,
+            'yellow': self.solidYellow,
+            'cyan': self.solidCyan
+            }
             
     """
     Display colors indefinetly
@@ -74,14 +84,7 @@ class LedController:
     
     # Run set of tests
     def test(self):
-        tests = {
-            'red': self.solidRed,
-            'green': self.solidGreen,
-            'blue': self.solidBlue,
-            'purple': self.solidPurple,
-            'yellow': self.solidYellow,
-            'cyan': self.solidCyan
-            }
+        tests = self.colors
         
         print("\n\nStarting RGB LED TESTS..\n\n")
         time.sleep(1)
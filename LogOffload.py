@@ -0,0 +1,384 @@
+"""
+This file offloads the logs of GMonitor automatically (run on a computer).
+
+Plugging a monitor into the laptop in the paddock is all it takes:
+
+    - A pyudev MonitorObserver watches for USB serial devices, and every
+      device rshell recognizes as a MicroPython board (Pico) is offloaded
+      in its own worker thread, so several cars can be plugged in at once
+    - The board is listed in one call: its unique id (each monitor gets
+      its own directory) and the size of every log segment
+    - Only new data is pulled. The local copy of a segment only ever holds
+      blocks that passed their CRC32, so its size is the offset to resume
+      from. Closed segments that are complete locally are skipped and the
+      open one is continued. All missing ranges are fetched in one call
+    - Sessions are numbered from 1 again once the logs on the board were
+      deleted, so a segment name can come back with a different recording.
+      A local copy is only continued if its header and first block header
+      match the board's segment. Otherwise the segment is fetched from the
+      start under the next free name (s0001_000.1.gml, ...)
+    - Updated segments are decoded to CSV in a background process pool
+
+Entering the raw REPL interrupts the monitor, so records still buffered
+in a partial block when the board is plugged in are not offloaded (stop
+the data logger first to flush them).
+
+Usage:
+    python LogOffload.py                      Watch for monitors, offload into offload/
+    python LogOffload.py -o DIR -j 4          Offload into DIR with 4 decoding processes
+    python LogOffload.py -p /dev/ttyACM0      Offload one monitor once and exit
+
+pyudev (Linux) is needed to watch for devices, rshell and pyserial for
+talking to the boards.
+
+kward
+"""
+import argparse
+import base64
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from DataLogger import LOG_DIR, HEADER_SIZE, BLOCK_HEADER_SIZE, parseHeader, readBlocks, decodeRecords
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+OUT_DIR = "offload"
+
+# Time for a board to boot before it is interrupted (s)
+SETTLE_S = 2
+
+# Bytes read per line of the fetch script (multiple of 3, so each line is whole base64)
+FETCH_CHUNK = 768
+
+CSV_HEADER = "time_ms,ax,ay,az,gx,gy,gz,mx,my,mz,mode,flags\n"
+
+# Bytes at the start of a segment that identify it (header and first block header)
+HEAD_SIZE = HEADER_SIZE + BLOCK_HEADER_SIZE
+
+# Prints the board's unique id and the name, size and first HEAD_SIZE bytes (hex) of every log segment
+LIST_SCRIPT = """
+import os
+import ubinascii
+try:
+    import machine
+    uid = ubinascii.hexlify(machine.unique_id()).decode()
+except Exception:
+    uid = "unknown"
+files = []
+try:
+    for name in os.listdir("%s"):
+        if name.endswith(".gml"):
+            with open("%s/" + name, "rb") as f:
+                head = f.read(%d)
+            files.append((name, os.stat("%s/" + name)[6], ubinascii.hexlify(head).decode()))
+except OSError:
+    pass
+print(repr((uid, files)))
+"""
+
+# Prints "@<name>" followed by the base64 lines of each segment from its offset
+FETCH_SCRIPT = """
+import ubinascii
+buf = bytearray(%d)
+view = memoryview(buf)
+for name, offset in %r:
+    print("@" + name)
+    with open("%s/" + name, "rb") as f:
+        f.seek(offset)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            print(ubinascii.b2a_base64(view[:n]).decode(), end="")
+"""
+
+# Run a script in the board's raw REPL, returns its output
+def execRaw(board, script, timeout=30):
+    board.exec_raw_no_follow(script)
+
+    # Read in bulk until both end markers (output and error) arrived
+    serial = board.serial
+    data = bytearray()
+    deadline = time.time() + timeout
+    while data.count(b"\x04") < 2:
+        chunk = serial.read(max(1, serial.in_waiting))
+        if chunk:
+            data += chunk
+            deadline = time.time() + timeout
+        elif time.time() > deadline:
+            raise RuntimeError("timeout waiting for the board")
+
+    output, error = bytes(data).split(b"\x04")[:2]
+    if error:
+        raise RuntimeError(error.decode(errors="replace").strip())
+    return output.decode()
+
+# Split the output of FETCH_SCRIPT into {name: bytes}
+def parseFetch(output):
+    segments = {}
+    name = None
+    lines = []
+    for line in output.splitlines():
+        if line.startswith("@"):
+            if name is not None:
+                segments[name] = base64.b64decode("".join(lines))
+            name = line[1:]
+            lines = []
+        elif line:
+            lines.append(line)
+    if name is not None:
+        segments[name] = base64.b64decode("".join(lines))
+    return segments
+
+"""
+Find the local copy of a board segment
+
+A local copy belongs to the segment if it is not longer than the
+segment and starts with the same header and first block header (as
+far as both have them). Segments written after the board's logs were
+deleted reuse old names, so on a mismatch the next name is tried:
+<name>.1.gml, <name>.2.gml, ...
+
+boardDir: local directory of the board
+name: segment name on the board
+size: segment size on the board
+head: first HEAD_SIZE bytes of the segment on the board
+Returns the path of the matching copy, or of a new one
+"""
+def localSegment(boardDir, name, size, head):
+    copy = 0
+    while True:
+        path = os.path.join(boardDir, name if copy == 0 else "%s.%d.gml" % (name[:-4], copy))
+        if not os.path.exists(path):
+            return path
+
+        with open(path, "rb") as f:
+            local = f.read(HEAD_SIZE)
+        common = min(len(local), len(head))
+        if os.path.getsize(path) <= size and local[:common] == head[:common]:
+            return path
+        copy += 1
+
+"""
+Append the new bytes of a segment to its local copy
+
+Only the header and complete blocks that pass their checksum are kept.
+Returns the number of bytes appended, raises ValueError (after keeping
+the blocks before it) if the header is invalid or a block is corrupt.
+"""
+def appendVerified(path, offset, data):
+    existing = b""
+    if offset > 0:
+        with open(path, "rb") as f:
+            existing = f.read()
+    combined = existing + data
+
+    if len(combined) < HEADER_SIZE:
+        return 0
+    if offset == 0:
+        parseHeader(combined)
+
+    end = max(offset, HEADER_SIZE)
+    error = None
+    try:
+        for nextOffset, records in readBlocks(combined, end):
+            end = nextOffset
+    except ValueError as e:
+        error = e
+
+    with open(path, "ab") as f:
+        f.write(combined[offset:end])
+
+    if error is not None:
+        raise error
+    return end - offset
+
+# Decode a local segment to CSV next to it (runs in a worker process), returns (path, records)
+def decodeSegment(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    parseHeader(data)
+
+    records = 0
+    with open(path[:-4] + ".csv", "w") as out:
+        out.write(CSV_HEADER)
+        for offset, block in readBlocks(data):
+            for record in decodeRecords(block):
+                out.write(",".join(str(value) for value in record) + "\n")
+                records += 1
+    return path, records
+
+"""
+Pull the new log data of the board on port into outDir/<board id>
+
+Returns (board id, paths of the updated segments, errors)
+"""
+def offloadBoard(port, outDir=OUT_DIR):
+    from rshell.pyboard import Pyboard
+
+    board = Pyboard(port)
+    board.serial.timeout = 1
+    try:
+        board.enter_raw_repl()
+        uid, files = eval(execRaw(board, LIST_SCRIPT % (LOG_DIR, LOG_DIR, HEAD_SIZE, LOG_DIR)))
+
+        boardDir = os.path.join(outDir, uid)
+        os.makedirs(boardDir, exist_ok=True)
+
+        # Local copy of each segment, decided once before anything is appended
+        paths = {}
+        for name, size, head in files:
+            paths[name] = localSegment(boardDir, name, size, bytes.fromhex(head))
+
+        updated = []
+        errors = []
+        # A corrupt block is fetched once more, in case it was damaged in transfer
+        for attempt in range(2):
+            wanted = []
+            for name, size, head in files:
+                path = paths[name]
+                offset = os.path.getsize(path) if os.path.exists(path) else 0
+                if offset < size:
+                    wanted.append((name, offset))
+            if not wanted:
+                break
+
+            segments = parseFetch(execRaw(board, FETCH_SCRIPT % (FETCH_CHUNK, wanted, LOG_DIR), timeout=60))
+            errors = []
+            for name, offset in wanted:
+                path = paths[name]
+                try:
+                    if appendVerified(path, offset, segments.get(name, b"")) > 0 and path not in updated:
+                        updated.append(path)
+                except ValueError as e:
+                    errors.append("%s: %s" % (name, e))
+            if not errors:
+                break
+
+        board.exit_raw_repl()
+    finally:
+        board.close()
+
+    return uid, updated, errors
+
+# Main class
+class OffloadDaemon:
+
+    """
+    Initialize daemon
+
+    outDir: directory of the offloaded logs (one subdirectory per board)
+    workers: number of decoding processes (None = one per CPU)
+    """
+    def __init__(self, outDir=OUT_DIR, workers=None):
+        self.outDir = outDir
+        self.boards = ThreadPoolExecutor(max_workers=8)
+        self.decoders = ProcessPoolExecutor(max_workers=workers)
+        self.active = set()
+        self.lock = threading.Lock()
+        self.observer = None
+
+    # Offload the boards already plugged in and watch for new ones
+    def start(self):
+        if pyudev is None:
+            raise RuntimeError("pyudev not available, use -p to offload one board")
+
+        context = pyudev.Context()
+        for device in context.list_devices(subsystem="tty"):
+            self.handleDevice(device)
+
+        monitor = pyudev.Monitor.from_netlink(context)
+        monitor.filter_by("tty")
+        self.observer = pyudev.MonitorObserver(monitor, callback=self.deviceEvent, name="gmonitor-offload")
+        self.observer.start()
+
+    # Stop watching and wait for running offloads and decodes
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer = None
+        self.boards.shutdown(wait=True)
+        self.decoders.shutdown(wait=True)
+
+    # Observer callback, runs in the observer thread
+    def deviceEvent(self, device):
+        if device.action == "add":
+            self.handleDevice(device)
+
+    # Start offloading a device if it is a MicroPython board not being offloaded yet
+    def handleDevice(self, device):
+        from rshell.main import is_micropython_usb_device
+
+        if device.device_node is None or not is_micropython_usb_device(device):
+            return
+
+        port = device.device_node
+        with self.lock:
+            if port in self.active:
+                return
+            self.active.add(port)
+        self.boards.submit(self.run, port)
+
+    # Offload one board (runs in a worker thread)
+    def run(self, port):
+        try:
+            time.sleep(SETTLE_S)
+            start = time.time()
+            uid, updated, errors = offloadBoard(port, self.outDir)
+            print("%s (%s): %d segments updated in %.1f s" % (port, uid, len(updated), time.time() - start))
+            for error in errors:
+                print("Error in OffloadDaemon.run(): " + error)
+
+            for path in updated:
+                self.decoders.submit(decodeSegment, path).add_done_callback(self.decoded)
+        except Exception as e:
+            print("Error in OffloadDaemon.run(): %s: %s" % (port, e))
+        finally:
+            with self.lock:
+                self.active.discard(port)
+
+    # Decoder callback
+    def decoded(self, future):
+        try:
+            path, records = future.result()
+            print("Decoded %s: %d records" % (path, records))
+        except Exception as e:
+            print("Error in OffloadDaemon.decoded(): " + str(e))
+
+def main():
+    parser = argparse.ArgumentParser(description="Offload GMonitor logs automatically")
+    parser.add_argument("-o", "--out", default=OUT_DIR, help="directory of the offloaded logs")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of decoding processes")
+    parser.add_argument("-p", "--port", help="offload the board on this serial port once and exit")
+    args = parser.parse_args()
+
+    if args.port is not None:
+        uid, updated, errors = offloadBoard(args.port, args.out)
+        print("%s (%s): %d segments updated" % (args.port, uid, len(updated)))
+        for error in errors:
+            print("Error in main(): " + error)
+
+        with ProcessPoolExecutor(max_workers=args.jobs) as decoders:
+            for path, records in decoders.map(decodeSegment, updated):
+                print("Decoded %s: %d records" % (path, records))
+        if errors:
+            sys.exit(1)
+        return
+
+    daemon = OffloadDaemon(args.out, args.jobs)
+    daemon.start()
+    print("Watching for GMonitor boards, offloading into " + args.out)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        daemon.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+This file contains the PWM brightness gauge display for GMonitor.
+It has the same interface as the backends in LedBackends.py.
+
+Instead of switching each direction LED fully on for one loop, the
+gauge drives the eight direction LEDs with machine.PWM. Each LED's
+brightness is proportional to the g within its band: the first LED
+fades in from 0 to one tolerance, the second from one to two
+tolerances. The hardware PWM keeps the LEDs lit between updates, so
+the CPU never has to software-PWM the pins.
+
+Per ride mode, lookup tables from quantized acceleration to a
+brightness level are built once, and a duty cycle is only written
+when an LED's level changes by a visible step.
+
+kward
+"""
+from machine import Pin, PWM
+import time
+
+PWM_FREQ = 1000 # Hz
+LEVELS = 32 # Visible brightness steps
+TOP = LEVELS - 1
+GAMMA = 2.2 # Perceived brightness correction
+
+# Acceleration is quantized to 256 buckets over 0 - 2g (raw LSB >> 7)
+QUANT_SHIFT = 7
+QUANT_SIZE = 256
+
+# Directions and their (first, second) LEDs
+LEFT = 0
+RIGHT = 1
+UP = 2 # Braking
+DOWN = 3 # Forward acceleration
+DIRECTION_LEDS = (("1L", "2L"), ("1R", "2R"), ("1U", "2U"), ("1D", "2D"))
+
+# Warning blink half period (ms, power of 2)
+BLINK_MS = 64
+
+# Threshold that is never reached (largest small int, does not allocate)
+NO_WARN = 0x3FFFFFFF
+
+# Main class
+class PwmGauge:
+
+    """
+    Initialize gauge
+
+    lightPins: map of LED name to GPIO number
+    """
+    def __init__(self, lightPins):
+        # PWM outputs in direction order: 1L, 2L, 1R, 2R, 1U, 2U, 1D, 2D
+        self.pwms = []
+        for leds in DIRECTION_LEDS:
+            for led in leds:
+                pwm = PWM(Pin(lightPins[led]))
+                pwm.freq(PWM_FREQ)
+                pwm.duty_u16(0)
+                self.pwms.append(pwm)
+
+        # Current level of every LED
+        self.levels = bytearray(len(self.pwms))
+
+        # Level to duty cycle
+        self.gamma = [int(65535 * (level / TOP) ** GAMMA) for level in range(LEVELS)]
+
+        # Level tables per direction for the first and second LED
+        self.table1 = bytearray(4 * QUANT_SIZE)
+        self.table2 = bytearray(4 * QUANT_SIZE)
+        self.warnLat = NO_WARN
+
+    """
+    Build the lookup tables for a ride mode
+
+    latTolerance, longTolF, longTolR: g per LED
+    warnLat: raw lateral acceleration of the slip warning
+    """
+    def build(self, latTolerance, longTolF, longTolR, warnLat):
+        self.warnLat = warnLat
+        tolerances = (latTolerance, latTolerance, longTolF, longTolR)
+
+        for d in range(4):
+            tol = tolerances[d]
+            for q in range(QUANT_SIZE):
+                # Center of the bucket in g
+                g = ((q << QUANT_SHIFT) + (1 << (QUANT_SHIFT - 1))) / 16384
+
+                first = min(1.0, g / tol)
+                second = min(1.0, max(0.0, (g - tol) / tol))
+                self.table1[d * QUANT_SIZE + q] = int(first * TOP + 0.5)
+                self.table2[d * QUANT_SIZE + q] = int(second * TOP + 0.5)
+
+    # Move the slip warning (raw lateral acceleration), the level tables do not depend on it
+    def setWarning(self, warnLat):
+        self.warnLat = warnLat
+
+    # Set an LED's level, only writing the duty cycle when it changes
+    def setLevel(self, i, level):
+        if self.levels[i] != level:
+            self.levels[i] = level
+            self.pwms[i].duty_u16(self.gamma[level])
+
+    # Show one axis; value is raw LSB, positive towards direction pos
+    def renderAxis(self, value, pos, neg, warn, blink):
+        if value >= 0:
+            d = pos
+            other = neg
+        else:
+            d = neg
+            other = pos
+            value = -value
+
+        q = value >> QUANT_SHIFT
+        if q >= QUANT_SIZE:
+            q = QUANT_SIZE - 1
+
+        # Blink both LEDs when past the warning threshold
+        if value >= warn:
+            first = second = TOP if blink else 0
+        else:
+            first = self.table1[d * QUANT_SIZE + q]
+            second = self.table2[d * QUANT_SIZE + q]
+
+        self.setLevel(d * 2, first)
+        self.setLevel(d * 2 + 1, second)
+        self.setLevel(other * 2, 0)
+        self.setLevel(other * 2 + 1, 0)
+
+    """
+    Update the gauge for one sample
+
+    ax: raw lateral acceleration (LSB, positive = left)
+    ay: raw longitudinal acceleration (LSB, positive = forward)
+    """
+    def render(self, ax, ay):
+        blink = time.ticks_ms() & BLINK_MS
+        self.renderAxis(ax, LEFT, RIGHT, self.warnLat, blink)
+        self.renderAxis(ay, DOWN, UP, NO_WARN, blink)
+
+    # Blink every LED (spin-out warning)
+    def renderSpin(self):
+        level = TOP if time.ticks_ms() & BLINK_MS else 0
+        for i in range(len(self.pwms)):
+            self.setLevel(i, level)
+
+    # Turn every LED off
+    def clear(self):
+        for i in range(len(self.pwms)):
+            self.setLevel(i, 0)
+
+    # Turn every LED off and release the PWM outputs
+    def deinit(self):
+        for pwm in self.pwms:
+            pwm.duty_u16(0)
+            pwm.deinit()
@@ -0,0 +1,197 @@
+"""
+This file loads GMonitor's ride mode profiles from flash.
+
+Profiles are stored in modes.json so users can add vehicle
+specific modes without reflashing code. The file is validated once
+at boot and every mode is compiled into a tuple of the float
+tolerances, the same tolerances and the slip warning threshold in
+raw accelerometer LSB (for the integer-only monitor loop) and the
+RGB LED colour method. The LED levels themselves come from
+the frame table that Classifier.py builds from the tolerances. Switching modes is then just an index
+change and the monitor loop never does a dict lookup.
+
+modes.json format:
+{
+    "default": "normal",
+    "maxLatForce": 0.95,
+    "modes": [
+        {"name": "normal", "latTolerance": 0.3, "longTolF": 0.6,
+         "longTolR": 0.25, "color": "yellow"},
+        ...
+    ]
+}
+
+Each mode may also set its own "maxLatForce" (slip warning limit).
+
+kward
+"""
+import json
+import math
+
+ACCEL_LSB_PER_G = 16384 # ICM-20948 at +-2g full scale
+WARN_MARGIN = 0.1 # Slip warning starts this many g below maxLatForce
+
+# Compiled mode tuple fields
+MODE_NAME = 0
+MODE_LAT_TOL = 1 # Lateral g per LED
+MODE_LONG_TOL_F = 2 # Braking g per LED
+MODE_LONG_TOL_R = 3 # Forward acceleration g per LED
+MODE_LAT_WARN = 4 # Lateral LSB for slip warning
+MODE_COLOR = 5 # RGB LED colour method
+MODE_COLOR_NAME = 6
+MODE_MAX_LAT = 7 # Maximum lateral force (g)
+MODE_LAT_TOL_LSB = 8 # Lateral LSB per LED
+MODE_LONG_TOL_F_LSB = 9 # Braking LSB per LED
+MODE_LONG_TOL_R_LSB = 10 # Forward acceleration LSB per LED
+
+# Built-in profiles, used when modes.json is missing or invalid
+DEFAULT_PROFILES = {
+    "default": "normal",
+    "maxLatForce": 0.95, # 2013 V6 Mustang maximum lateral force tolerance
+    "modes": [
+        # For showing off the device in a low-acceleration environment
+        {"name": "tech-demo", "latTolerance": 0.25, "longTolF": 0.4, "longTolR": 0.2, "color": "purple"},
+
+        # For normal usage
+        {"name": "normal", "latTolerance": 0.3, "longTolF": 0.6, "longTolR": 0.25, "color": "yellow"},
+
+        # For usage when the vehicle will be driven hard on normal roads
+        {"name": "sport", "latTolerance": 0.35, "longTolF": 1.0, "longTolR": 0.27, "color": "cyan"},
+
+        # For usage on a track or closed course
+        {"name": "race", "latTolerance": 0.4, "longTolF": 1.2, "longTolR": 0.3, "color": "red"}
+    ]
+}
+
+# Convert g to raw accelerometer LSB
+def toLsb(g):
+    return int(g * ACCEL_LSB_PER_G)
+
+"""
+Compile one mode profile into a tuple
+
+profile: dict from modes.json
+colors: map of colour name to RGB LED method
+maxLatForce: default slip warning limit (g)
+"""
+def compileMode(profile, colors, maxLatForce):
+    name = profile["name"]
+    latTol = float(profile["latTolerance"])
+    longTolF = float(profile["longTolF"])
+    longTolR = float(profile["longTolR"])
+    color = profile["color"]
+    maxLat = float(profile.get("maxLatForce", maxLatForce))
+
+    # Check values
+    if not type(name) == str or len(name) == 0:
+        raise ValueError("mode name must be a non-empty string")
+    for value in (latTol, longTolF, longTolR, maxLat):
+        if not math.isfinite(value):
+            raise ValueError("values of mode " + name + " must be finite")
+    if latTol <= 0 or longTolF <= 0 or longTolR <= 0:
+        raise ValueError("tolerances of mode " + name + " must be positive")
+    if maxLat <= latTol or maxLat <= WARN_MARGIN:
+        raise ValueError("maxLatForce of mode " + name + " must be above latTolerance and " + str(WARN_MARGIN) + " g")
+    if not color in colors:
+        raise ValueError("unknown color " + str(color) + " in mode " + name)
+
+    return (
+        name,
+        latTol,
+        longTolF,
+        longTolR,
+        toLsb(maxLat - WARN_MARGIN),
+        colors[color],
+        color,
+        maxLat,
+        toLsb(latTol),
+        toLsb(longTolF),
+        toLsb(longTolR)
+    )
+
+"""
+Load, validate and compile ride mode profiles
+
+Returns (modes, defaultIdx) where modes is a tuple of compiled
+mode tuples. Falls back to the built-in profiles if the file is
+missing or invalid.
+"""
+def loadModes(colors, filename="modes.json"):
+    try:
+        with open(filename) as f:
+            profiles = json.load(f)
+        modes, defaultIdx = compileProfiles(profiles, colors)
+        print("Loaded " + str(len(modes)) + " ride modes from " + filename)
+        return modes, defaultIdx
+    except OSError:
+        pass
+    except (ValueError, KeyError, TypeError) as e:
+        print("Error in loadModes(): invalid " + filename + ": " + str(e))
+
+    return compileProfiles(DEFAULT_PROFILES, colors)
+
+# Compile a full profile document
+def compileProfiles(profiles, colors):
+    maxLatForce = float(profiles.get("maxLatForce", DEFAULT_PROFILES["maxLatForce"]))
+
+    modes = []
+    names = []
+    for profile in profiles["modes"]:
+        mode = compileMode(profile, colors, maxLatForce)
+
+        if mode[MODE_NAME] in names:
+            raise ValueError("duplicate mode " + mode[MODE_NAME])
+
+        names.append(mode[MODE_NAME])
+        modes.append(mode)
+
+    if len(modes) == 0:
+        raise ValueError("no ride modes defined")
+
+    default = profiles.get("default", names[0])
+    if not default in names:
+        raise ValueError("unknown default mode " + str(default))
+
+    return tuple(modes), names.index(default)
+
+# Convert a compiled mode back into its profile dict (with maxLatForce if given instead of the mode's)
+def modeProfile(mode, maxLatForce=None):
+    return {
+        "name": mode[MODE_NAME],
+        "latTolerance": mode[MODE_LAT_TOL],
+        "longTolF": mode[MODE_LONG_TOL_F],
+        "longTolR": mode[MODE_LONG_TOL_R],
+        "color": mode[MODE_COLOR_NAME],
+        "maxLatForce": mode[MODE_MAX_LAT] if maxLatForce is None else maxLatForce
+    }
+
+"""
+Recompile one field of a mode
+
+Returns a new mode tuple, raises ValueError if the new value is invalid
+"""
+def updateMode(mode, field, value, colors):
+    profile = modeProfile(mode)
+
+    if not field in profile or field == "name":
+        raise ValueError("unknown field " + field)
+
+    profile[field] = value
+    return compileMode(profile, colors, mode[MODE_MAX_LAT])
+
+"""
+Save compiled modes back to flash
+
+priors: configured maxLatForce of each mode, saved instead of the
+        modes' current (learned) limits, which live in grip.json
+"""
+def saveModes(modes, defaultIdx, filename="modes.json", priors=None):
+    profiles = {
+        "default": modes[defaultIdx][MODE_NAME],
+        "modes": [modeProfile(mode, None if priors is None else round(priors[i], 4)) for i, mode in enumerate(modes)]
+    }
+
+    with open(filename, "w") as f:
+        json.dump(profiles, f)
+
+    print("Ride modes saved to: " + filename)
@@ -0,0 +1,296 @@
+"""
+This file contains the multi-rate scheduler of the GMonitor loop.
+
+Acquisition runs once per tick at the IMU's output data rate, and
+every consumer that does not need every sample is a stage with its
+own rate:
+
+    - The scheduler paces the ticks against ticks_us deadlines, so
+      the sample spacing no longer depends on how much work the
+      loop did
+    - Each stage declares its rate and gets its own deadline. A
+      stage that is due runs after acquisition, at most one per tick
+      (in order of priority), so slow consumers never stack up on
+      the same sample
+    - Decimating (boxcar) filters average every sample between two
+      runs of a stage, so a 60 Hz display or a 100 Hz log still sees
+      all of the 1 kHz data
+
+A tick or stage that falls more than one period behind is counted
+as an overrun and resynchronized instead of running a burst to catch
+up. The worst lateness of a tick against its deadline is kept too.
+
+TimerScheduler is the hard-periodic variant: ticks come from a
+machine.Timer, so the sample spacing no longer depends on the loop
+at all, and the loop only measures how late it picked each tick up.
+
+kward
+"""
+from array import array
+
+try:
+    from time import ticks_us, ticks_diff, ticks_add
+except ImportError:
+    # CPython fallback for running on a host
+    from time import perf_counter
+
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+    def ticks_add(a, b):
+        return a + b
+
+try:
+    from machine import Timer, idle
+    import micropython
+except ImportError:
+    Timer = None
+
+# One consumer of the sample stream
+class Stage:
+
+    """
+    Initialize stage
+
+    name: name shown by report()
+    rateHz: rate at which callback runs
+    callback: function without arguments
+    """
+    def __init__(self, name, rateHz, callback):
+        self.name = name
+        self.callback = callback
+        self.setRate(rateHz)
+
+        self.deadline = 0
+        self.runs = 0
+        self.overruns = 0
+
+    # Change the rate of the stage
+    def setRate(self, rateHz):
+        if rateHz <= 0:
+            raise ValueError("stage rate must be positive")
+
+        self.rateHz = rateHz
+        self.periodUs = 1000000 // rateHz
+
+
+# Main class
+class RateScheduler:
+
+    """
+    Initialize scheduler
+
+    rateHz: acquisition (tick) rate
+    """
+    def __init__(self, rateHz):
+        self.stages = []
+        self.setRate(rateHz)
+
+        self.deadline = ticks_us()
+        self.ticks = 0
+        self.overruns = 0
+        self.worstLateUs = 0
+
+    # Change the acquisition rate
+    def setRate(self, rateHz):
+        if rateHz <= 0:
+            raise ValueError("poll rate must be positive")
+
+        self.rateHz = rateHz
+        self.periodUs = 1000000 // rateHz
+
+    # Add a stage, stages added first have priority when several are due
+    def addStage(self, name, rateHz, callback):
+        stage = Stage(name, rateHz, callback)
+        self.stages.append(stage)
+        return stage
+
+    # Find a stage by name, None if it does not exist
+    def stage(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        return None
+
+    # Restart all deadlines from now (after a pause of the loop)
+    def start(self):
+        now = ticks_us()
+        self.deadline = now
+        for stage in self.stages:
+            stage.deadline = now
+
+    # Stop ticking (nothing to release when ticks are paced by the loop)
+    def stop(self):
+        pass
+
+    # Clear the overrun and lateness counters
+    def resetTiming(self):
+        self.overruns = 0
+        self.worstLateUs = 0
+        for stage in self.stages:
+            stage.overruns = 0
+
+    # Wait for the next acquisition tick, returns its ticks_us time
+    def wait(self):
+        deadline = self.deadline
+        while ticks_diff(deadline, ticks_us()) > 0:
+            pass
+
+        now = ticks_us()
+        late = ticks_diff(now, deadline)
+        if late > self.worstLateUs:
+            self.worstLateUs = late
+        deadline = ticks_add(deadline, self.periodUs)
+
+        # More than a period behind, drop the missed ticks
+        if ticks_diff(now, deadline) >= 0:
+            deadline = ticks_add(now, self.periodUs)
+            self.overruns += 1
+
+        self.deadline = deadline
+        self.ticks += 1
+        return now
+
+    # Run the first stage that is due at time now (ticks_us)
+    def run(self, now):
+        for stage in self.stages:
+            if ticks_diff(now, stage.deadline) >= 0:
+                deadline = ticks_add(stage.deadline, stage.periodUs)
+                if ticks_diff(now, deadline) >= 0:
+                    deadline = ticks_add(now, stage.periodUs)
+                    stage.overruns += 1
+                stage.deadline = deadline
+
+                stage.runs += 1
+                stage.callback()
+                return
+
+    # Print configured rates and deadline overruns over serial
+    def report(self):
+        print("Acquisition: %d Hz, %d ticks, %d overruns, worst lateness %d us" % (self.rateHz, self.ticks, self.overruns, self.worstLateUs))
+        for stage in self.stages:
+            print("Stage %s: %d Hz, %d runs, %d overruns" % (stage.name, stage.rateHz, stage.runs, stage.overruns))
+
+
+# Hard-periodic scheduler, ticks are generated by a hardware timer
+class TimerScheduler(RateScheduler):
+
+    """
+    Initialize scheduler
+
+    The timer callback only hands the tick to micropython.schedule,
+    which counts it outside of interrupt context. wait() sleeps until
+    a tick is pending. A tick that is still pending when the next one
+    fires is an overrun and is dropped.
+
+    rateHz: acquisition (tick) rate
+    timerId: hardware timer (-1 = virtual timer)
+    """
+    def __init__(self, rateHz, timerId=-1):
+        if Timer is None:
+            raise ValueError("machine.Timer not available")
+
+        self.timer = Timer(timerId)
+        self.tickRef = self.tick # Bound method allocated once, not per interrupt
+        self.pending = 0
+        self.running = False
+        RateScheduler.__init__(self, rateHz)
+
+    # Change the acquisition rate (restarts the timer if it runs)
+    def setRate(self, rateHz):
+        RateScheduler.setRate(self, rateHz)
+        if self.running:
+            self.start()
+
+    # Timer callback, may run in hard interrupt context
+    def isr(self, timer):
+        try:
+            micropython.schedule(self.tickRef, 0)
+        except RuntimeError:
+            # Schedule queue full, the tick is lost
+            self.overruns += 1
+
+    # Scheduled tick, deadline of the newest tick
+    def tick(self, arg):
+        self.pending += 1
+        self.deadline = ticks_add(self.deadline, self.periodUs)
+
+    # Restart the timer and all stage deadlines from now
+    def start(self):
+        self.timer.deinit()
+        RateScheduler.start(self)
+        self.pending = 0
+        self.running = True
+        self.timer.init(freq=self.rateHz, mode=Timer.PERIODIC, callback=self.isr)
+
+    # Stop the timer
+    def stop(self):
+        self.timer.deinit()
+        self.running = False
+
+    # Wait for the next timer tick, returns the time it was picked up
+    def wait(self):
+        while self.pending == 0:
+            idle()
+
+        now = ticks_us()
+        # Subtract rather than clear, a tick may be scheduled in between
+        pending = self.pending
+        self.pending -= pending
+
+        # Lateness against the oldest pending tick, later ones are overruns
+        late = ticks_diff(now, self.deadline) + (pending - 1) * self.periodUs
+        if late > self.worstLateUs:
+            self.worstLateUs = late
+        self.overruns += pending - 1
+
+        self.ticks += 1
+        return now
+
+
+# Boxcar decimating filter over integer channels
+class Decimator:
+
+    """
+    Initialize filter
+
+    channels: number of integer channels (raw LSB)
+    """
+    def __init__(self, channels):
+        self.sums = array('l', [0] * channels)
+        self.count = 0
+
+    # Add one sample of values[i] to channels offset + i
+    def add(self, values, offset=0):
+        sums = self.sums
+        for i in range(len(values)):
+            sums[offset + i] += values[i]
+
+    # Count the sample added with add() (once per tick)
+    def tick(self):
+        self.count += 1
+
+    """
+    Write the mean of every channel since the last call to out
+    and restart, returns the number of samples averaged
+    """
+    def mean(self, out):
+        sums = self.sums
+        n = self.count
+        if n == 0:
+            return 0
+
+        for i in range(len(sums)):
+            # Round half away from zero
+            s = sums[i]
+            if s >= 0:
+                out[i] = (s + (n >> 1)) // n
+            else:
+                out[i] = -((-s + (n >> 1)) // n)
+            sums[i] = 0
+
+        self.count = 0
+        return n
@@ -0,0 +1,262 @@
+"""
+This file contains incremental session statistics for GMonitor.
+
+Instead of logging the raw 1kHz stream, the monitor keeps a
+running summary of the session and of each ride mode:
+    - Peak lateral (left/right), braking and forward acceleration
+    - Running mean and variance of each axis (sums of samples and
+      of their squares)
+    - Samples spent at or above each LED level in every direction
+    - A fixed-bin 2D g-g histogram (lateral vs longitudinal)
+
+Samples and thresholds are raw accelerometer LSB and every
+accumulator is an int that stays a MicroPython small int (sums carry
+into a high word), so an update never boxes a float. Everything lives
+in preallocated arrays and every update is O(1), so no memory is
+allocated while monitoring. Conversion to g happens in dump().
+
+kward
+"""
+from array import array
+import struct
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    # CPython fallback for running on a host
+    from time import perf_counter
+
+    def ticks_ms():
+        return int(perf_counter() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+# Peak indices
+PEAK_LEFT = 0
+PEAK_RIGHT = 1
+PEAK_BRAKING = 2
+PEAK_ACCEL = 3
+NUM_PEAKS = 4
+
+ACCEL_LSB_PER_G = 16384 # ICM-20948 at +-2g full scale
+
+# Number of axes with mean/variance (x, y, z)
+NUM_AXES = 3
+
+# Sums of (halved) samples and squares carry into a high word past CARRY_BITS
+CARRY_BITS = 24
+CARRY_MASK = (1 << CARRY_BITS) - 1
+
+# LED level counters (level 1 and level 2 for left, right, up, down)
+LEVELS = ("1L", "2L", "1R", "2R", "1U", "2U", "1D", "2D")
+NUM_LEVELS = 8
+
+# g-g histogram, HIST_BINS x HIST_BINS bins over +-HIST_RANGE (1.6 g)
+HIST_BINS = 16
+HIST_RANGE = 26214
+
+# File header for save(): magic, version, number of slots
+FILE_MAGIC = b"GMST"
+FILE_VERSION = 2
+
+# Main class
+class SessionStats:
+
+    """
+    Initialize statistics
+
+    modeNames: list of ride mode names, one slot is kept per
+    mode plus one for the whole session
+    """
+    def __init__(self, modeNames):
+        self.modeNames = modeNames
+        self.numSlots = len(modeNames) + 1
+        self.sessionSlot = len(modeNames)
+
+        n = self.numSlots
+        self.peaks = array('l', [0] * (n * NUM_PEAKS))
+        self.count = array('L', [0] * n)
+        self.sumLo = array('l', [0] * (n * NUM_AXES))
+        self.sumHi = array('l', [0] * (n * NUM_AXES))
+        self.sqLo = array('l', [0] * (n * NUM_AXES))
+        self.sqHi = array('l', [0] * (n * NUM_AXES))
+        self.levels = array('L', [0] * (n * NUM_LEVELS))
+        self.hist = array('L', [0] * (n * HIST_BINS * HIST_BINS))
+
+        self.reset()
+
+    # Clear all statistics and start a new session
+    def reset(self):
+        for arr in (self.peaks, self.count, self.sumLo, self.sumHi, self.sqLo, self.sqHi, self.levels, self.hist):
+            for i in range(len(arr)):
+                arr[i] = 0
+
+        self.startMs = ticks_ms()
+        self.durationMs = 0
+
+    """
+    Add one sample to the session and ride mode statistics
+
+    modeIdx: index of the current ride mode in modeNames
+    ax: lateral acceleration (raw LSB)
+    ay: longitudinal acceleration (raw LSB)
+    az: vertical acceleration (raw LSB)
+    latTolerance, longTolF, longTolR: raw LSB per LED of the current ride mode
+    """
+    def update(self, modeIdx, ax, ay, az, latTolerance, longTolF, longTolR):
+        self.updateSlot(modeIdx, ax, ay, az, latTolerance, longTolF, longTolR)
+        self.updateSlot(self.sessionSlot, ax, ay, az, latTolerance, longTolF, longTolR)
+
+    # Update a single slot
+    def updateSlot(self, slot, ax, ay, az, latTolerance, longTolF, longTolR):
+        peaks = self.peaks
+        levels = self.levels
+
+        # Peaks
+        p = slot * NUM_PEAKS
+        if ax > peaks[p + PEAK_LEFT]:
+            peaks[p + PEAK_LEFT] = ax
+        elif -ax > peaks[p + PEAK_RIGHT]:
+            peaks[p + PEAK_RIGHT] = -ax
+        if -ay > peaks[p + PEAK_BRAKING]:
+            peaks[p + PEAK_BRAKING] = -ay
+        elif ay > peaks[p + PEAK_ACCEL]:
+            peaks[p + PEAK_ACCEL] = ay
+
+        # Sums for the running mean and variance
+        self.count[slot] += 1
+        a = slot * NUM_AXES
+        self.addSample(a, ax)
+        self.addSample(a + 1, ay)
+        self.addSample(a + 2, az)
+
+        # Time at or above each LED level (same rounding as the display: 1 LED from half a tolerance)
+        l = slot * NUM_LEVELS
+        if ax > 0:
+            twice = ax << 1
+        else:
+            twice = -ax << 1
+            l += 2
+        if twice >= latTolerance:
+            levels[l] += 1
+            if twice >= 3 * latTolerance:
+                levels[l + 1] += 1
+
+        l = slot * NUM_LEVELS
+        if ay > 0:
+            twice = ay << 1
+            tol = longTolR
+            l += 6
+        else:
+            twice = -ay << 1
+            tol = longTolF
+            l += 4
+        if twice >= tol:
+            levels[l] += 1
+            if twice >= 3 * tol:
+                levels[l + 1] += 1
+
+        # g-g histogram, clamped to the outer bins
+        col = (ax + HIST_RANGE) * HIST_BINS // (2 * HIST_RANGE)
+        if col < 0:
+            col = 0
+        elif col >= HIST_BINS:
+            col = HIST_BINS - 1
+        row = (ay + HIST_RANGE) * HIST_BINS // (2 * HIST_RANGE)
+        if row < 0:
+            row = 0
+        elif row >= HIST_BINS:
+            row = HIST_BINS - 1
+        self.hist[(slot * HIST_BINS + row) * HIST_BINS + col] += 1
+
+    # Add a sample to the sums of one axis. Halved, its square stays below 2**28 and each low word below 2**29
+    def addSample(self, i, value):
+        half = value >> 1
+
+        lo = self.sumLo[i] + half
+        if lo >> CARRY_BITS:
+            self.sumHi[i] += lo >> CARRY_BITS
+            lo &= CARRY_MASK
+        self.sumLo[i] = lo
+
+        lo = self.sqLo[i] + half * half
+        if lo >> CARRY_BITS:
+            self.sqHi[i] += lo >> CARRY_BITS
+            lo &= CARRY_MASK
+        self.sqLo[i] = lo
+
+    # Update session duration
+    def stop(self):
+        self.durationMs = ticks_diff(ticks_ms(), self.startMs)
+
+    # Mean of an axis in a slot (g)
+    def mean(self, slot, axis):
+        n = self.count[slot]
+        if n == 0:
+            return 0.0
+        i = slot * NUM_AXES + axis
+        total = (self.sumHi[i] << CARRY_BITS) + self.sumLo[i]
+        return 2 * total / n / ACCEL_LSB_PER_G
+
+    # Variance of an axis in a slot (g^2), exact in ints up to the final division
+    def variance(self, slot, axis):
+        n = self.count[slot]
+        if n < 2:
+            return 0.0
+        i = slot * NUM_AXES + axis
+        total = (self.sumHi[i] << CARRY_BITS) + self.sumLo[i]
+        squares = (self.sqHi[i] << CARRY_BITS) + self.sqLo[i]
+        return 4 * (n * squares - total * total) / (n * (n - 1)) / (ACCEL_LSB_PER_G * ACCEL_LSB_PER_G)
+
+    # Print a human readable summary over serial
+    def dump(self):
+        self.stop()
+        total = self.count[self.sessionSlot]
+
+        print("\n\nGMonitor Session Statistics:")
+        print("=======================================")
+        print("Duration: %.1f s, %d samples" % (self.durationMs / 1000, total))
+
+        for slot in range(self.numSlots):
+            n = self.count[slot]
+            if n == 0:
+                continue
+
+            if slot == self.sessionSlot:
+                print("\n[session]")
+            else:
+                print("\n[" + self.modeNames[slot] + "]")
+
+            p = slot * NUM_PEAKS
+            peaks = [self.peaks[p + i] / ACCEL_LSB_PER_G for i in range(NUM_PEAKS)]
+            print("Peak left/right: %.2f / %.2f g" % (peaks[PEAK_LEFT], peaks[PEAK_RIGHT]))
+            print("Peak braking/accel: %.2f / %.2f g" % (peaks[PEAK_BRAKING], peaks[PEAK_ACCEL]))
+
+            for axis in range(NUM_AXES):
+                print("Axis %s mean %.3f g, std %.3f g" % ("xyz"[axis], self.mean(slot, axis), self.variance(slot, axis) ** 0.5))
+
+            # Convert sample counts to time using the session's average rate
+            for i in range(NUM_LEVELS):
+                count = self.levels[slot * NUM_LEVELS + i]
+                if total > 0:
+                    print("Time at LED %s: %.2f s" % (LEVELS[i], count * self.durationMs / total / 1000))
+
+    """
+    Save all statistics to a small binary file on flash
+
+    Layout: header (magic, version, slots, hist bins, duration ms)
+    followed by the raw bytes of each array. Peaks are raw LSB, the
+    sums are of halved samples (value >> 1), split into low and high
+    words of CARRY_BITS
+    """
+    def save(self, filename="stats.bin"):
+        self.stop()
+
+        with open(filename, "wb") as f:
+            f.write(FILE_MAGIC)
+            f.write(struct.pack("<BBBxL", FILE_VERSION, self.numSlots, HIST_BINS, self.durationMs))
+            for arr in (self.peaks, self.count, self.sumLo, self.sumHi, self.sqLo, self.sqHi, self.levels, self.hist):
+                f.write(arr)
+
+        print("Session statistics saved to: " + filename)
@@ -0,0 +1,517 @@
+"""
+This file contains the columnar session store of GMonitor (run on a
+computer).
+
+Logs and telemetry are decoded once into a store directory that keeps
+every channel in its own fixed-width column file, so analysis over
+hundreds of sessions does no parsing: a column file is memory-mapped
+and read as a zero-copy memoryview (or NumPy array), and only the
+columns an analysis touches are ever paged in.
+
+Store layout (one directory):
+    header      HEADER_FORMAT: magic "GMCS", version, column count,
+                rows, followed by a COLUMN_FORMAT entry (name, type
+                code) per column
+    index       INDEX_FORMAT entries: kind (session or lap), log rate
+                (Hz), number, first row, end row
+    <name>.col  the column, little endian, COLUMNS[i][1] per row
+
+Columns: time (ms since the session started), ax, ay, az, gx, gy, gz,
+mx, my, mz (raw LSB), ride mode index, flags (FLAG_* of DataLogger.py).
+
+Sessions are numbered in the order they were added. Laps are optional
+row ranges within a session (marked by whoever adds the session, e.g.
+an importer that knows the lap channel). The row count in the header
+is only updated after the columns and index were written, so a store
+whose writer was interrupted is still consistent up to its last
+flush(), and the rows after it are dropped when it is opened again.
+
+Usage:
+    python SessionStore.py STORE                         Print the sessions and laps in STORE
+    python SessionStore.py STORE offload/<id>/*.gml      Add logged segments (one session per log session)
+    python SessionStore.py STORE telemetry/*.csv         Add the CSVs of LogOffload.py / TelemetryIngest.py
+    python SessionStore.py -b                            Benchmark import and column scans
+
+kward
+"""
+import argparse
+import csv
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+from DataLogger import RECORD_FORMAT, RECORD_SIZE, parseHeader, readBlocks
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+STORE_MAGIC = b"GMCS"
+STORE_VERSION = 1
+
+HEADER_FORMAT = "<4sBBHQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+COLUMN_FORMAT = "<8sc"
+COLUMN_SIZE = struct.calcsize(COLUMN_FORMAT)
+INDEX_FORMAT = "<HHLQQ"
+INDEX_SIZE = struct.calcsize(INDEX_FORMAT)
+
+# Index entry kinds
+KIND_SESSION = 0
+KIND_LAP = 1
+
+# Columns in record order: name, type code (array/memoryview, standard sizes)
+COLUMNS = (
+    ("time", "I"),
+    ("ax", "h"), ("ay", "h"), ("az", "h"),
+    ("gx", "h"), ("gy", "h"), ("gz", "h"),
+    ("mx", "h"), ("my", "h"), ("mz", "h"),
+    ("mode", "B"),
+    ("flags", "B"),
+)
+COLUMN_NAMES = tuple(name for name, typecode in COLUMNS)
+
+# NumPy dtype of each type code
+DTYPES = {"I": "<u4", "h": "<i2", "B": "u1"}
+
+# Byte offset of each column in a DataLogger record
+RECORD_OFFSETS = tuple(struct.calcsize("<" + "".join(typecode for name, typecode in COLUMNS[:i])) for i in range(len(COLUMNS)))
+if RECORD_OFFSETS[-1] + 1 != RECORD_SIZE or struct.calcsize(RECORD_FORMAT) != RECORD_SIZE:
+    raise ImportError("COLUMNS do not match DataLogger.RECORD_FORMAT")
+
+"""
+Split packed DataLogger records into one bytes object per column
+
+Every column is gathered with a strided slice per byte of its width,
+so no record is unpacked in Python.
+"""
+def splitRecords(records):
+    data = bytes(records)
+    count = len(data) // RECORD_SIZE
+    data = data[:count * RECORD_SIZE]
+
+    columns = []
+    for i in range(len(COLUMNS)):
+        width = struct.calcsize(COLUMNS[i][1])
+        column = bytearray(count * width)
+        for k in range(width):
+            column[k::width] = data[RECORD_OFFSETS[i] + k::RECORD_SIZE]
+        columns.append(column)
+    return columns
+
+# Main class
+class SessionStore:
+
+    """
+    Open a store
+
+    path: store directory
+    mode: "r" to read, "a" to read and add sessions (the store is
+          created if it does not exist)
+    """
+    def __init__(self, path, mode="r"):
+        if mode not in ("r", "a"):
+            raise ValueError("mode must be 'r' or 'a'")
+
+        self.path = path
+        self.mode = mode
+        self.maps = {}
+        self.files = None
+        self.session = None # Index entry of the session being added
+        self.lap = None
+
+        if not os.path.exists(os.path.join(path, "header")):
+            if mode == "r":
+                raise ValueError("no session store at " + path)
+            os.makedirs(path, exist_ok=True)
+            self.rows = 0
+            self.entries = []
+            self.writeIndex()
+            self.writeHeader()
+        else:
+            self.refresh()
+
+        if mode == "a":
+            # Drop rows written after the last flush
+            self.files = []
+            for name, typecode in COLUMNS:
+                f = open(self.columnPath(name), "ab")
+                f.truncate(self.rows * struct.calcsize(typecode))
+                self.files.append(f)
+
+    # File of a column
+    def columnPath(self, name):
+        return os.path.join(self.path, name + ".col")
+
+    # Reread the header and index (picks up sessions added by another process)
+    def refresh(self):
+        with open(os.path.join(self.path, "header"), "rb") as f:
+            data = f.read()
+
+        if len(data) < HEADER_SIZE:
+            raise ValueError("session store header incomplete")
+        magic, version, count, reserved, rows = struct.unpack_from(HEADER_FORMAT, data, 0)
+        if magic != STORE_MAGIC or version != STORE_VERSION:
+            raise ValueError("not a version " + str(STORE_VERSION) + " GMonitor session store")
+
+        columns = []
+        for i in range(count):
+            name, typecode = struct.unpack_from(COLUMN_FORMAT, data, HEADER_SIZE + i * COLUMN_SIZE)
+            columns.append((name.rstrip(b"\0").decode(), typecode.decode()))
+        if tuple(columns) != COLUMNS:
+            raise ValueError("session store has different columns")
+
+        with open(os.path.join(self.path, "index"), "rb") as f:
+            data = f.read()
+        self.entries = [list(entry) for entry in struct.iter_unpack(INDEX_FORMAT, data[:len(data) - len(data) % INDEX_SIZE])]
+        self.rows = rows
+
+    def writeHeader(self):
+        header = bytearray(struct.pack(HEADER_FORMAT, STORE_MAGIC, STORE_VERSION, len(COLUMNS), 0, self.rows))
+        for name, typecode in COLUMNS:
+            header += struct.pack(COLUMN_FORMAT, name.encode(), typecode.encode())
+
+        path = os.path.join(self.path, "header")
+        with open(path + ".tmp", "wb") as f:
+            f.write(header)
+        os.replace(path + ".tmp", path)
+
+    def writeIndex(self):
+        path = os.path.join(self.path, "index")
+        with open(path + ".tmp", "wb") as f:
+            f.write(b"".join(struct.pack(INDEX_FORMAT, *entry) for entry in self.entries))
+        os.replace(path + ".tmp", path)
+
+    """
+    Start adding a session
+
+    rateHz: rate of the rows
+    Returns the number of the session.
+    """
+    def beginSession(self, rateHz):
+        if self.files is None:
+            raise ValueError("session store is read only")
+        if self.session is not None:
+            self.endSession()
+
+        number = 1 + max([entry[2] for entry in self.entries if entry[0] == KIND_SESSION] or [0])
+        self.session = [KIND_SESSION, rateHz, number, self.rows, self.rows]
+        self.entries.append(self.session)
+        return number
+
+    # Start a new lap of the current session at the next row
+    def markLap(self):
+        if self.session is None:
+            raise ValueError("no session being added")
+
+        self.endLap()
+        number = 1 + sum(1 for entry in self.entries if entry[0] == KIND_LAP and entry[3] >= self.session[3])
+        self.lap = [KIND_LAP, self.session[1], number, self.rows, self.rows]
+        self.entries.append(self.lap)
+
+    # End the current lap (the rest of the session belongs to no lap)
+    def endLap(self):
+        if self.lap is not None:
+            self.lap[4] = self.rows
+            self.lap = None
+
+    # End the current session and write it out
+    def endSession(self):
+        if self.session is None:
+            return
+
+        self.endLap()
+        self.session[4] = self.rows
+        self.session = None
+        self.flush()
+
+    # Add packed DataLogger records (bytes or memoryview, e.g. the blocks of readBlocks())
+    def appendRecords(self, records):
+        self.appendColumns(splitRecords(records))
+
+    # Add rows given as tuples (time ms, ax, ay, az, gx, gy, gz, mx, my, mz, mode, flags)
+    def appendRows(self, rows):
+        if not rows:
+            return
+
+        columns = []
+        for i, values in enumerate(zip(*rows)):
+            column = array(COLUMNS[i][1], values)
+            if sys.byteorder != "little":
+                column.byteswap()
+            columns.append(column)
+        self.appendColumns(columns)
+
+    # Add one buffer (little endian) per column, all holding the same number of rows
+    def appendColumns(self, columns):
+        if self.session is None:
+            raise ValueError("no session being added")
+
+        sizes = [memoryview(column).nbytes for column in columns]
+        count = sizes[0] // struct.calcsize(COLUMNS[0][1])
+        for i, (name, typecode) in enumerate(COLUMNS):
+            if sizes[i] != count * struct.calcsize(typecode):
+                raise ValueError("column " + name + " has a different number of rows")
+        for f, column in zip(self.files, columns):
+            f.write(column)
+
+        self.rows += count
+        self.session[4] = self.rows
+        if self.lap is not None:
+            self.lap[4] = self.rows
+
+    # Make the rows added so far visible to readers
+    def flush(self):
+        if self.files is None:
+            return
+
+        for f in self.files:
+            f.flush()
+            os.fsync(f.fileno())
+        self.writeIndex()
+        self.writeHeader()
+
+    def close(self):
+        if self.files is not None:
+            self.endSession()
+            self.flush()
+            for f in self.files:
+                f.close()
+            self.files = None
+
+        # Mappings still viewed by the caller stay valid until the views are released
+        self.maps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Sessions as (number, rateHz, first row, end row)
+    def sessions(self):
+        return [(entry[2], entry[1], entry[3], entry[4]) for entry in self.entries if entry[0] == KIND_SESSION]
+
+    # Laps of a session as (number, first row, end row)
+    def laps(self, session):
+        first, end = self.sessionRows(session)
+        return [(entry[2], entry[3], entry[4]) for entry in self.entries
+            if entry[0] == KIND_LAP and entry[3] >= first and entry[4] <= end and entry[3] < end]
+
+    # Row range (first, end) of a session
+    def sessionRows(self, session):
+        for entry in self.entries:
+            if entry[0] == KIND_SESSION and entry[2] == session:
+                return entry[3], entry[4]
+        raise ValueError("no session " + str(session))
+
+    # Row range (first, end) of a lap of a session
+    def lapRows(self, session, lap):
+        for number, first, end in self.laps(session):
+            if number == lap:
+                return first, end
+        raise ValueError("no lap " + str(lap) + " in session " + str(session))
+
+    # Read-only mapping of a column file, mapped again when rows were added since
+    def mapping(self, name, width):
+        mapped = self.maps.get(name)
+        if mapped is None or len(mapped) < self.rows * width:
+            with open(self.columnPath(name), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), self.rows * width, access=mmap.ACCESS_READ)
+            self.maps[name] = mapped
+        return mapped
+
+    # Checked row range and type code of a column
+    def columnRange(self, name, first, end):
+        typecode = COLUMNS[COLUMN_NAMES.index(name)][1]
+        if end is None:
+            end = self.rows
+        if first < 0 or first > end or end > self.rows:
+            raise ValueError("rows " + str(first) + "-" + str(end) + " out of range")
+        return typecode, end
+
+    """
+    Zero-copy view of a column
+
+    name: column name (COLUMN_NAMES)
+    first, end: row range (default all rows)
+    Returns a memoryview with the column's type code. The file is
+    mapped on first use, so columns that are never viewed are never
+    read.
+    """
+    def column(self, name, first=0, end=None):
+        if sys.byteorder != "little":
+            raise ValueError("column views need a little endian host, use array() with NumPy")
+
+        typecode, end = self.columnRange(name, first, end)
+        if end == first:
+            return memoryview(b"").cast(typecode)
+
+        width = struct.calcsize(typecode)
+        return memoryview(self.mapping(name, width))[first * width:end * width].cast(typecode)
+
+    # Column as a NumPy array viewing the mapping (a memoryview without NumPy)
+    def array(self, name, first=0, end=None):
+        if numpy is None:
+            return self.column(name, first, end)
+
+        typecode, end = self.columnRange(name, first, end)
+        if end == first:
+            return numpy.zeros(0, dtype=DTYPES[typecode])
+
+        width = struct.calcsize(typecode)
+        return numpy.frombuffer(self.mapping(name, width), dtype=DTYPES[typecode], count=end - first, offset=first * width)
+
+    # Views of several columns of a session (all columns by default) as {name: view}
+    def sessionColumns(self, session, names=COLUMN_NAMES):
+        first, end = self.sessionRows(session)
+        return {name: self.array(name, first, end) for name in names}
+
+    # Views of several columns of a lap as {name: view}
+    def lapColumns(self, session, lap, names=COLUMN_NAMES):
+        first, end = self.lapRows(session, lap)
+        return {name: self.array(name, first, end) for name in names}
+
+    """
+    Add logged segments, one session per log session
+
+    paths: .gml segment files (e.g. of LogOffload.py), in any order
+    Returns the numbers of the sessions added.
+    """
+    def importSegments(self, paths):
+        bySession = {}
+        for path in paths:
+            with open(path, "rb") as f:
+                data = f.read()
+            header = parseHeader(data)
+            bySession.setdefault(header["session"], []).append((header["segment"], header["rateHz"], data))
+
+        added = []
+        for session in sorted(bySession):
+            segments = sorted(bySession[session], key=lambda segment: segment[0])
+            added.append(self.beginSession(segments[0][1]))
+            for number, rateHz, data in segments:
+                for offset, records in readBlocks(data):
+                    self.appendRecords(records)
+            self.endSession()
+        return added
+
+    """
+    Add a CSV of LogOffload.py or TelemetryIngest.py as one session
+
+    rateHz: rate of the rows (taken from the time column if None)
+    Returns the number of the session added.
+    """
+    def importCsv(self, path, rateHz=None):
+        with open(path, newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            picks = [header.index("time_ms")] + [header.index(name) for name in COLUMN_NAMES[1:]]
+            rows = [[int(row[i]) for i in picks] for row in reader if row]
+
+        if rateHz is None:
+            span = rows[-1][0] - rows[0][0] if len(rows) > 1 else 0
+            rateHz = int(round(1000 * (len(rows) - 1) / span)) if span > 0 else 1
+
+        number = self.beginSession(rateHz)
+        self.appendRows(rows)
+        self.endSession()
+        return number
+
+# Print the sessions and laps of a store
+def printStore(store):
+    print("%s: %d rows in %d sessions" % (store.path, store.rows, len(store.sessions())))
+    for number, rateHz, first, end in store.sessions():
+        times = store.column("time", first, end)
+        duration = (times[-1] - times[0]) / 1000 if end > first else 0
+        print("  session %4d: %8d rows at %4d Hz, %8.1f s" % (number, end - first, rateHz, duration))
+        for lap, lapFirst, lapEnd in store.laps(number):
+            print("    lap %3d: %8d rows, %7.1f s" % (lap, lapEnd - lapFirst, (lapEnd - lapFirst) / rateHz))
+
+# Import an hour of 1 kHz records and time it against reading it back
+def benchmark():
+    import shutil
+    import tempfile
+
+    rateHz = 1000
+    count = 3600 * rateHz
+    record = struct.Struct(RECORD_FORMAT)
+    records = bytearray(count * RECORD_SIZE)
+    for i in range(count):
+        record.pack_into(records, i * RECORD_SIZE, i, i % 16384, -(i % 8000), 16384, 0, 0, i % 500, 1, 2, 3, i // 600000, 0)
+
+    path = tempfile.mkdtemp(prefix="gmcs")
+    try:
+        start = time.perf_counter()
+        with SessionStore(path, "a") as store:
+            store.beginSession(rateHz)
+            # One minute laps, added in 1000 record blocks
+            for block in range(0, count, 1000):
+                if block % (60 * rateHz) == 0:
+                    store.markLap()
+                store.appendRecords(records[block * RECORD_SIZE:(block + 1000) * RECORD_SIZE])
+        imported = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store = SessionStore(path)
+        opened = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ax = store.column("ax")
+        peak = max(ax)
+        scanned = time.perf_counter() - start
+
+        # Conformance: every column matches the records it came from
+        ok = peak == 16383
+        for i in (0, 12345, count - 1):
+            values = record.unpack_from(records, i * RECORD_SIZE)
+            ok = ok and tuple(store.column(name)[i] for name in COLUMN_NAMES) == values
+        ok = ok and len(store.laps(1)) == 60 and store.laps(1)[-1][2] == count
+
+        print("\nSession store benchmark (%d rows)" % count)
+        print("=======================================")
+        print("import     %8.1f ms" % (imported * 1000))
+        print("open       %8.3f ms" % (opened * 1000))
+        print("max(ax)    %8.1f ms (memoryview%s)" % (scanned * 1000, ", numpy available" if numpy is not None else ""))
+        if numpy is not None:
+            start = time.perf_counter()
+            peak = int(store.array("ax").max())
+            print("numpy max  %8.1f ms" % ((time.perf_counter() - start) * 1000))
+        print("columns match records: " + ("ok" if ok else "MISMATCH"))
+
+        del ax
+        store.close()
+    finally:
+        shutil.rmtree(path)
+
+def main():
+    parser = argparse.ArgumentParser(description="GMonitor columnar session store")
+    parser.add_argument("store", nargs="?", help="store directory")
+    parser.add_argument("files", nargs="*", help=".gml segments or CSVs to add")
+    parser.add_argument("-b", "--bench", action="store_true", help="benchmark import and column scans")
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark()
+        return
+    if args.store is None:
+        parser.error("a store directory is needed")
+
+    if args.files:
+        with SessionStore(args.store, "a") as store:
+            segments = [path for path in args.files if path.endswith(".gml")]
+            if segments:
+                print("Added sessions %s from %d segments" % (store.importSegments(segments), len(segments)))
+            for path in args.files:
+                if path.endswith(".csv"):
+                    print("Added session %d from %s" % (store.importCsv(path), path))
+
+    with SessionStore(args.store) as store:
+        printStore(store)
+
+if __name__ == "__main__":
+    main()
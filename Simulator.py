@@ -0,0 +1,607 @@
+"""
+This file simulates the Pico and the IMU so GMonitor can run on a
+computer (run on a computer).
+
+install() registers simulated machine, micropython and neopixel
+modules and a virtual clock, after which the unchanged device modules
+(GMonitor.py, icm20948.py, ...) can be imported and run on CPython:
+
+    - machine.I2C is a simulated bus with an ICM-20948 register model
+      on it (banks, WHO_AM_I, the AK09916 behind the I2C master). The
+      14 byte ACCEL_XOUT_H burst that GyroAccelRead() reads is served
+      from a stream of raw bursts in the exact register layout (big
+      endian ax, ay, az, gx, gy, gz, temp), see packBursts()
+    - time.ticks_*() and time.sleep*() use a virtual clock. The
+      deadline scheduler jumps the clock to its next deadline instead
+      of spinning, and machine.Timer callbacks fire as the clock
+      passes them, so a replay runs as fast as the host can execute
+      the monitor loop
+    - Pins, PWM, SPI and NeoPixel outputs keep what they were set to
+      and for how long, which replay() reports per LED
+
+The simulated modules are only registered in sys.modules (there is no
+machine.py that could end up on the Pico). Kernels.py is imported
+before micropython is registered, so the reference (pure Python)
+kernels are used. The MicroPython heap is not modelled,
+gc.mem_free() and gc.mem_alloc() return fixed values.
+
+kward
+"""
+import struct
+import sys
+import time
+import types
+
+# ICM-20948 registers used by icm20948.py
+IMU_ADDRESS = 0x68
+REG_WHO_AM_I = 0x00
+WHO_AM_I = 0xEA
+REG_USER_CTRL = 0x03
+BIT_I2C_MST_EN = 0x20
+REG_ACCEL_XOUT_H = 0x2D
+REG_EXT_SENS_DATA_00 = 0x3B
+REG_BANK_SEL = 0x7F
+REG_SLV0_ADDR = 0x03 # Bank 3
+REG_SLV1_ADDR = 0x07
+BIT_SLV_EN = 0x80
+BIT_SLV_READ = 0x80
+
+# AK09916 magnetometer registers
+MAG_WIA1 = 0x48
+MAG_WIA2 = 0x09
+REG_MAG_ST2 = 0x10
+REG_MAG_DATA = 0x11
+
+BURST_SIZE = 14
+BURST_CHANNELS = 7
+
+# Raw values of a board lying still at about 30 C: az = 1g, TEMP_OUT = (30 - 21) * 333.87
+REST_BURST = struct.pack(">7h", 0, 0, 16384, 0, 0, 0, 3005)
+
+# Simulated heap (bytes)
+HEAP_FREE = 180000
+HEAP_ALLOC = 20000
+
+# Raised by the IMU model when the burst stream ends, ends monitor()
+class ReplayFinished(Exception):
+    pass
+
+"""
+Pack raw channels into IMU bursts
+
+channels: ax, ay, az, gx, gy, gz, temp, each an int16 buffer (array
+          'h', memoryview) of the same length or an int for a
+          constant channel
+Returns a bytearray of len * BURST_SIZE bytes, the big endian
+register layout of ACCEL_XOUT_H onwards. Every channel is written
+with two strided slice assignments, so packing does not touch single
+samples in Python.
+"""
+def packBursts(channels):
+    count = None
+    for channel in channels:
+        if not isinstance(channel, int):
+            count = len(channel)
+            break
+    if count is None:
+        raise ValueError("at least one channel must be a buffer")
+
+    bursts = bytearray(count * BURST_SIZE)
+    high = 1 if sys.byteorder == "little" else 0
+    for i in range(BURST_CHANNELS):
+        channel = channels[i]
+        if isinstance(channel, int):
+            value = struct.pack(">h", channel)
+            bursts[2 * i::BURST_SIZE] = value[0:1] * count
+            bursts[2 * i + 1::BURST_SIZE] = value[1:2] * count
+            continue
+
+        view = memoryview(channel).cast("B")
+        if len(view) != 2 * count:
+            raise ValueError("channel " + str(i) + " has a different length")
+        bursts[2 * i::BURST_SIZE] = view[high::2]
+        bursts[2 * i + 1::BURST_SIZE] = view[1 - high::2]
+    return bursts
+
+
+# Virtual microsecond clock, also runs the simulated timers
+class VirtualClock:
+
+    # Initialize clock
+    def __init__(self):
+        self.us = 0
+        self.timers = []
+
+    def ticks_us(self):
+        return self.us
+
+    def ticks_ms(self):
+        return self.us // 1000
+
+    def ticks_cpu(self):
+        return self.us
+
+    def ticks_add(self, ticks, delta):
+        return ticks + delta
+
+    def ticks_diff(self, a, b):
+        return a - b
+
+    def sleep(self, seconds):
+        self.advance(int(seconds * 1000000))
+
+    def sleep_ms(self, ms):
+        self.advance(ms * 1000)
+
+    def sleep_us(self, us):
+        self.advance(us)
+
+    # Advance by us, firing every timer that becomes due on the way
+    def advance(self, us):
+        self.advanceTo(self.us + us)
+
+    def advanceTo(self, us):
+        while self.timers:
+            timer = min(self.timers, key=lambda timer: timer.due)
+            if timer.due > us:
+                break
+            self.us = max(self.us, timer.due)
+            timer.fire()
+        if us > self.us:
+            self.us = us
+
+    # Advance to the next timer (machine.idle()), or by 1 us without timers
+    def idle(self):
+        if self.timers:
+            self.advanceTo(min(timer.due for timer in self.timers))
+        else:
+            self.advance(1)
+
+
+# Simulated machine.Pin, keeps its value and the time it was on
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    clock = None
+    pins = {}
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self.level = 1 if pull == Pin.PULL_UP else 0
+        self.changes = 0
+        self.onUs = 0
+        self.since = Pin.clock.us
+        Pin.pins[id] = self
+        if value is not None:
+            self.value(value)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        if value is not None:
+            self.value(value)
+
+    def value(self, level=None):
+        if level is None:
+            return self.level
+
+        level = 1 if level else 0
+        if level != self.level:
+            now = Pin.clock.us
+            if self.level:
+                self.onUs += now - self.since
+            self.since = now
+            self.level = level
+            self.changes += 1
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def high(self):
+        self.value(1)
+
+    def low(self):
+        self.value(0)
+
+    def toggle(self):
+        self.value(not self.level)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING):
+        return None
+
+    # Time the pin was high (us)
+    def onTime(self):
+        return self.onUs + (Pin.clock.us - self.since if self.level else 0)
+
+    def __call__(self, level=None):
+        return self.value(level)
+
+
+# Simulated machine.PWM
+class PWM:
+    def __init__(self, pin, freq=None, duty_u16=None):
+        self.pin = pin
+        self.frequency = freq or 0
+        self.duty = 0
+        self.writes = 0
+        if duty_u16 is not None:
+            self.duty_u16(duty_u16)
+
+    def freq(self, value=None):
+        if value is None:
+            return self.frequency
+        self.frequency = value
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self.duty
+        self.duty = value
+        self.writes += 1
+        self.pin.value(value > 0)
+
+    def deinit(self):
+        self.duty_u16(0)
+
+
+# Simulated machine.SPI, keeps the last transfer
+class SPI:
+    def __init__(self, id, baudrate=1000000, **kwargs):
+        self.id = id
+        self.last = b""
+        self.bytesWritten = 0
+
+    def write(self, buf):
+        self.last = bytes(buf)
+        self.bytesWritten += len(buf)
+
+    def deinit(self):
+        pass
+
+
+# Simulated machine.ADC, the temperature sensor reads 27 C
+class ADC:
+    def __init__(self, channel):
+        self.channel = channel
+
+    def read_u16(self):
+        return int(0.706 / 3.3 * 65535)
+
+
+# Simulated machine.Timer, fired by the virtual clock
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    clock = None
+
+    def __init__(self, id=-1, **kwargs):
+        self.id = id
+        self.callback = None
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode=PERIODIC, freq=None, period=None, callback=None):
+        self.deinit()
+        self.mode = mode
+        self.periodUs = 1000000 // freq if freq else period * 1000
+        self.callback = callback
+        self.due = Timer.clock.us + self.periodUs
+        Timer.clock.timers.append(self)
+
+    def deinit(self):
+        if self in Timer.clock.timers:
+            Timer.clock.timers.remove(self)
+
+    def fire(self):
+        if self.mode == Timer.PERIODIC:
+            self.due += self.periodUs
+        else:
+            self.deinit()
+        self.callback(self)
+
+
+# Simulated neopixel.NeoPixel (same buffer layout as MicroPython's: GRB(W) bytes in buf)
+class NeoPixel:
+    ORDER = (1, 0, 2, 3)
+
+    def __init__(self, pin, n, bpp=3, timing=1):
+        self.pin = pin
+        self.n = n
+        self.bpp = bpp
+        self.buf = bytearray(n * bpp)
+        self.writes = 0
+
+    def __len__(self):
+        return self.n
+
+    def __setitem__(self, i, color):
+        offset = i * self.bpp
+        for c in range(self.bpp):
+            self.buf[offset + self.ORDER[c]] = color[c]
+
+    def __getitem__(self, i):
+        offset = i * self.bpp
+        return tuple(self.buf[offset + self.ORDER[c]] for c in range(self.bpp))
+
+    def fill(self, color):
+        for i in range(self.n):
+            self[i] = color
+
+    def write(self):
+        self.writes += 1
+
+
+"""
+ICM-20948 register model
+
+Serves the accel/gyro/temp burst from a stream of raw bursts: load()
+takes a bytes-like of whole bursts or an iterator of such chunks, so
+a long replay can be generated while it runs. Without a stream (e.g.
+while GMonitor measures the gyro offset at startup) the board lies
+still (REST_BURST). Once a loaded stream is used up, the next burst
+read raises ReplayFinished.
+"""
+class ICM20948Model:
+
+    # Initialize model
+    def __init__(self):
+        self.banks = [bytearray(128) for i in range(4)]
+        self.banks[0][REG_WHO_AM_I] = WHO_AM_I
+        self.bank = 0
+
+        # AK09916: ids, data always ready, a constant field
+        self.mag = bytearray(0x40)
+        self.mag[0] = MAG_WIA1
+        self.mag[1] = MAG_WIA2
+        self.mag[REG_MAG_ST2] = 0x01
+        self.mag[REG_MAG_DATA:REG_MAG_DATA + 6] = struct.pack("<3h", 200, -50, 400)
+
+        self.chunks = None
+        self.chunk = b""
+        self.pos = 0
+        self.bursts = 0
+
+    # Replay a stream of bursts (bytes-like or an iterator of bytes-like chunks)
+    def load(self, bursts):
+        if isinstance(bursts, (bytes, bytearray, memoryview)):
+            bursts = iter((bursts,))
+        self.chunks = bursts
+        self.chunk = b""
+        self.pos = 0
+
+    # Next burst, refilling from the stream
+    def nextBurst(self):
+        if self.chunks is None:
+            return REST_BURST
+
+        while self.pos + BURST_SIZE > len(self.chunk):
+            try:
+                self.chunk = memoryview(next(self.chunks)).cast("B")
+            except StopIteration:
+                self.chunks = None
+                raise ReplayFinished()
+            self.pos = 0
+            if len(self.chunk) % BURST_SIZE:
+                raise ValueError("burst chunk is not a multiple of " + str(BURST_SIZE) + " bytes")
+
+        burst = self.chunk[self.pos:self.pos + BURST_SIZE]
+        self.pos += BURST_SIZE
+        self.bursts += 1
+        return burst
+
+    def read(self, reg, buf):
+        if reg == REG_BANK_SEL:
+            buf[0] = self.bank << 4
+        elif self.bank == 0 and reg == REG_ACCEL_XOUT_H and len(buf) == BURST_SIZE:
+            buf[:] = self.nextBurst()
+        else:
+            regs = self.banks[self.bank]
+            buf[:] = regs[reg:reg + len(buf)]
+
+    def write(self, reg, data):
+        if reg == REG_BANK_SEL:
+            self.bank = (data[0] >> 4) & 3
+            return
+
+        regs = self.banks[self.bank]
+        regs[reg:reg + len(data)] = data
+
+        # Setting I2C_MST_EN runs the enabled secondary transactions
+        if self.bank == 0 and reg == REG_USER_CTRL and data[0] & BIT_I2C_MST_EN:
+            self.secondary()
+
+    # Run SLV0 (read into EXT_SENS_DATA) and SLV1 (single byte write) on the magnetometer
+    def secondary(self):
+        bank3 = self.banks[3]
+        for slave in (REG_SLV0_ADDR, REG_SLV1_ADDR):
+            address, reg, ctrl, out = bank3[slave], bank3[slave + 1], bank3[slave + 2], bank3[slave + 3]
+            if not ctrl & BIT_SLV_EN:
+                continue
+            length = ctrl & 0x0F
+            if address & BIT_SLV_READ:
+                self.banks[0][REG_EXT_SENS_DATA_00:REG_EXT_SENS_DATA_00 + length] = self.mag[reg:reg + length]
+            else:
+                self.mag[reg] = out
+
+
+# Simulated machine.I2C, every instance is the same bus
+class I2C:
+    devices = {}
+
+    def __init__(self, id=0, **kwargs):
+        self.id = id
+
+    def scan(self):
+        return sorted(I2C.devices)
+
+    def device(self, addr):
+        device = I2C.devices.get(addr)
+        if device is None:
+            raise OSError(5) # EIO, no acknowledge
+        return device
+
+    def readfrom_mem(self, addr, reg, nbytes):
+        buf = bytearray(nbytes)
+        self.device(addr).read(reg, buf)
+        return bytes(buf)
+
+    def readfrom_mem_into(self, addr, reg, buf):
+        self.device(addr).read(reg, buf)
+
+    def writeto_mem(self, addr, reg, buf):
+        self.device(addr).write(reg, bytes(buf))
+
+
+# Tuning commands typed at given (virtual) times, replaces CommandChannel
+class ScriptedCommands:
+
+    """
+    Initialize script
+
+    commands: (seconds, line) pairs
+    clock: virtual clock
+    """
+    def __init__(self, commands, clock):
+        self.commands = sorted(commands)
+        self.clock = clock
+
+    def check(self):
+        if self.commands and self.commands[0][0] * 1000000 <= self.clock.us:
+            return self.commands.pop(0)[1]
+        return None
+
+
+# Everything install() set up
+class Simulation:
+
+    def __init__(self, clock, imu):
+        self.clock = clock
+        self.imu = imu
+
+simulation = None
+
+"""
+Install the simulated hardware
+
+Must run before the monitor's modules are imported. Returns the
+Simulation (clock and IMU model), the same one on every call.
+"""
+def install():
+    global simulation
+
+    if simulation is not None:
+        return simulation
+    for name in ("GMonitor", "icm20948", "Scheduler", "temperature"):
+        if name in sys.modules:
+            raise RuntimeError("install() must run before " + name + " is imported")
+
+    # Reference kernels: the viper annotations do not exist on CPython
+    import Kernels
+
+    clock = VirtualClock()
+    Pin.clock = clock
+    Timer.clock = clock
+
+    imu = ICM20948Model()
+    I2C.devices[IMU_ADDRESS] = imu
+
+    machine = types.ModuleType("machine")
+    for obj in (Pin, PWM, SPI, ADC, Timer, I2C):
+        setattr(machine, obj.__name__, obj)
+    machine.idle = clock.idle
+    machine.freq = lambda hz=None: 125000000
+    machine.unique_id = lambda: b"\xe6\x60\x58\x38\x83\x00\x00\x01"
+    machine.reset = machine.soft_reset = lambda: None
+    sys.modules["machine"] = machine
+
+    micropython = types.ModuleType("micropython")
+    micropython.const = lambda value: value
+    micropython.native = micropython.viper = micropython.bytecode = lambda f: f
+    micropython.schedule = lambda func, arg: func(arg)
+    micropython.mem_info = lambda verbose=None: print("heap not simulated")
+    micropython.alloc_emergency_exception_buf = lambda size: None
+    sys.modules["micropython"] = micropython
+
+    neopixel = types.ModuleType("neopixel")
+    neopixel.NeoPixel = NeoPixel
+    sys.modules["neopixel"] = neopixel
+
+    for name in ("ticks_us", "ticks_ms", "ticks_cpu", "ticks_add", "ticks_diff", "sleep", "sleep_ms", "sleep_us"):
+        setattr(time, name, getattr(clock, name))
+
+    import gc
+    gc.mem_free = lambda: HEAP_FREE
+    gc.mem_alloc = lambda: HEAP_ALLOC
+
+    # Deadline scheduling jumps the clock instead of spinning on it
+    import Scheduler
+
+    RateScheduler = Scheduler.RateScheduler
+
+    class VirtualScheduler(RateScheduler):
+        def wait(self):
+            clock.advanceTo(self.deadline)
+            return RateScheduler.wait(self)
+
+    Scheduler.RateScheduler = VirtualScheduler
+
+    simulation = Simulation(clock, imu)
+    return simulation
+
+"""
+Replay IMU bursts through GMonitor
+
+bursts: bytes-like of bursts or an iterator of chunks (packBursts())
+rateHz: sample rate of the bursts, the monitor's poll rate is set to it
+commands: (seconds, line) tuning commands, e.g. (0, "set mode race")
+log: run the data logger during the replay
+report: print the LED report and the monitor's system information
+setup: called with the GMonitor before the replay starts (e.g. to
+       record its spin warnings)
+Returns the GMonitor after the bursts ran out.
+"""
+def replay(bursts, rateHz=1000, commands=(), log=False, report=True, setup=None):
+    sim = install()
+    from GMonitor import GMonitor
+
+    monitor = GMonitor()
+    monitor.commands = ScriptedCommands(commands, sim.clock)
+    if rateHz != monitor.pollRateHz:
+        monitor.setPollRateHz(rateHz)
+    if log:
+        monitor.enableLogger = True
+        monitor.logger.start()
+    if setup is not None:
+        setup(monitor)
+
+    sim.imu.load(bursts)
+    first = sim.imu.bursts
+    startUs = sim.clock.us
+    start = time.perf_counter()
+    try:
+        monitor.monitor()
+    except ReplayFinished:
+        pass
+    elapsed = time.perf_counter() - start
+
+    samples = sim.imu.bursts - first
+    seconds = (sim.clock.us - startUs) / 1000000
+    monitor.cleanup()
+
+    if report:
+        print("\nReplayed %d samples (%.1f s) in %.1f s, %.0fx real time" % (samples, seconds, elapsed,
+            seconds / elapsed if elapsed > 0 else 0))
+        for name in sorted(monitor.lightPins):
+            pin = Pin.pins.get(monitor.lightPins[name])
+            if pin is not None and seconds > 0:
+                print("  LED %-6s on %5.1f%%, %6d changes" % (name, pin.onTime() / 10000 / seconds, pin.changes))
+        monitor.printInfo()
+    return monitor
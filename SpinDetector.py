@@ -0,0 +1,233 @@
+"""
+This file contains a yaw-rate based spin-out (oversteer)
+detector for GMonitor.
+
+While the tires are gripping, the yaw rate measured by the gyro
+matches the yaw rate implied by the lateral acceleration and the
+vehicle's speed (r = a_lat / v). When the rear steps out the car
+rotates faster than its lateral acceleration can explain, so a
+sustained divergence between the two is flagged as a spin.
+
+Speed is not measured directly. It is estimated by integrating
+longitudinal acceleration and is continuously corrected while
+cornering with grip (v = a_lat / r).
+
+Every update is a fixed number of integer operations on raw IMU
+samples, so it can be called from the 1kHz monitor loop without
+boxing a float. Speed is the running sum of raw longitudinal
+samples; the yaw rate implied by the lateral acceleration is
+computed in gyro LSB by one multiply and one divide with the speed
+shifted down by SPEED_SHIFT, and all thresholds are converted to
+the same units once.
+
+kward
+"""
+import math
+
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    # CPython fallback for running the replay benchmark on a host
+    from time import perf_counter
+
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+GRAVITY = 9.80665 # m/s^2 per g
+ACCEL_LSB_PER_G = 16384 # ICM-20948 at +-2g full scale
+GYRO_LSB_PER_DPS = 32.8 # ICM-20948 at +-1000 dps full scale
+
+# Speed bits dropped before it divides a lateral acceleration, keeps products small ints
+SPEED_SHIFT = 12
+
+# Speed estimates are clamped to this (m/s), so the speed sum stays a small int
+MAX_SPEED = 100.0
+
+# Weight of the cornering speed estimate in the complementary filter (1 / 2**SPEED_GAIN_SHIFT)
+SPEED_GAIN_SHIFT = 9
+
+# Main class
+class SpinDetector:
+
+    """
+    Initialize detector
+
+    sampleRateHz: rate at which update() is called
+    yawThreshold: excess yaw rate (deg/s) considered a divergence
+    holdMs: how long the divergence must last before a spin is flagged
+    minSpeed: speed (m/s) below which the detector is disabled
+    """
+    def __init__(self, sampleRateHz=1000, yawThreshold=15.0, holdMs=15, minSpeed=5.0):
+        # Speed (m/s) of one unit of the speed sum: one raw longitudinal LSB over one sample
+        self.speedUnit = GRAVITY / ACCEL_LSB_PER_G / sampleRateHz
+
+        # Precompute thresholds in raw units
+        self.yawThreshold = int(yawThreshold * GYRO_LSB_PER_DPS) # Gyro LSB
+        self.minYawRate = int(3.0 * GYRO_LSB_PER_DPS) # Minimum yaw rate to correct speed with
+        self.minSpeed = max(1 << SPEED_SHIFT, int(minSpeed / self.speedUnit))
+        self.maxSpeed = int(MAX_SPEED / self.speedUnit)
+
+        # Yaw rate (gyro LSB) = latToYaw * lateral LSB // (speed sum >> SPEED_SHIFT), i.e. r = a / v
+        self.latToYaw = int(GRAVITY / ACCEL_LSB_PER_G / (self.speedUnit * (1 << SPEED_SHIFT)) * 180 / math.pi * GYRO_LSB_PER_DPS + 0.5)
+
+        # Number of consecutive divergent samples to flag a spin
+        self.holdSamples = max(1, int(holdMs * sampleRateHz / 1000))
+
+        self.reset()
+
+    # Clear all state (e.g. when the vehicle is stopped)
+    def reset(self):
+        self.speed = 0 # Estimated speed (sum of raw longitudinal samples, see getSpeed())
+        self.yawRate = 0 # Last measured yaw rate (gyro LSB)
+        self.expectedYawRate = 0 # Yaw rate implied by lateral acceleration (gyro LSB)
+        self.count = 0 # Consecutive divergent samples
+        self.spinning = False
+
+    # Set the speed estimate directly (m/s, e.g. from an external source)
+    def setSpeed(self, speed):
+        self.speed = min(self.maxSpeed, int(speed / self.speedUnit))
+
+    # Estimated speed (m/s)
+    def getSpeed(self):
+        return self.speed * self.speedUnit
+
+    """
+    Process one sample and return True while a spin is detected
+
+    gyroZ: raw yaw rate from the IMU (LSB)
+    ax: raw lateral acceleration (LSB)
+    ay: raw longitudinal acceleration (LSB)
+    """
+    def update(self, gyroZ, ax, ay):
+        r = abs(gyroZ)
+        aLat = abs(ax)
+
+        # Integrate longitudinal acceleration
+        v = self.speed + ay
+        if v < 0:
+            v = 0
+        elif v > self.maxSpeed:
+            v = self.maxSpeed
+
+        self.yawRate = r
+
+        # Too slow to tell a spin from a parking lot turn
+        if v < self.minSpeed:
+            self.speed = v
+            self.expectedYawRate = 0
+            self.count = 0
+            self.spinning = False
+            return False
+
+        expected = self.latToYaw * aLat // (v >> SPEED_SHIFT)
+        self.expectedYawRate = expected
+
+        if r - expected > self.yawThreshold:
+            # Rotating faster than the lateral force explains
+            if self.count < self.holdSamples:
+                self.count += 1
+        else:
+            if self.count > 0:
+                self.count -= 1
+
+            # Gripping while cornering, correct speed drift towards v = a / r
+            if r > self.minYawRate and not self.spinning:
+                target = self.latToYaw * aLat // r
+                if target > self.maxSpeed >> SPEED_SHIFT:
+                    target = self.maxSpeed >> SPEED_SHIFT
+                v += ((target << SPEED_SHIFT) - v) >> SPEED_GAIN_SHIFT
+
+        self.speed = v
+
+        # Flag after holdSamples of divergence, release once fully recovered
+        if self.count >= self.holdSamples:
+            self.spinning = True
+        elif self.count == 0:
+            self.spinning = False
+
+        return self.spinning
+
+
+"""
+Replay benchmark
+
+Generates synthetic traces at the detector's sample rate and
+reports the detection latency and the cost of each update.
+"""
+
+# Build a synthetic trace of raw (gyroZ, ax, ay) samples and the spin onset index
+def spinTrace(sampleRateHz, cornerG, spinRate, spin=True):
+    dt = 1 / sampleRateHz
+    trace = []
+    v = 0.0
+
+    # Accelerate in a straight line for 5 s
+    for i in range(5 * sampleRateHz):
+        trace.append((0, 0, int(0.3 * ACCEL_LSB_PER_G)))
+        v += 0.3 * GRAVITY * dt
+
+    # Steady corner with grip for 2 s
+    r = cornerG * GRAVITY / v
+    gyroZ = int(r * 180 / math.pi * GYRO_LSB_PER_DPS)
+    for i in range(2 * sampleRateHz):
+        trace.append((gyroZ, int(cornerG * ACCEL_LSB_PER_G), 0))
+
+    onset = len(trace)
+
+    # Rear steps out: yaw rate ramps up over 100 ms while grip falls away
+    for i in range(sampleRateHz):
+        k = min(1.0, i / (0.1 * sampleRateHz)) if spin else 0.0
+        yaw = r + k * spinRate * math.pi / 180
+        lat = cornerG * (1 - 0.5 * k)
+        trace.append((int(yaw * 180 / math.pi * GYRO_LSB_PER_DPS), int(lat * ACCEL_LSB_PER_G), int(-0.2 * k * ACCEL_LSB_PER_G)))
+
+    return trace, onset
+
+# Replay a trace and return (first detection index or -1, worst update time in us)
+def replay(detector, trace):
+    detected = -1
+    worst = 0
+
+    for i in range(len(trace)):
+        sample = trace[i]
+        start = ticks_us()
+        spinning = detector.update(sample[0], sample[1], sample[2])
+        elapsed = ticks_diff(ticks_us(), start)
+
+        if elapsed > worst:
+            worst = elapsed
+        if spinning and detected < 0:
+            detected = i
+
+    return detected, worst
+
+def main():
+    sampleRateHz = 1000
+
+    print("\nSpin detector replay benchmark")
+    print("=======================================")
+
+    for cornerG, spinRate in ((0.4, 45), (0.6, 60), (0.8, 90)):
+        detector = SpinDetector(sampleRateHz)
+        trace, onset = spinTrace(sampleRateHz, cornerG, spinRate)
+        detected, worst = replay(detector, trace)
+
+        if detected < 0:
+            print("%.1fg corner, %d deg/s spin: NOT DETECTED" % (cornerG, spinRate))
+        elif detected < onset:
+            print("%.1fg corner, %d deg/s spin: FALSE POSITIVE at %d ms" % (cornerG, spinRate, detected))
+        else:
+            latency = (detected - onset) * 1000 / sampleRateHz
+            print("%.1fg corner, %d deg/s spin: detected in %d ms (worst update %d us)" % (cornerG, spinRate, latency, worst))
+
+    # Gripping corner must never be flagged
+    detector = SpinDetector(sampleRateHz)
+    trace, onset = spinTrace(sampleRateHz, 0.8, 0, spin=False)
+    detected, worst = replay(detector, trace)
+    print("0.8g corner, no spin: " + ("FALSE POSITIVE" if detected >= 0 else "no detection"))
+
+if __name__ == "__main__":
+    main()
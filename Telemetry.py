@@ -0,0 +1,169 @@
+"""
+This file contains the live telemetry stream of GMonitor.
+
+With telemetryRateHz set (e.g. "set telemetryRateHz 1000" over the
+USB REPL), every sample is decimated to that rate and written to USB
+as a binary frame, so a computer can record several monitors live
+(see TelemetryIngest.py). The frame buffer is preallocated and the
+checksum is computed by a viper kernel, so streaming does not
+allocate.
+
+Frame layout (FRAME_FORMAT, little endian, FRAME_SIZE bytes):
+    sync        FRAME_SYNC (0xA5 0x5A)
+    sequence    frame counter mod 256, gaps are lost frames
+    record      same fields as a DataLogger record: time (ms since
+                the stream started), ax, ay, az, gx, gy, gz, mx, my,
+                mz (raw LSB), ride mode index, flags
+    checksum    Fletcher-16 of the sequence and record bytes
+
+Command replies and other prints share the USB serial with the
+frames. The decoder at the end of this file resynchronizes on the
+sync bytes and checksum, and hands the text in between back as
+lines. It only needs struct, so it also runs on the host.
+
+kward
+"""
+import struct
+import sys
+from DataLogger import RECORD_FORMAT
+from Kernels import frameChecksum, frameChecksumPy
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    # CPython fallback for running on a host
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+FRAME_SYNC = b"\xa5\x5a"
+FRAME_FORMAT = "<2sB" + RECORD_FORMAT[1:] + "H"
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+CHECK_OFFSET = FRAME_SIZE - 2 # Checksum covers bytes 2 to CHECK_OFFSET
+
+MAX_TEXT = 1024 # Text kept by the decoder while waiting for the end of a line
+
+# Main class
+class TelemetryStream:
+
+    # Initialize stream
+    def __init__(self):
+        self.frame = bytearray(FRAME_SIZE)
+        self.seq = 0
+        self.startMs = ticks_ms()
+        self.sent = 0
+
+        # Binary stdout where the port has one
+        try:
+            self.out = sys.stdout.buffer
+        except AttributeError:
+            self.out = sys.stdout
+
+    # Restart the sequence and time base
+    def start(self):
+        self.seq = 0
+        self.sent = 0
+        self.startMs = ticks_ms()
+
+    """
+    Send one frame
+
+    values: ax, ay, az, gx, gy, gz (raw LSB)
+    mag: mx, my, mz (raw LSB)
+    modeIdx: index of the current ride mode
+    flags: FLAG_* bits of DataLogger.py
+    """
+    def send(self, values, mag, modeIdx, flags=0):
+        frame = self.frame
+        struct.pack_into(FRAME_FORMAT, frame, 0, FRAME_SYNC, self.seq, ticks_diff(ticks_ms(), self.startMs),
+            values[0], values[1], values[2], values[3], values[4], values[5],
+            int(mag[0]), int(mag[1]), int(mag[2]), modeIdx, flags, 0)
+        struct.pack_into("<H", frame, CHECK_OFFSET, frameChecksum(frame, 2, CHECK_OFFSET))
+
+        self.out.write(frame)
+        self.seq = (self.seq + 1) & 0xFF
+        self.sent += 1
+
+
+"""
+Host side stream decoder
+
+feed() takes the bytes read from the serial port in any chunking and
+returns the complete frames as tuples (sequence, time ms, ax, ay, az,
+gx, gy, gz, mx, my, mz, mode, flags). A sync pattern whose checksum
+fails is skipped one byte at a time, so frames are found again after
+garbage or text.
+"""
+class FrameDecoder:
+
+    # Initialize decoder
+    def __init__(self):
+        self.buffer = bytearray()
+        self.text = bytearray()
+        self.record = struct.Struct(FRAME_FORMAT)
+        self.lastSeq = -1
+
+        self.frames = 0
+        self.lost = 0
+        self.badChecksums = 0
+
+    # Decode the frames completed by data
+    def feed(self, data):
+        buf = self.buffer
+        buf += data
+        unpack = self.record.unpack_from
+        frames = []
+
+        pos = 0
+        end = len(buf)
+        while True:
+            start = buf.find(FRAME_SYNC, pos)
+            if start < 0:
+                # Keep a trailing first sync byte, it may start a frame
+                keep = end - 1 if end > pos and buf[end - 1] == FRAME_SYNC[0] else end
+                self.text += buf[pos:keep]
+                pos = keep
+                break
+            if start + FRAME_SIZE > end:
+                self.text += buf[pos:start]
+                pos = start
+                break
+
+            frame = unpack(buf, start)
+            if frameChecksumPy(buf, start + 2, start + CHECK_OFFSET) != frame[-1]:
+                # Not a frame (or a damaged one), look for the next sync
+                self.badChecksums += 1
+                self.text += buf[pos:start + 1]
+                pos = start + 1
+                continue
+
+            self.text += buf[pos:start]
+            pos = start + FRAME_SIZE
+
+            seq = frame[1]
+            if self.lastSeq >= 0:
+                self.lost += (seq - self.lastSeq - 1) & 0xFF
+            self.lastSeq = seq
+            frames.append(frame[1:-1])
+
+        del buf[:pos]
+        if len(self.text) > MAX_TEXT:
+            del self.text[:-MAX_TEXT]
+
+        self.frames += len(frames)
+        return frames
+
+    # Complete lines of text received between frames
+    def lines(self):
+        text = self.text
+        end = text.rfind(b"\n")
+        if end < 0:
+            return []
+
+        lines = bytes(text[:end]).decode("utf-8", "replace").split("\n")
+        del text[:end + 1]
+        return [line.rstrip("\r") for line in lines if line.strip()]
@@ -0,0 +1,229 @@
+"""
+This file records the live telemetry of several GMonitors at once (run
+on a computer).
+
+A thread per serial port (serial.threaded.ReaderThread) costs CPU in
+context switches and interleaves the output of the boards. Here a
+single asyncio loop serves every board:
+
+    - Each port is opened non-blocking and its file descriptor is
+      watched with loop.add_reader, so a board only costs a callback
+      when it has sent data, which is read in bulk
+    - The bytes are cut into frames by Telemetry.FrameDecoder, and the
+      frames of one read are queued as one batch
+    - Every board has its own bounded queue and consumer task, so the
+      frames of a board stay in order. When a consumer falls behind and
+      its queue is full, reading that port is paused until the queue
+      has drained to a quarter. The kernel and USB buffers then fill
+      and the board slows down, instead of the host buffering without
+      bound
+    - Once a second, the frame rate, lost frames and pauses of each
+      board and the CPU use of the process are printed
+
+Usage:
+    python TelemetryIngest.py                          All MicroPython boards found
+    python TelemetryIngest.py /dev/ttyACM0 /dev/ttyACM1 -r 1000
+    python TelemetryIngest.py -r 1000 -o telemetry     Also write one CSV per board
+    python TelemetryIngest.py -r 1000 -o telemetry -s  Add a session to a store per board instead (SessionStore.py)
+
+-r sets telemetryRateHz on the boards (and turns it off again on exit).
+pyserial is needed, rshell to find the boards automatically.
+
+kward
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from SessionStore import SessionStore
+from Telemetry import FrameDecoder
+
+READ_SIZE = 4096 # Bytes read per callback at most
+QUEUE_BATCHES = 64 # Batches of frames queued per board before reading is paused
+
+CSV_HEADER = "seq,time_ms,ax,ay,az,gx,gy,gz,mx,my,mz,mode,flags\n"
+
+# One board, read from the event loop
+class DeviceStream:
+
+    """
+    Initialize stream
+
+    port: serial port of the board
+    maxBatches: batches of frames queued before reading is paused
+    """
+    def __init__(self, port, maxBatches=QUEUE_BATCHES):
+        from serial.serialposix import Serial
+
+        self.port = port
+        self.serial = Serial(port, timeout=0) # Reads return what is there
+        self.loop = asyncio.get_event_loop()
+        # Bounded by pausing the reader at maxBatches, so the end marker always fits
+        self.queue = asyncio.Queue()
+        self.maxBatches = maxBatches
+        self.resumeBatches = maxBatches // 4
+        self.decoder = FrameDecoder()
+
+        self.reading = False
+        self.pauses = 0
+
+    # Start reading in the event loop
+    def start(self):
+        self.loop.add_reader(self.serial.fileno(), self.readable)
+        self.reading = True
+
+    # Stop reading, the queue holds its frames until they are consumed
+    def pause(self):
+        if self.reading:
+            self.loop.remove_reader(self.serial.fileno())
+            self.reading = False
+
+    # Send a command line to the board
+    def send(self, line):
+        self.serial.write((line + "\r").encode())
+
+    # Stop reading and close the port, ends batches()
+    def close(self):
+        self.pause()
+        self.serial.close()
+        self.queue.put_nowait(None)
+
+    # Reader callback, decodes everything the board sent so far
+    def readable(self):
+        try:
+            data = self.serial.read(READ_SIZE)
+        except Exception as e:
+            print("%s: %s" % (self.port, e))
+            self.pause()
+            self.queue.put_nowait(None)
+            return
+
+        frames = self.decoder.feed(data)
+        for line in self.decoder.lines():
+            print("%s: %s" % (self.port, line))
+
+        if frames:
+            self.queue.put_nowait(frames)
+            if self.queue.qsize() >= self.maxBatches:
+                # Backpressure, resumed by batches()
+                self.pause()
+                self.pauses += 1
+
+    # Async iterator over the batches of frames, in order
+    async def batches(self):
+        while True:
+            batch = await self.queue.get()
+            if batch is None:
+                return
+
+            if not self.reading and self.serial.is_open and self.queue.qsize() <= self.resumeBatches:
+                self.start()
+            yield batch
+
+
+"""
+Consume the frames of one board
+
+outDir: directory to write them to (None to only count them)
+rateHz: telemetry rate, stored with the session
+store: add them as a session to the session store outDir/<port>
+       instead of writing a CSV
+"""
+async def consume(stream, outDir=None, rateHz=None, store=False):
+    out = None
+    if outDir is not None and store:
+        out = SessionStore(os.path.join(outDir, os.path.basename(stream.port)), "a")
+        out.beginSession(rateHz or 0)
+    elif outDir is not None:
+        os.makedirs(outDir, exist_ok=True)
+        name = os.path.basename(stream.port) + time.strftime("_%Y%m%d_%H%M%S.csv")
+        out = open(os.path.join(outDir, name), "w")
+        out.write(CSV_HEADER)
+
+    try:
+        async for batch in stream.batches():
+            if store and out is not None:
+                # Without the sequence number
+                out.appendRows([frame[1:] for frame in batch])
+            elif out is not None:
+                out.write("".join(",".join(map(str, frame)) + "\n" for frame in batch))
+    finally:
+        if out is not None:
+            out.close()
+
+# Print the frame rate of every board and the CPU use of the process once a second
+async def report(streams, interval=1.0):
+    counts = [stream.decoder.frames for stream in streams]
+    cpu = time.process_time()
+    wall = time.time()
+    while True:
+        await asyncio.sleep(interval)
+
+        now = time.time()
+        cpuNow = time.process_time()
+        elapsed = now - wall
+        line = []
+        for i, stream in enumerate(streams):
+            decoder = stream.decoder
+            line.append("%s %5.0f/s lost %d bad %d paused %d" % (os.path.basename(stream.port),
+                (decoder.frames - counts[i]) / elapsed, decoder.lost, decoder.badChecksums, stream.pauses))
+            counts[i] = decoder.frames
+        print("  ".join(line) + "  cpu %.1f%%" % (100 * (cpuNow - cpu) / elapsed))
+        cpu = cpuNow
+        wall = now
+
+# Serial ports of all MicroPython boards plugged in
+def findPorts():
+    import serial.tools.list_ports
+    from rshell.main import is_micropython_usb_device
+
+    return [port[0] for port in serial.tools.list_ports.comports() if is_micropython_usb_device(port)]
+
+async def ingest(ports, rateHz=None, outDir=None, store=False):
+    streams = [DeviceStream(port) for port in ports]
+    for stream in streams:
+        stream.start()
+        if rateHz is not None:
+            stream.send("set telemetryRateHz %d" % rateHz)
+
+    reporter = asyncio.ensure_future(report(streams))
+    try:
+        await asyncio.gather(*(consume(stream, outDir, rateHz, store) for stream in streams))
+    finally:
+        reporter.cancel()
+        for stream in streams:
+            if rateHz is not None and stream.serial.is_open:
+                stream.send("set telemetryRateHz 0")
+            stream.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Record the live telemetry of several GMonitors")
+    parser.add_argument("ports", nargs="*", help="serial ports (default: all MicroPython boards)")
+    parser.add_argument("-r", "--rate", type=int, help="set telemetryRateHz on the boards")
+    parser.add_argument("-o", "--out", help="write the frames of each board to a CSV in this directory")
+    parser.add_argument("-s", "--store", action="store_true", help="write a session store per board into the -o directory instead")
+    args = parser.parse_args()
+
+    if args.store and args.out is None:
+        parser.error("--store needs --out")
+
+    ports = args.ports or findPorts()
+    if not ports:
+        parser.error("no boards found")
+
+    loop = asyncio.get_event_loop()
+    task = asyncio.ensure_future(ingest(ports, args.rate, args.out, args.store))
+    try:
+        loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+    finally:
+        loop.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,716 @@
+"""
+This file generates synthetic IMU traces for load and regression
+testing of GMonitor (run on a computer).
+
+A scenario is a list of events (straights, braking zones, corners,
+curbs and spins), each with a severity from 0 to 1. It is driven
+through:
+
+    - A bicycle model of the car: speed, sideslip and yaw rate, with
+      front and rear tire forces saturating at the friction limit,
+      run at PHYSICS_HZ. A corner steers for a lateral acceleration
+      of severity times the grip. A spin takes rear grip away under
+      power, so the car yaws faster than its lateral force explains,
+      then slides to a stop
+    - Pitch and roll rates from the body pitch and roll that follow
+      the longitudinal and lateral acceleration
+    - A noise and vibration model at the output rate: white sensor
+      noise and engine vibration from a precomputed ring per channel,
+      and curb ridges struck at the car's speed
+
+The physics samples are upsampled to the output rate with one
+strided slice per phase, the ring is added in C (map, or NumPy when
+installed, both give identical counts) and the channels are packed
+into the 14 byte bursts GyroAccelRead() reads (Simulator.packBursts()),
+one chunk per event. Chunks can be replayed through GMonitor on the
+simulated I2C bus, or written directly as DataLogger segments with
+FLAG_SPIN set on every sample of a spin, to check the detector
+against.
+
+Values are raw ICM-20948 counts in the monitor's axes: ax positive =
+left, ay positive = forward, az = vertical including gravity, gx
+pitch, gy roll and gz yaw rate (positive = turning left).
+
+Usage:
+    python TraceGenerator.py                        Print the scenario of one lap
+    python TraceGenerator.py --replay -s 0.8        Replay 5 laps through GMonitor and check the spin warnings
+    python TraceGenerator.py -o logs -n 600         Write 10 minutes of random events as log segments
+    python TraceGenerator.py -b                     Benchmark an hour at 1 kHz and check the decode paths
+
+kward
+"""
+import argparse
+import math
+import os
+import random
+import struct
+import sys
+import time
+from array import array
+from binascii import crc32
+from operator import add
+
+from DataLogger import (BLOCK_FORMAT, BLOCK_RECORDS, FILE_MAGIC, FILE_VERSION, FLAG_SPIN, HEADER_FORMAT,
+    RECORD_SIZE, SEGMENT_BLOCKS, segmentName)
+from Simulator import packBursts
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+GRAVITY = 9.80665 # m/s^2 per g
+ACCEL_LSB_PER_G = 16384 # ICM-20948 at +-2g full scale
+GYRO_LSB_PER_DPS = 32.8 # ICM-20948 at +-1000 dps full scale
+DEG_PER_RAD = 180 / math.pi
+TEMP_RAW = 3005 # TEMP_OUT of 30 C
+MAG_RAW = (200, -50, 400) # Constant field written to the log
+
+PHYSICS_HZ = 100 # Rate of the vehicle model (at most)
+RING_SIZE = 65536 # Samples of noise and vibration per channel before they repeat
+
+# Event kinds
+STRAIGHT = "straight" # Full power
+BRAKE = "brake"
+CORNER = "corner"
+CURB = "curb" # Corner with the inside wheels over the curb
+SPIN = "spin" # Corner, then the rear lets go
+
+# Vehicle limits at severity 1
+ACCEL_G = 0.5
+BRAKE_G = 1.1
+MAX_SPEED = 60.0 # m/s
+MIN_SPEED = 6.0 # m/s, kept above SpinDetector's minSpeed, also the speed at the start
+MIN_RADIUS = 15.0 # m, tightest corner, limits the lateral acceleration at low speed
+
+# Curbs: ridge spacing (m), vertical and lateral peak (g) at severity 1
+CURB_SPACING = 0.6
+CURB_VERT_G = 1.2
+CURB_LAT_G = 0.1
+
+# Spins: lead-in corner (s), rear grip left as a fraction of what the corner needs, slide (s)
+SPIN_LEAD = 0.8
+SPIN_GRIP = 0.3
+SPIN_SLIDE = 0.4
+SPIN_MIN = SPIN_LEAD + SPIN_SLIDE + 0.5 # Shortest spin (s)
+
+# Sensor noise (LSB rms, about the datasheet's noise density at 1 kHz) and engine vibration
+ACCEL_NOISE = 120
+GYRO_NOISE = 16
+ENGINE_HZ = 47
+ENGINE_G = (0.03, 0.05, 0.12) # ax, ay, az
+
+# Body roll and pitch (rad per g) and their lag (s)
+ROLL_PER_G = 0.06
+PITCH_PER_G = 0.03
+BODY_LAG = 0.12
+
+# Single track (bicycle) model of the car, y and yaw positive to the left
+class BicycleModel:
+
+    """
+    Initialize model
+
+    mass: kg, yawInertia: kg m^2
+    frontAxle, rearAxle: distance of the axles from the center of gravity (m)
+    frontStiffness, rearStiffness: cornering stiffness of an axle (N/rad)
+    mu: friction coefficient
+    """
+    def __init__(self, mass=1200.0, yawInertia=1800.0, frontAxle=1.1, rearAxle=1.5,
+            frontStiffness=80000.0, rearStiffness=90000.0, mu=1.0):
+        self.mass = mass
+        self.yawInertia = yawInertia
+        self.frontAxle = frontAxle
+        self.rearAxle = rearAxle
+        self.frontStiffness = frontStiffness
+        self.rearStiffness = rearStiffness
+        self.mu = mu
+
+        wheelbase = frontAxle + rearAxle
+        self.wheelbase = wheelbase
+
+        # Grip of each axle from its static load (N)
+        self.frontLimit = mu * mass * GRAVITY * rearAxle / wheelbase
+        self.rearLimit = mu * mass * GRAVITY * frontAxle / wheelbase
+
+        # Understeer gradient (rad per m/s^2)
+        self.understeer = mass / wheelbase * (rearAxle / frontStiffness - frontAxle / rearStiffness)
+
+        self.reset()
+
+    def reset(self, speed=MIN_SPEED):
+        self.speed = speed # m/s
+        self.slip = 0.0 # Sideslip angle (rad)
+        self.yawRate = 0.0 # rad/s
+        self.latAccel = 0.0 # m/s^2
+
+    # Steering angle (rad) of a steady corner at latAccel (m/s^2) at the current speed
+    def steadySteer(self, latAccel):
+        v = self.speed
+        return (self.wheelbase / (v * v) + self.understeer) * latAccel
+
+    """
+    Advance by dt seconds
+
+    steer: steering angle (rad, positive = left)
+    longAccel: longitudinal acceleration (m/s^2)
+    rearGrip: fraction of the rear axle's grip available
+    Returns the lateral acceleration (m/s^2, positive = left).
+    """
+    def step(self, dt, steer, longAccel, rearGrip=1.0):
+        v = self.speed
+        r = self.yawRate
+
+        # Slip angles and saturating tire forces
+        frontAngle = self.slip + self.frontAxle * r / v - steer
+        rearAngle = self.slip - self.rearAxle * r / v
+        frontLimit = self.frontLimit
+        rearLimit = self.rearLimit * rearGrip
+        front = -frontLimit * math.tanh(self.frontStiffness * frontAngle / frontLimit)
+        rear = -rearLimit * math.tanh(self.rearStiffness * rearAngle / rearLimit)
+
+        # Semi-implicit Euler: the new yaw rate is used for the sideslip
+        latAccel = (front + rear) / self.mass
+        r += (self.frontAxle * front - self.rearAxle * rear) / self.yawInertia * dt
+        self.slip += (latAccel / v - r) * dt
+        self.yawRate = r
+        self.speed = max(MIN_SPEED, v + longAccel * dt)
+        self.latAccel = latAccel
+        return latAccel
+
+
+# Main class
+class TraceGenerator:
+
+    """
+    Initialize generator
+
+    rateHz: output rate (the monitor's poll rate)
+    noise: sensor noise, 1 = datasheet
+    vibration: engine vibration, 1 = a running engine on its mounts
+    seed: seed of the noise rings
+    model: BicycleModel (a default car if None)
+    """
+    def __init__(self, rateHz=1000, noise=1.0, vibration=1.0, seed=1, model=None):
+        self.rateHz = rateHz
+        self.factor = max(1, rateHz // PHYSICS_HZ) # Output samples per physics step
+        self.dt = self.factor / rateHz
+        self.model = model if model is not None else BicycleModel()
+
+        self.roll = 0.0
+        self.pitch = 0.0
+        self.samples = 0 # Output samples generated so far
+        self.spins = [] # (first, end) samples of every spin
+
+        # Physics sample before the next event, per channel
+        self.last = [0.0, 0.0, float(ACCEL_LSB_PER_G), 0.0, 0.0, 0.0]
+
+        self.rings, self.margins = buildRings(rateHz, noise, vibration, seed)
+        self.ringPos = 0
+
+    """
+    Generate one event
+
+    kind: STRAIGHT, BRAKE, CORNER, CURB or SPIN
+    seconds: duration (at least SPIN_MIN for a spin)
+    severity: 0 - 1 of the car's limits
+    direction: 1 = left, -1 = right (corners, curbs and spins)
+    Returns ([ax, ay, az, gx, gy, gz] int16 arrays, flags) where flags
+    is FLAG_SPIN or 0 for each sample, as a bytes-like.
+    """
+    def event(self, kind, seconds, severity=0.5, direction=1):
+        model = self.model
+        dt = self.dt
+        if kind == SPIN:
+            seconds = max(seconds, SPIN_MIN)
+        steps = max(1, int(round(seconds / dt)))
+        severity = min(1.0, max(0.0, severity))
+        accelScale = ACCEL_LSB_PER_G / GRAVITY
+        gyroScale = GYRO_LSB_PER_DPS * DEG_PER_RAD
+        rollGain = ROLL_PER_G / GRAVITY
+        pitchGain = PITCH_PER_G / GRAVITY
+        body = dt / BODY_LAG
+
+        # Driver inputs
+        longAccel = 0.0
+        targetLat = 0.0
+        if kind == STRAIGHT:
+            longAccel = ACCEL_G * GRAVITY * max(severity, 0.2)
+        elif kind == BRAKE:
+            longAccel = -BRAKE_G * GRAVITY * max(severity, 0.2)
+        elif kind in (CORNER, CURB, SPIN):
+            targetLat = direction * severity * model.mu * GRAVITY * 0.95
+        else:
+            raise ValueError("Error in event(): unknown event " + str(kind))
+
+        # Spin phases (steps): grip loss, then sliding to a stop
+        onset = min(steps, int(SPIN_LEAD / dt)) if kind == SPIN else steps
+        slide = max(onset, steps - int(SPIN_SLIDE / dt)) if kind == SPIN else steps
+        rampSteps = max(1, int(0.4 / dt))
+
+        lat = [0.0] * steps
+        lon = [0.0] * steps
+        pitchRate = [0.0] * steps
+        rollRate = [0.0] * steps
+        yaw = [0.0] * steps
+        for i in range(steps):
+            speed = model.speed
+            accel = longAccel
+            if kind == STRAIGHT:
+                accel = longAccel * (1 - model.speed / MAX_SPEED)
+
+            if i < slide:
+                # Turn in over rampSteps, unwind over the last rampSteps of a corner
+                ramp = min(1.0, (i + 1) / rampSteps)
+                if kind != SPIN:
+                    ramp = min(ramp, (steps - i) / rampSteps)
+                grip = 1.0
+                if i >= onset:
+                    # Rear lets go within 0.1 s, under power
+                    grip = 1 - (1 - SPIN_GRIP * severity) * min(1.0, (i - onset + 1) * dt / 0.1)
+                    accel = 0.2 * GRAVITY
+                target = math.copysign(min(abs(targetLat), speed * speed / MIN_RADIUS), targetLat)
+                latAccel = model.step(dt, model.steadySteer(target * ramp), accel, grip)
+            else:
+                # Sliding sideways: yaw and lateral force die away, the car scrubs off speed
+                decay = math.exp(-dt / 0.12)
+                model.yawRate *= decay
+                model.latAccel *= decay
+                latAccel = model.latAccel
+                model.speed = max(MIN_SPEED, speed - 0.8 * GRAVITY * dt)
+
+            # From the speed, so braking ends at MIN_SPEED like the car does
+            accel = (model.speed - speed) / dt
+
+            # Body roll and pitch follow the acceleration with a lag
+            rollStep = (rollGain * latAccel - self.roll) * body
+            pitchStep = (-pitchGain * accel - self.pitch) * body
+            self.roll += rollStep
+            self.pitch += pitchStep
+
+            lat[i] = latAccel * accelScale
+            lon[i] = accel * accelScale
+            pitchRate[i] = pitchStep / dt * gyroScale
+            rollRate[i] = rollStep / dt * gyroScale
+            yaw[i] = model.yawRate * gyroScale
+
+        if kind == SPIN:
+            # The car is caught straight and carries on
+            model.reset(model.speed)
+
+        vert = [float(ACCEL_LSB_PER_G)] * steps
+        channels = [lat, lon, vert, pitchRate, rollRate, yaw]
+        columns = []
+        for i, values in enumerate(channels):
+            columns.append(self.upsample(i, values))
+        count = steps * self.factor
+
+        if kind == CURB:
+            columns[2], columns[0] = curbRidges(columns[2], columns[0], model.speed, self.rateHz, severity,
+                32767 - self.margins[2], 32767 - self.margins[0])
+
+        # Noise and vibration
+        position = self.ringPos
+        for i in range(len(columns)):
+            noise = ringSlice(self.rings[i], position, count)
+            if numpy is not None:
+                columns[i] = columns[i] + noise
+            else:
+                columns[i] = array("h", map(add, columns[i], noise))
+        self.ringPos = (position + count) % RING_SIZE
+
+        flags = bytearray(count)
+        if kind == SPIN:
+            first = onset * self.factor
+            flags[first:] = bytes([FLAG_SPIN]) * (count - first)
+            self.spins.append((self.samples + first, self.samples + count))
+        self.samples += count
+        return columns, flags
+
+    """
+    Upsample physics samples of channel i to the output rate
+
+    Linear between consecutive physics samples, starting from the last
+    sample of the previous event, clamped so that adding the channel's
+    ring cannot overflow. Returns an int16 array (NumPy when installed).
+    """
+    def upsample(self, i, values):
+        limit = 32767 - self.margins[i]
+        if max(values) > limit or min(values) < -limit:
+            values = [min(limit, max(-limit, value)) for value in values]
+        previous = [self.last[i]] + values[:-1]
+        self.last[i] = values[-1]
+        factor = self.factor
+        count = len(values) * factor
+
+        if numpy is not None:
+            values = numpy.array(values)
+            previous = numpy.array(previous)
+            delta = values - previous
+            out = numpy.empty(count, dtype=numpy.int16)
+            for k in range(factor):
+                out[k::factor] = previous + delta * ((k + 1) / factor)
+            return out
+
+        if values[0] == previous[0] and min(values) == max(values):
+            return array("h", [int(values[0])]) * count
+        out = array("h", bytes(2 * count))
+        delta = [b - a for a, b in zip(previous, values)]
+        for k in range(factor):
+            w = (k + 1) / factor
+            out[k::factor] = array("h", [int(a + d * w) for a, d in zip(previous, delta)])
+        return out
+
+    # Generate a scenario of (kind, seconds, severity, direction) events, yields event() per event
+    def columns(self, scenario):
+        for event in scenario:
+            yield self.event(*event)
+
+    # Bursts of a scenario, one chunk per event (for Simulator.replay() or ICM20948Model.load())
+    def bursts(self, scenario):
+        for columns, flags in self.columns(scenario):
+            yield packBursts(columns + [TEMP_RAW])
+
+
+"""
+Noise and vibration rings
+
+Every channel gets RING_SIZE samples of white noise plus, on the
+accelerometer, engine vibration at a whole number of cycles per ring
+so it repeats without a jump. Returns (rings, margins), margins being
+the largest magnitude in each ring.
+"""
+def buildRings(rateHz, noise=1.0, vibration=1.0, seed=1):
+    rng = random.Random(seed)
+    cycles = max(1, int(round(ENGINE_HZ * RING_SIZE / rateHz)))
+    rings = []
+    margins = []
+    for i in range(6):
+        sigma = noise * (ACCEL_NOISE if i < 3 else GYRO_NOISE)
+        amplitude = vibration * ENGINE_G[i] * ACCEL_LSB_PER_G if i < 3 else 0.0
+        ring = array("h", [int(rng.gauss(0.0, sigma) + amplitude * math.sin(2 * math.pi * cycles * k / RING_SIZE))
+            for k in range(RING_SIZE)])
+        margins.append(max(max(ring), -min(ring)))
+        rings.append(numpy.array(ring, dtype=numpy.int16) if numpy is not None else ring)
+    return rings, margins
+
+# count samples of a ring starting at position, wrapping around
+def ringSlice(ring, position, count):
+    pieces = []
+    while count > 0:
+        take = min(count, RING_SIZE - position)
+        pieces.append(ring[position:position + take])
+        count -= take
+        position = 0
+    if numpy is not None:
+        return numpy.concatenate(pieces)
+    return pieces[0] if len(pieces) == 1 else array("h", b"".join(piece.tobytes() for piece in pieces))
+
+"""
+Curb ridges over the middle half of a curb event
+
+Each ridge is a half sine bump on az and a smaller lateral shake on
+ax (a full sine, the car is not pushed off line), struck at
+speed / CURB_SPACING per second. Returns the new (az, ax) columns,
+clamped to +-vertLimit and +-latLimit.
+"""
+def curbRidges(vert, lat, speed, rateHz, severity, vertLimit=32767, latLimit=32767):
+    count = len(vert)
+    first, end = count // 4, count - count // 4
+    vert = array("h", bytes(vert))
+    lat = array("h", bytes(lat))
+    ridgeHz = speed / CURB_SPACING
+    vertPeak = severity * CURB_VERT_G * ACCEL_LSB_PER_G
+    latPeak = severity * CURB_LAT_G * ACCEL_LSB_PER_G
+    ridges = [math.sin(2 * math.pi * ridgeHz * k / rateHz) for k in range(end - first)]
+    vert[first:end] = array("h", [min(vertLimit, max(-vertLimit, int(value + vertPeak * max(0.0, ridge))))
+        for value, ridge in zip(vert[first:end], ridges)])
+    lat[first:end] = array("h", [min(latLimit, max(-latLimit, int(value + latPeak * ridge)))
+        for value, ridge in zip(lat[first:end], ridges)])
+    if numpy is not None:
+        return numpy.frombuffer(vert, dtype=numpy.int16), numpy.frombuffer(lat, dtype=numpy.int16)
+    return vert, lat
+
+
+"""
+Scenario of one lap
+
+severity: 0 - 1 of the car's limits
+spin: end the lap with a spin
+"""
+def lap(severity=0.7, spin=True):
+    events = [
+        (STRAIGHT, 6.0, severity, 1),
+        (BRAKE, 1.5, severity, 1),
+        (CORNER, 3.0, severity, 1),
+        (STRAIGHT, 3.0, severity, 1),
+        (BRAKE, 1.0, severity, 1),
+        (CURB, 2.5, severity, -1),
+        (STRAIGHT, 4.0, severity, 1),
+        (BRAKE, 1.2, severity, 1),
+        (CORNER, 2.0, severity, -1),
+    ]
+    if spin:
+        events.append((SPIN, 2.0, severity, 1))
+    return events
+
+"""
+Random scenario for load testing
+
+seconds: length of the scenario
+severity: the events' severity is drawn up to this
+spinEvery: a spin on average every spinEvery seconds (0 for none)
+"""
+def randomScenario(seconds, severity=0.8, spinEvery=60, seed=1):
+    rng = random.Random(seed)
+    events = []
+    total = 0.0
+    while total < seconds:
+        kind = rng.choice((STRAIGHT, STRAIGHT, BRAKE, CORNER, CORNER, CURB))
+        if spinEvery and rng.random() < 4.0 / spinEvery:
+            kind = SPIN
+        if kind == BRAKE:
+            length = rng.uniform(1.0, 2.5)
+        elif kind == SPIN:
+            length = rng.uniform(SPIN_MIN, 3.0)
+        else:
+            length = rng.uniform(2.0, 6.0)
+        events.append((kind, length, rng.uniform(0.3, 1.0) * severity, rng.choice((1, -1))))
+        total += length
+    return events
+
+"""
+Write generated columns as DataLogger segments
+
+chunks: (columns, flags) per event, e.g. TraceGenerator.columns()
+directory: directory of the segments (created if missing)
+Returns (segments, records) written.
+"""
+def writeLog(chunks, directory, rateHz=1000, session=1, modeIdx=0):
+    os.makedirs(directory, exist_ok=True)
+    blockSize = BLOCK_RECORDS * RECORD_SIZE
+    magBytes = struct.pack("<3h", *MAG_RAW)
+
+    pending = bytearray()
+    segment = 0
+    blocks = 0
+    records = 0
+    out = None
+    for columns, flags in chunks:
+        count = len(flags)
+        packed = bytearray(count * RECORD_SIZE)
+
+        # Time (ms since the session started), little endian
+        times = array("I" if array("I").itemsize == 4 else "L", [(records + k) * 1000 // rateHz for k in range(count)])
+        fields = [times] + [array("h", bytes(column)) if numpy is not None else column for column in columns]
+        if sys.byteorder != "little":
+            for field in fields:
+                field.byteswap()
+        offset = 0
+        for field in fields:
+            view = memoryview(field).cast("B")
+            width = field.itemsize
+            for k in range(width):
+                packed[offset + k::RECORD_SIZE] = view[k::width]
+            offset += width
+        for k in range(6):
+            packed[offset + k::RECORD_SIZE] = magBytes[k:k + 1] * count
+        packed[offset + 6::RECORD_SIZE] = bytes([modeIdx]) * count
+        packed[offset + 7::RECORD_SIZE] = flags
+        pending += packed
+        records += count
+
+        # Full blocks
+        while len(pending) >= blockSize:
+            if out is None:
+                out = openSegment(directory, rateHz, session, segment, (records - (len(pending) // RECORD_SIZE)) * 1000 // rateHz)
+            writeBlock(out, pending[:blockSize])
+            del pending[:blockSize]
+            blocks += 1
+            if blocks == SEGMENT_BLOCKS:
+                out.close()
+                out = None
+                segment += 1
+                blocks = 0
+
+    if pending:
+        if out is None:
+            out = openSegment(directory, rateHz, session, segment, (records - len(pending) // RECORD_SIZE) * 1000 // rateHz)
+        writeBlock(out, pending)
+    if out is not None:
+        out.close()
+        segment += 1
+    return segment, records
+
+# Open a segment file and write its header
+def openSegment(directory, rateHz, session, segment, startMs):
+    out = open(segmentName(session, segment, directory), "wb")
+    out.write(struct.pack(HEADER_FORMAT, FILE_MAGIC, FILE_VERSION, RECORD_SIZE, rateHz, session, segment, startMs))
+    return out
+
+# Write records as one block with its CRC32
+def writeBlock(out, records):
+    out.write(struct.pack(BLOCK_FORMAT, len(records) // RECORD_SIZE, 0, crc32(records) & 0xFFFFFFFF))
+    out.write(records)
+
+# Print a scenario
+def printScenario(scenario):
+    total = 0.0
+    for kind, seconds, severity, direction in scenario:
+        side = "" if kind in (STRAIGHT, BRAKE) else (" left" if direction > 0 else " right")
+        print("  %7.1f s  %-8s %4.1f s  severity %.2f%s" % (total, kind, seconds, severity, side))
+        total += seconds
+    print("  %7.1f s" % total)
+
+"""
+Replay a scenario through GMonitor and check its spin warnings
+
+Every spin must raise the warning between its onset and end, and no
+warning may be raised outside a spin. Prints the latency of each.
+Returns True if the check passed.
+"""
+def replayCheck(scenario, rateHz=1000, mode=None, noise=1.0, vibration=1.0):
+    import Simulator
+
+    sim = Simulator.install()
+    generator = TraceGenerator(rateHz, noise, vibration)
+    warnings = [] # Samples at which the warning was raised
+    state = {"first": 0, "spinning": False}
+
+    def setup(monitor):
+        state["first"] = sim.imu.bursts
+        detector = monitor.spinDetector
+        update = detector.update
+
+        def recorded(gyroZ, ax, ay):
+            spinning = update(gyroZ, ax, ay)
+            if spinning and not state["spinning"]:
+                warnings.append(sim.imu.bursts - state["first"] - 1)
+            state["spinning"] = spinning
+            return spinning
+        detector.update = recorded
+
+    commands = [(0, "set mode " + mode)] if mode else []
+    Simulator.replay(generator.bursts(scenario), rateHz, commands, setup=setup)
+
+    print("\nSpin warnings")
+    print("=======================================")
+    passed = True
+    matched = set()
+    for first, end in generator.spins:
+        hits = [sample for sample in warnings if first <= sample < end]
+        if hits:
+            matched.add(hits[0])
+            print("Spin at %8.3f s: warning after %d ms" % (first / rateHz, (hits[0] - first) * 1000 // rateHz))
+        else:
+            passed = False
+            print("Spin at %8.3f s: NO WARNING" % (first / rateHz))
+    for sample in warnings:
+        if not any(first <= sample < end for first, end in generator.spins):
+            passed = False
+            print("FALSE WARNING at %8.3f s" % (sample / rateHz))
+    print("Spin check " + ("passed" if passed else "FAILED"))
+    return passed
+
+"""
+Benchmark and conformance check
+
+Generates an hour of random events at 1 kHz, packed into bursts and
+written as log segments, decodes a stretch of the bursts through
+icm20948.py on the simulated I2C bus and reads the segments back
+with the DataLogger's CRC check.
+"""
+def benchmark(directory="tracebench"):
+    import shutil
+    import Simulator
+    from DataLogger import parseHeader, readBlocks, decodeRecords
+
+    rateHz = 1000
+    scenario = randomScenario(3600)
+
+    print("\nTrace generator benchmark (%s)" % ("NumPy" if numpy is not None else "standard library"))
+    print("=======================================")
+
+    generator = TraceGenerator(rateHz)
+    start = time.perf_counter()
+    size = 0
+    for chunk in generator.bursts(scenario):
+        size += len(chunk)
+    elapsed = time.perf_counter() - start
+    samples = generator.samples
+    print("Bursts: %d samples (%.0f s) in %.2f s, %.2f M samples/s, %d spins" % (samples, samples / rateHz,
+        elapsed, samples / elapsed / 1000000, len(generator.spins)))
+
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    start = time.perf_counter()
+    segments, records = writeLog(TraceGenerator(rateHz).columns(scenario), directory, rateHz)
+    elapsed = time.perf_counter() - start
+    print("Log: %d records in %d segments in %.2f s, %.2f M records/s" % (records, segments, elapsed,
+        records / elapsed / 1000000))
+
+    # Read the log back, every block is CRC checked
+    checked = 0
+    spinRecords = 0
+    for segment in range(segments):
+        with open(segmentName(1, segment, directory), "rb") as f:
+            data = f.read()
+        parseHeader(data)
+        for offset, block in readBlocks(data):
+            checked += len(block) // RECORD_SIZE
+            spinRecords += sum(1 for record in decodeRecords(block) if record[11] & FLAG_SPIN)
+    expected = sum(end - first for first, end in generator.spins)
+    print("Log read back: %d records, %d flagged spinning (expected %d)" % (checked, spinRecords, expected))
+    shutil.rmtree(directory)
+
+    # Decode path: the bursts of the first events through icm20948.GyroAccelRead()
+    sim = Simulator.install()
+    import icm20948
+
+    imu = icm20948.ICM20948()
+    generator = TraceGenerator(rateHz)
+    columns, flags = generator.event(CURB, 5.0, 1.0, 1)
+    sim.imu.load(packBursts(columns + [TEMP_RAW]))
+    mismatches = 0
+    for k in range(len(flags)):
+        imu.GyroAccelRead()
+        read = list(icm20948.Accel) + list(icm20948.Gyro)
+        if read != [int(column[k]) for column in columns] or icm20948.Temp[0] != TEMP_RAW:
+            mismatches += 1
+    print("Decoded %d bursts through icm20948.py, %d mismatches" % (len(flags), mismatches))
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic IMU traces for GMonitor")
+    parser.add_argument("-s", "--severity", type=float, default=0.7, help="severity of the events, 0 - 1 (default 0.7)")
+    parser.add_argument("-r", "--rate", type=int, default=1000, help="sample rate in Hz (default 1000)")
+    parser.add_argument("-n", "--seconds", type=float, help="random events for this long instead of laps")
+    parser.add_argument("-l", "--laps", type=int, default=5, help="laps (default 5)")
+    parser.add_argument("--noise", type=float, default=1.0, help="sensor noise, 1 = datasheet")
+    parser.add_argument("--vibration", type=float, default=1.0, help="engine vibration, 0 for none")
+    parser.add_argument("-m", "--mode", help="ride mode for the replay")
+    parser.add_argument("-o", "--out", help="write the trace as log segments into this directory")
+    parser.add_argument("--replay", action="store_true", help="replay through GMonitor (Simulator.py) and check spin warnings")
+    parser.add_argument("-b", "--bench", action="store_true", help="benchmark an hour at 1 kHz")
+    args = parser.parse_args()
+
+    if args.bench:
+        benchmark()
+        return
+
+    if args.seconds is not None:
+        scenario = randomScenario(args.seconds, args.severity)
+    else:
+        scenario = lap(args.severity) * args.laps
+
+    if args.replay:
+        if not replayCheck(scenario, args.rate, args.mode, args.noise, args.vibration):
+            sys.exit(1)
+    elif args.out is not None:
+        generator = TraceGenerator(args.rate, args.noise, args.vibration)
+        segments, records = writeLog(generator.columns(scenario), args.out, args.rate)
+        print("Wrote %d records in %d segments to %s, %d spins" % (records, segments, args.out, len(generator.spins)))
+    else:
+        printScenario(lap(args.severity))
+
+if __name__ == "__main__":
+    main()
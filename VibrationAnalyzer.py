@@ -0,0 +1,459 @@
+"""
+This file contains an on-device vibration spectrum analyzer
+for GMonitor.
+
+Samples of one accelerometer axis (Z by default) are collected
+into preallocated windows. Once a window is full it is handed to
+an in-place fixed-point radix-2 FFT which is run a few butterflies
+at a time from step(), so the transform is spread across many
+monitor iterations and never delays the sampler. The butterflies
+run in a viper kernel (fftButterflies in Kernels.py); the window
+load and band power slices are interpreted and kept short. When a window has
+been transformed, the energy and dominant frequency of each band
+(suspension, wheel hop, engine order) are stored for reporting.
+
+The bands span three decades, which one window cannot resolve (at
+1 kHz, 256 points are 3.9 Hz per bin and the whole suspension band
+would be one bin). Each band is therefore analysed at the smallest
+power-of-2 decimation of the sample rate that gives it MIN_BAND_BINS
+bins, e.g. suspension at 125 Hz (0.49 Hz bins), wheel hop at 500 Hz
+and engine orders at the full rate. Every decimation level fills its
+own window with boxcar means; the boxcar's zeros lie on multiples of
+the decimated rate, which is where components alias into the low
+bins. The levels share the FFT, a full window waits for it instead of
+being dropped. A band that stays narrower than one bin, or starts
+above the Nyquist frequency, is rejected at startup.
+
+Fixed-point notes:
+    - Twiddle factors and the Hann window are Q14 integers
+    - Every FFT stage scales by 1/2, so intermediate values stay
+      within MicroPython's small int range and never allocate
+    - Bin powers are scaled down by the number of bins per window
+      before they are summed, so band energies stay small ints too
+
+kward
+"""
+from array import array
+import math
+from Kernels import fftButterflies, fftSetup, fftRestart
+
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    # CPython fallback for running the benchmark on a host
+    from time import perf_counter
+
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+Q = 14 # Fixed-point fraction bits
+ONE = 1 << Q
+SAMPLE_LIMIT = ONE - 1 # Clamp for DC-removed samples
+
+# Analyzer states
+IDLE = 0
+LOAD = 1
+FFT = 2
+POWER = 3
+
+# Frequency bands (name, low Hz, high Hz)
+BANDS = (
+    ("suspension", 0.5, 5.0),
+    ("wheel-hop", 8.0, 25.0),
+    ("engine", 25.0, 500.0)
+)
+
+# Decimation of a band's window
+MIN_BAND_BINS = 8 # Bins a band should span
+MAX_DECIMATION = 64
+NYQUIST_MARGIN = 0.8 # Highest band frequency relative to the decimated Nyquist frequency
+NO_LEVEL = 255 # Level of a rejected band
+
+# Main class
+class VibrationAnalyzer:
+
+    """
+    Initialize analyzer
+
+    sampleRateHz: rate at which add() is called
+    size: FFT window length, must be a power of 2
+    sliceOps: maximum samples or bins processed per step() (interpreted)
+    fftOps: maximum butterflies processed per step() (compiled)
+    """
+    def __init__(self, sampleRateHz=1000, size=256, sliceOps=8, fftOps=64):
+        # Check window size
+        if size < 4 or size & (size - 1):
+            print("Error in VibrationAnalyzer.__init__(): size must be a power of 2")
+            size = 256
+
+        self.sampleRateHz = sampleRateHz
+        self.n = size
+        self.sliceOps = sliceOps
+
+        # FFT work buffers (shared by all decimation levels)
+        self.re = array('i', [0] * size)
+        self.im = array('i', [0] * size)
+
+        # Precomputed tables, twiddles and FFT progress are shared with the kernel
+        half = size >> 1
+        self.twiddle, self.fftState = fftSetup(size, fftOps)
+        self.window = array('h', [int(round((0.5 - 0.5 * math.cos(2 * math.pi * i / size)) * ONE)) for i in range(size)])
+
+        bits = 0
+        while (1 << bits) < size:
+            bits += 1
+        self.bitrev = array('H', [0] * size)
+        for i in range(size):
+            r = 0
+            for b in range(bits):
+                if i & (1 << b):
+                    r |= 1 << (bits - 1 - b)
+            self.bitrev[i] = r
+
+        # Bin powers are summed in units of 2^energyShift (at most half bins per band)
+        self.energyShift = bits - 1
+
+        # Decimation level and bin range of every band
+        self.numBands = len(BANDS)
+        self.bandLevel = bytearray(self.numBands)
+        self.bandLo = array('H', [0] * self.numBands)
+        self.bandHi = array('H', [0] * self.numBands)
+        factors = []
+        for b in range(self.numBands):
+            name, loHz, hiHz = BANDS[b]
+            if loHz >= sampleRateHz / 2:
+                print("Error in VibrationAnalyzer.__init__(): band " + name + " is above the Nyquist frequency, skipped")
+                self.bandLevel[b] = NO_LEVEL
+                continue
+
+            # Halve the rate while the band spans too few bins and stays well below Nyquist
+            decim = 1
+            while ((hiHz - loHz) * size * decim < MIN_BAND_BINS * sampleRateHz and decim * 2 <= MAX_DECIMATION
+                    and hiHz <= NYQUIST_MARGIN * sampleRateHz / (4 * decim)):
+                decim *= 2
+
+            binHz = sampleRateHz / (size * decim)
+            lo = max(1, int(math.ceil(loHz / binHz)))
+            hi = min(half - 1, int(hiHz / binHz))
+            if hi < lo:
+                print("Error in VibrationAnalyzer.__init__(): band " + name + " is narrower than one bin, skipped")
+                self.bandLevel[b] = NO_LEVEL
+                continue
+
+            if not decim in factors:
+                factors.append(decim)
+            self.bandLevel[b] = factors.index(decim)
+            self.bandLo[b] = lo
+            self.bandHi[b] = hi
+
+        # Double buffered sample windows of every decimation level (one filling, one waiting for the FFT)
+        self.numLevels = len(factors)
+        self.decim = array('H', factors)
+        self.decimSum = array('l', [0] * self.numLevels)
+        self.decimCount = array('H', [0] * self.numLevels)
+        self.fills = [array('h', [0] * size) for i in range(self.numLevels)]
+        self.frozens = [array('h', [0] * size) for i in range(self.numLevels)]
+        self.fillIdx = array('H', [0] * self.numLevels)
+        self.fillSum = array('l', [0] * self.numLevels)
+        self.frozenMean = array('l', [0] * self.numLevels)
+        self.ready = bytearray(self.numLevels) # 1 = frozen window waiting for the FFT
+
+        # Results of the last completed window of each band
+        self.bandEnergy = array('f', [0.0] * self.numBands) # Units of 2^energyShift
+        self.bandPeakHz = array('f', [0.0] * self.numBands)
+        self.bandPeakPower = array('i', [0] * self.numBands)
+        self.windows = 0 # Completed windows
+        self.dropped = 0 # Windows dropped because the previous one of their level was still waiting
+
+        # Slice progress
+        self.state = IDLE
+        self.level = 0 # Decimation level being analysed
+        self.pos = 0 # Sample or bin index
+        self.band = 0 # Band being accumulated
+        self.energy = 0
+        self.peak = 0
+        self.peakBin = 0
+
+    # Add one raw sample (LSB), decimated into the window of every level
+    def add(self, sample):
+        for level in range(self.numLevels):
+            x = sample
+            decim = self.decim[level]
+            if decim > 1:
+                total = self.decimSum[level] + sample
+                count = self.decimCount[level] + 1
+                if count < decim:
+                    self.decimSum[level] = total
+                    self.decimCount[level] = count
+                    continue
+                self.decimSum[level] = 0
+                self.decimCount[level] = 0
+                x = total // decim
+
+            idx = self.fillIdx[level]
+            self.fills[level][idx] = x
+            self.fillSum[level] += x
+            idx += 1
+            if idx < self.n:
+                self.fillIdx[level] = idx
+                continue
+
+            # Window full, hand it over unless the previous one still waits or is being loaded
+            if self.ready[level] or (self.state == LOAD and self.level == level):
+                self.dropped += 1
+            else:
+                temp = self.frozens[level]
+                self.frozens[level] = self.fills[level]
+                self.fills[level] = temp
+                self.frozenMean[level] = self.fillSum[level] // self.n
+                self.ready[level] = 1
+
+            self.fillIdx[level] = 0
+            self.fillSum[level] = 0
+
+    # Run one slice of the analysis, returns True when a window completes
+    def step(self):
+        state = self.state
+
+        if state == IDLE:
+            # Start on the first level with a window waiting
+            for level in range(self.numLevels):
+                if self.ready[level]:
+                    self.ready[level] = 0
+                    self.level = level
+                    self.state = LOAD
+                    self.pos = 0
+                    break
+        elif state == LOAD:
+            self.loadSlice()
+        elif state == FFT:
+            self.fftSlice()
+        elif state == POWER:
+            self.powerSlice()
+            if self.state == IDLE:
+                return True
+
+        return False
+
+    # Remove DC, apply window and copy into bit-reversed order
+    def loadSlice(self):
+        n = self.n
+        frozen = self.frozens[self.level]
+        window = self.window
+        bitrev = self.bitrev
+        re = self.re
+        im = self.im
+        mean = self.frozenMean[self.level]
+
+        i = self.pos
+        end = min(n, i + self.sliceOps)
+        while i < end:
+            x = frozen[i] - mean
+            if x > SAMPLE_LIMIT:
+                x = SAMPLE_LIMIT
+            elif x < -SAMPLE_LIMIT:
+                x = -SAMPLE_LIMIT
+
+            j = bitrev[i]
+            re[j] = (x * window[i]) >> Q
+            im[j] = 0
+            i += 1
+
+        self.pos = i
+        if i >= n:
+            # Start butterflies at the first stage
+            self.state = FFT
+            fftRestart(self.fftState)
+
+    # Run up to fftOps butterflies, scaling every stage by 1/2
+    def fftSlice(self):
+        if fftButterflies(self.re, self.im, self.twiddle, self.fftState):
+            # Start power accumulation at the first band of this level
+            self.startBand(self.nextBand(0))
+
+    # First band of the current level from band b on (numBands if there is none)
+    def nextBand(self, b):
+        level = self.level
+        bandLevel = self.bandLevel
+        while b < self.numBands and bandLevel[b] != level:
+            b += 1
+        return b
+
+    # Start accumulating band b, or finish the window when b is past the last band
+    def startBand(self, b):
+        if b >= self.numBands:
+            self.windows += 1
+            self.state = IDLE
+            return
+
+        self.state = POWER
+        self.band = b
+        self.pos = self.bandLo[b]
+        self.energy = 0
+        self.peak = 0
+        self.peakBin = self.pos
+
+    # Accumulate band power over up to sliceOps bins
+    def powerSlice(self):
+        re = self.re
+        im = self.im
+        b = self.band
+        k = self.pos
+        hi = self.bandHi[b]
+        shift = self.energyShift
+        energy = self.energy
+        peak = self.peak
+        peakBin = self.peakBin
+
+        ops = self.sliceOps
+        while ops > 0:
+            p = re[k] * re[k] + im[k] * im[k]
+            energy += p >> shift
+            if p > peak:
+                peak = p
+                peakBin = k
+
+            ops -= 1
+            k += 1
+            if k > hi:
+                # Band complete
+                self.bandEnergy[b] = energy
+                self.bandPeakPower[b] = peak
+                self.bandPeakHz[b] = peakBin * self.sampleRateHz / (self.n * self.decim[self.level])
+
+                self.startBand(self.nextBand(b + 1))
+                return
+
+        self.pos = k
+        self.energy = energy
+        self.peak = peak
+        self.peakBin = peakBin
+
+    # Print the bands of the last completed window
+    def report(self):
+        print("\nVibration spectrum (window %d, %d dropped):" % (self.windows, self.dropped))
+        for b in range(self.numBands):
+            if self.bandLevel[b] == NO_LEVEL:
+                print("%-10s not resolvable at %d Hz" % (BANDS[b][0], self.sampleRateHz))
+                continue
+            print("%-10s %6.1f Hz peak, energy %d" % (BANDS[b][0], self.bandPeakHz[b], self.bandEnergy[b] * (1 << self.energyShift)))
+
+
+"""
+Accuracy and cycle-count benchmark
+
+Feeds a synthetic Z-axis signal (gravity + suspension, wheel hop
+and engine components + noise) through the analyzer and compares
+the fixed-point spectrum against a floating point reference DFT.
+"""
+
+# Floating point reference power spectrum using the same window and scaling
+def referenceSpectrum(analyzer, samples):
+    n = analyzer.n
+    mean = sum(samples) // n
+    x = []
+    for i in range(n):
+        v = max(-SAMPLE_LIMIT, min(SAMPLE_LIMIT, samples[i] - mean))
+        x.append(v * (0.5 - 0.5 * math.cos(2 * math.pi * i / n)))
+
+    power = []
+    for k in range(n >> 1):
+        sr = 0.0
+        si = 0.0
+        for i in range(n):
+            a = 2 * math.pi * k * i / n
+            sr += x[i] * math.cos(a)
+            si -= x[i] * math.sin(a)
+        power.append((sr * sr + si * si) / (n * n))
+
+    return power
+
+# Boxcar means of decim samples, the last full window of a decimation level as the analyzer sees it
+def levelWindow(analyzer, samples, decim):
+    n = analyzer.n
+    decimated = [sum(samples[i:i + decim]) // decim for i in range(0, len(samples) - decim + 1, decim)]
+    windows = len(decimated) // n
+    return decimated[(windows - 1) * n:windows * n]
+
+def main():
+    import random
+
+    sampleRateHz = 1000
+    analyzer = VibrationAnalyzer(sampleRateHz)
+    n = analyzer.n
+
+    # 1g + 3 Hz suspension + 15 Hz wheel hop + 120 Hz engine order, long enough for a window of every level
+    samples = []
+    for i in range(n * max(analyzer.decim)):
+        t = i / sampleRateHz
+        v = 16384
+        v += 1600 * math.sin(2 * math.pi * 3.0 * t)
+        v += 900 * math.sin(2 * math.pi * 15.0 * t)
+        v += 400 * math.sin(2 * math.pi * 120.0 * t)
+        v += random.randint(-50, 50)
+        samples.append(int(v))
+
+    # Add and step like the monitor loop, timing the worst slice
+    steps = 0
+    worst = 0
+    total = 0
+    for s in samples:
+        analyzer.add(s)
+        busy = analyzer.state != IDLE
+        start = ticks_us()
+        analyzer.step()
+        elapsed = ticks_diff(ticks_us(), start)
+        if busy:
+            total += elapsed
+            steps += 1
+            if elapsed > worst:
+                worst = elapsed
+    while analyzer.state != IDLE or any(analyzer.ready):
+        analyzer.step()
+
+    print("\nVibration analyzer benchmark")
+    print("=======================================")
+    print("Window: %d samples, decimation %s" % (n, ", ".join(str(d) for d in analyzer.decim)))
+    print("%d windows in %d slices, total %d us, worst slice %d us" % (analyzer.windows, steps, total, worst))
+
+    try:
+        import machine
+        mhz = machine.freq() // 1000000
+        print("Approx. cycles: total %d, worst slice %d" % (total * mhz, worst * mhz))
+    except ImportError:
+        pass
+
+    analyzer.report()
+
+    # Compare fixed-point power of the last transformed window against the reference
+    decim = analyzer.decim[analyzer.level]
+    ref = referenceSpectrum(analyzer, levelWindow(analyzer, samples, decim))
+    maxErr = 0.0
+    refPeak = max(ref[1:])
+    for k in range(1, n >> 1):
+        p = analyzer.re[k] * analyzer.re[k] + analyzer.im[k] * analyzer.im[k]
+        err = abs(p - ref[k]) / refPeak
+        if err > maxErr:
+            maxErr = err
+    print("\nMax power error vs reference (decimation %d): %.3f%% of peak" % (decim, maxErr * 100))
+
+    for b in range(analyzer.numBands):
+        if analyzer.bandLevel[b] == NO_LEVEL:
+            continue
+        decim = analyzer.decim[analyzer.bandLevel[b]]
+        ref = referenceSpectrum(analyzer, levelWindow(analyzer, samples, decim))
+        lo = analyzer.bandLo[b]
+        hi = analyzer.bandHi[b]
+        best = lo
+        for k in range(lo, hi + 1):
+            if ref[k] > ref[best]:
+                best = k
+        refHz = best * sampleRateHz / (n * decim)
+        print("%-10s fixed %6.1f Hz, reference %6.1f Hz (%.2f Hz bins)" % (BANDS[b][0], analyzer.bandPeakHz[b], refHz,
+            sampleRateHz / (n * decim)))
+
+if __name__ == "__main__":
+    main()
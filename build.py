@@ -0,0 +1,186 @@
+"""
+This file builds and deploys GMonitor to the Pico (run on a computer).
+
+Without a build the Pico compiles every module from source on each
+power-on, which costs boot time and heap. This script:
+
+    - Precompiles the device modules to .mpy with mpy-cross
+      (-march=armv6m for the viper/native kernels, -O2 strips asserts
+      and debug code), so the Pico only has to load bytecode
+    - Writes a two line main.py that starts the monitor, as main.py
+      itself is always run from source
+    - Deploys only the build artifacts with rshell and removes the
+      .py version of every compiled module from the board (MicroPython
+      imports a .py before a .mpy of the same name)
+    - Optionally measures import time and heap use of the monitor on
+      the board from source and from .mpy and reports the delta
+
+Usage:
+    python build.py                      Build into build/
+    python build.py -p /dev/ttyACM0 -d   Build and deploy
+    python build.py -p /dev/ttyACM0 -r   Build, deploy and report boot-time/heap delta
+
+mpy-cross is needed for the build (pip install mpy-cross, matching
+the firmware's MicroPython version), rshell and pyserial for deploying.
+
+kward
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+
+# Modules compiled to .mpy
+MODULES = (
+    "GMonitor", "icm20948", "LedController", "temperature", "RideModes", "SpinDetector",
+    "SessionStats", "VibrationAnalyzer", "BiasModel", "CommandChannel", "GripEstimator",
+    "PwmGauge", "LedBackends", "Classifier", "Kernels", "Scheduler", "DataLogger", "HeapMonitor",
+    "Telemetry"
+)
+
+# Files copied as they are
+DATA_FILES = ("modes.json",)
+
+BUILD_DIR = "build"
+BOARD_DIR = "/pyboard"
+
+MAIN_PY = """from GMonitor import main
+main()
+"""
+
+# Measured on the board after a soft reset: import time (us), heap used (bytes), heap free (bytes)
+MEASURE_SCRIPT = """
+import gc, time
+gc.collect()
+before = gc.mem_free()
+start = time.ticks_us()
+import GMonitor
+elapsed = time.ticks_diff(time.ticks_us(), start)
+gc.collect()
+print(elapsed, before - gc.mem_free(), gc.mem_free())
+"""
+
+# Command line of mpy-cross (executable or pip module)
+def mpyCross():
+    if shutil.which("mpy-cross") is not None:
+        return ["mpy-cross"]
+    try:
+        import mpy_cross
+        return [sys.executable, "-m", "mpy_cross"]
+    except ImportError:
+        print("Error in mpyCross(): mpy-cross not found, install it with: pip install mpy-cross")
+        sys.exit(1)
+
+# Compile all modules into outDir, returns the list of artifacts
+def build(srcDir=".", outDir=BUILD_DIR):
+    if os.path.isdir(outDir):
+        shutil.rmtree(outDir)
+    os.makedirs(outDir)
+
+    cross = mpyCross()
+    artifacts = []
+
+    for module in MODULES:
+        src = os.path.join(srcDir, module + ".py")
+        out = os.path.join(outDir, module + ".mpy")
+        result = subprocess.run(cross + ["-march=armv6m", "-O2", "-s", module + ".py", "-o", out, src])
+        if result.returncode != 0:
+            print("Error in build(): failed to compile " + src)
+            sys.exit(1)
+
+        print("%-24s %6d -> %6d bytes" % (module + ".py", os.path.getsize(src), os.path.getsize(out)))
+        artifacts.append(out)
+
+    with open(os.path.join(outDir, "main.py"), "w") as f:
+        f.write(MAIN_PY)
+    artifacts.append(os.path.join(outDir, "main.py"))
+
+    for name in DATA_FILES:
+        shutil.copy(os.path.join(srcDir, name), os.path.join(outDir, name))
+        artifacts.append(os.path.join(outDir, name))
+
+    return artifacts
+
+# Run a list of rshell commands on the board
+def rshell(port, commands):
+    script = os.path.join(BUILD_DIR, "deploy.rshell")
+    with open(script, "w") as f:
+        f.write("\n".join(commands) + "\n")
+
+    result = subprocess.run(["rshell", "--quiet", "-p", port, "-f", script])
+    if result.returncode != 0:
+        print("Error in rshell(): deploy failed")
+        sys.exit(1)
+
+# Copy the build artifacts to the board, removing the sources they replace
+def deploy(port, artifacts):
+    commands = []
+    for module in MODULES:
+        commands.append("rm -f %s/%s.py" % (BOARD_DIR, module))
+    for path in artifacts:
+        commands.append("cp %s %s/" % (path, BOARD_DIR))
+
+    rshell(port, commands)
+    print("Deployed " + str(len(artifacts)) + " files")
+
+# Copy the sources to the board, removing the compiled modules (for comparison)
+def deploySources(port, srcDir="."):
+    commands = []
+    for module in MODULES:
+        commands.append("rm -f %s/%s.mpy" % (BOARD_DIR, module))
+        commands.append("cp %s %s/" % (os.path.join(srcDir, module + ".py"), BOARD_DIR))
+    for name in DATA_FILES:
+        commands.append("cp %s %s/" % (os.path.join(srcDir, name), BOARD_DIR))
+
+    rshell(port, commands)
+
+# Measure import time and heap use of the monitor on the board
+def measure(port):
+    from rshell.pyboard import Pyboard
+
+    board = Pyboard(port)
+    try:
+        board.enter_raw_repl()
+        output = board.exec_(MEASURE_SCRIPT)
+        board.exit_raw_repl()
+    finally:
+        board.close()
+
+    elapsed, used, free = (int(value) for value in output.split())
+    return elapsed, used, free
+
+# Deploy sources and compiled modules in turn and print the difference
+def report(port, artifacts):
+    deploySources(port)
+    sourceUs, sourceUsed, sourceFree = measure(port)
+
+    deploy(port, artifacts)
+    mpyUs, mpyUsed, mpyFree = measure(port)
+
+    print("\nGMonitor boot report")
+    print("=======================================")
+    print("%-12s %12s %12s %12s" % ("", "import (ms)", "heap used", "heap free"))
+    print("%-12s %12.1f %12d %12d" % ("source", sourceUs / 1000, sourceUsed, sourceFree))
+    print("%-12s %12.1f %12d %12d" % (".mpy", mpyUs / 1000, mpyUsed, mpyFree))
+    print("%-12s %12.1f %12d %12d" % ("delta", (mpyUs - sourceUs) / 1000, mpyUsed - sourceUsed, mpyFree - sourceFree))
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and deploy GMonitor")
+    parser.add_argument("-p", "--port", help="serial port of the Pico")
+    parser.add_argument("-d", "--deploy", action="store_true", help="deploy the build with rshell")
+    parser.add_argument("-r", "--report", action="store_true", help="deploy and report boot-time/heap delta against source")
+    args = parser.parse_args()
+
+    if (args.deploy or args.report) and args.port is None:
+        parser.error("--deploy and --report need --port")
+
+    artifacts = build()
+
+    if args.report:
+        report(args.port, artifacts)
+    elif args.deploy:
+        deploy(args.port, artifacts)
+
+if __name__ == "__main__":
+    main()
@@ -148,6 +148,10 @@ USB_BUFFER_SIZE = 512
 RPI_PICO_USB_BUFFER_SIZE = 128
 UART_BUFFER_SIZE = 32
 BUFFER_SIZE = USB_BUFFER_SIZE
+# Windowed transfers from the board: number of chunks in flight (1 selects
+# the stop-and-wait protocol) and the largest chunk the host will accept.
+XFER_WINDOW = 8
+XFER_CHUNK_SIZE = 4096
 QUIET = False
 RTS = ''
 DTR = ''
@@ -603,6 +607,29 @@ def auto(func, filename, *args, **kwargs):
     return dev.remote_eval(func, dev_filename, *args, **kwargs)
 
 
+def auto_batch(func, filenames, *args, **kwargs):
+    """Like auto, but calls func for each filename in `filenames`. All the
+       calls for files on the same micropython board are made in one go.
+       Returns the list of results, in the same order as filenames.
+    """
+    results = [None] * len(filenames)
+    dev_calls = {}
+    for idx, filename in enumerate(filenames):
+        dev, dev_filename = get_dev_and_path(filename)
+        if dev is None:
+            if len(dev_filename) > 0 and dev_filename[0] == '~':
+                dev_filename = os.path.expanduser(dev_filename)
+            results[idx] = func(dev_filename, *args, **kwargs)
+        else:
+            dev_calls.setdefault(dev, []).append((idx, dev_filename))
+    for dev, calls in dev_calls.items():
+        dev_results = dev.remote_eval_batch([(func, (dev_filename,) + args, kwargs)
+                                             for _, dev_filename in calls])
+        for (idx, _), result in zip(calls, dev_results):
+            results[idx] = result
+    return results
+
+
 def board_name(default):
     """Returns the boards name (if available)."""
     try:
@@ -633,8 +660,7 @@ def cat(src_filename, dst_file):
                 dst_file.write(line)
     else:
         filesize = dev.remote_eval(get_filesize, dev_filename)
-        return dev.remote(send_file_to_host, dev_filename, dst_file, filesize,
-                          xfer_func=recv_file_from_remote)
+        return copy_from_remote(dev, dev_filename, dst_file, filesize)
 
 
 def chdir(dirname):
@@ -661,9 +687,22 @@ def copy_file(src_filename, dst_filename):
         return False
 
 
-def cp(src_filename, dst_filename):
+def copy_from_remote(dev, src_filename, dst_file, filesize):
+    """Copies a file from the remote to an already opened file on the host.
+       Uses the windowed protocol if the remote supports sys.stdin.buffer,
+       and the stop-and-wait protocol otherwise.
+    """
+    if dev.has_buffer and XFER_WINDOW > 1:
+        return dev.remote(send_file_to_host_windowed, src_filename, dst_file,
+                          filesize, xfer_func=recv_file_from_remote_windowed)
+    return dev.remote(send_file_to_host, src_filename, dst_file, filesize,
+                      xfer_func=recv_file_from_remote)
+
+
+def cp(src_filename, dst_filename, filesize=None):
     """Copies one file to another. The source file may be local or remote and
-       the destination file may be local or remote.
+       the destination file may be local or remote. If the size of the source
+       file is already known, passing it as filesize saves a remote call.
     """
     src_dev, src_dev_filename = get_dev_and_path(src_filename)
     dst_dev, dst_dev_filename = get_dev_and_path(dst_filename)
@@ -671,13 +710,13 @@ def cp(src_filename, dst_filename):
         # src and dst are either on the same remote, or both are on the host
         return auto(copy_file, src_filename, dst_dev_filename)
 
-    filesize = auto(get_filesize, src_filename)
+    if filesize is None:
+        filesize = auto(get_filesize, src_filename)
 
     if dst_dev is None:
         # Copying from remote to host
         with open(dst_dev_filename, 'wb') as dst_file:
-            return src_dev.remote(send_file_to_host, src_dev_filename, dst_file,
-                                  filesize, xfer_func=recv_file_from_remote)
+            return copy_from_remote(src_dev, src_dev_filename, dst_file, filesize)
     if src_dev is None:
         # Copying from host to remote
         with open(src_dev_filename, 'rb') as src_file:
@@ -687,8 +726,7 @@ def cp(src_filename, dst_filename):
     # Copying from remote A to remote B. We first copy the file
     # from remote A to the host and then from the host to remote B
     host_temp_file = tempfile.TemporaryFile()
-    if src_dev.remote(send_file_to_host, src_dev_filename, host_temp_file,
-                      filesize, xfer_func=recv_file_from_remote):
+    if copy_from_remote(src_dev, src_dev_filename, host_temp_file, filesize):
         host_temp_file.seek(0)
         return dst_dev.remote(recv_file_from_host, host_temp_file, dst_dev_filename,
                               filesize, xfer_func=send_file_to_remote)
@@ -1008,6 +1046,234 @@ def rsync(src_dir, dst_dir, mirror, dry_run, print_func, recursed, sync_hidden):
                         cp(src_filename, dst_filename)
 
 
+# Files synchronized by `rsync --checksum` are compared by the SHA-256 of
+# their content instead of their mtime, as the RTC of many boards is unset
+# after power on. Hashing a file on the board is slow, so the board keeps a
+# manifest of (size, mtime, hash) for every file it has hashed or received
+# and only hashes files whose size or mtime no longer match. The manifest
+# of a whole tree is fetched in one call.
+
+def manifest_filename():
+    """Function which runs on the pyboard. Returns the name of the board's
+       manifest file, on the internal flash.
+    """
+    import os
+    try:
+        os.stat('/flash')
+        return '/flash/.rshell_manifest'
+    except OSError:
+        return '/.rshell_manifest'
+
+
+def load_manifest(filename):
+    """Reads a manifest file into a dictionary which maps each filename
+       to a tuple of (size, mtime, hash).
+    """
+    manifest = {}
+    try:
+        with open(filename) as manifest_file:
+            for line in manifest_file:
+                name, size, mtime, digest = line.rstrip('\n').rsplit(' ', 3)
+                manifest[name] = (int(size), int(mtime), digest)
+    except (OSError, ValueError):
+        pass
+    return manifest
+
+
+def save_manifest(filename, manifest):
+    """Writes a dictionary created by load_manifest to a manifest file."""
+    with open(filename, 'w') as manifest_file:
+        for name in manifest:
+            size, mtime, digest = manifest[name]
+            manifest_file.write('{} {} {} {}\n'.format(name, size, mtime, digest))
+
+
+def hash_file(filename):
+    """Returns the hex SHA-256 of the contents of a file."""
+    try:
+        import hashlib
+    except ImportError:
+        import uhashlib as hashlib
+    try:
+        import binascii
+    except ImportError:
+        import ubinascii as binascii
+    sha = hashlib.sha256()
+    buf = bytearray(512)
+    view = memoryview(buf)
+    with open(filename, 'rb') as src_file:
+        while True:
+            bytes_read = src_file.readinto(buf)
+            if not bytes_read:
+                break
+            sha.update(view[:bytes_read])
+    return binascii.hexlify(sha.digest()).decode()
+
+
+@extra_funcs(manifest_filename, load_manifest, save_manifest, hash_file)
+def get_manifest(dirname, show_hidden=True, use_cache=True):
+    """Returns a dictionary which maps the name (relative to dirname) of
+       every file and directory in the tree below dirname to a tuple of
+       (mode, size, hash), or None if the directory does not exist. The
+       hash of a directory is None. With use_cache, hashes are taken from
+       the manifest file if the size and mtime of the file still match,
+       and the manifest file is updated with the ones computed.
+    """
+    import os
+    root = dirname.rstrip('/')
+    try:
+        os.stat(root or '/')
+    except OSError:
+        return None
+    cache_name = manifest_filename() if use_cache else ''
+    cache = load_manifest(cache_name) if use_cache else {}
+    cache_changed = False
+    manifest = {}
+    dirs = ['']
+    while dirs:
+        rel_dir = dirs.pop()
+        for name in os.listdir(root + rel_dir or '/'):
+            if not show_hidden and (name[0] == '.' or name[-1] == '~'):
+                continue
+            rel_name = rel_dir + '/' + name
+            filename = root + rel_name
+            if filename == cache_name:
+                continue
+            stat = os.stat(filename)
+            if stat[0] & 0x4000:
+                manifest[rel_name[1:]] = (stat[0], 0, None)
+                dirs.append(rel_name)
+                continue
+            entry = cache.get(filename)
+            if entry is None or entry[0] != stat[6] or entry[1] != stat[8]:
+                entry = (stat[6], stat[8], hash_file(filename))
+                cache[filename] = entry
+                cache_changed = True
+            manifest[rel_name[1:]] = (stat[0], stat[6], entry[2])
+    if cache_changed:
+        try:
+            save_manifest(cache_name, cache)
+        except OSError:
+            pass
+    return manifest
+
+
+@extra_funcs(manifest_filename, load_manifest, save_manifest)
+def update_manifest(hashes):
+    """Function which runs on the pyboard. Records the hashes of files which
+       were just copied to the board in the board's manifest file. hashes
+       maps each filename to the hash of its contents.
+    """
+    import os
+    cache_name = manifest_filename()
+    cache = load_manifest(cache_name)
+    for filename in hashes:
+        try:
+            stat = os.stat(filename)
+            cache[filename] = (stat[6], stat[8], hashes[filename])
+        except OSError:
+            cache.pop(filename, None)
+    try:
+        save_manifest(cache_name, cache)
+    except OSError:
+        return False
+    return True
+
+
+def dir_manifest(dirname, show_hidden):
+    """Returns the manifest of a local or remote directory tree, see get_manifest."""
+    dev, dev_dirname = get_dev_and_path(dirname)
+    if dev is None:
+        return get_manifest(dev_dirname, show_hidden, use_cache=False)
+    return dev.remote_eval(get_manifest, dev_dirname, show_hidden)
+
+
+def cp_succeeded(result):
+    """Returns True if the result of cp means the file was copied. Copies to
+       a board return the raw output of the remote call, the line True or
+       False as bytes (both truthy), everything else returns a bool.
+    """
+    if isinstance(result, bytes):
+        return result.rstrip().endswith(b'True')
+    return result is True
+
+
+def rsync_checksum(src_dir, dst_dir, mirror, dry_run, print_func, sync_hidden):
+    """Synchronizes 2 directory trees, copying only the files whose contents
+       differ. Both trees are listed and hashed in one call each.
+    """
+    src_files = dir_manifest(src_dir, sync_hidden)
+    if src_files is None:
+        print_err('Source directory {} does not exist.'.format(src_dir))
+        return
+    dst_files = dir_manifest(dst_dir, sync_hidden)
+    if dst_files is None: # Directory does not exist
+        if not make_dir(dst_dir, dry_run, print_func, False):
+            return
+        dst_files = {}
+
+    skipped = set()  # Directories which can't be synchronized
+    copied = {}  # Hash of each file copied, by destination filename
+    # Sorted, so that directories come before their contents
+    for name in sorted(src_files):
+        if name.rpartition('/')[0] in skipped:
+            skipped.add(name)
+            continue
+        src_mode, _, src_hash = src_files[name]
+        src_filename = src_dir + '/' + name
+        dst_filename = dst_dir + '/' + name
+        dst_entry = dst_files.get(name)
+        if mode_isdir(src_mode):
+            if dst_entry is None:
+                print_func("Adding %s" % dst_filename)
+                if not make_dir(dst_filename, dry_run, print_func, True):
+                    skipped.add(name)
+            elif not mode_isdir(dst_entry[0]):
+                msg = "Source '{}' is a directory and destination " \
+                      "'{}' is a file. Ignoring"
+                print_err(msg.format(src_filename, dst_filename))
+                skipped.add(name)
+            continue
+        if dst_entry is None:
+            print_func("Adding %s" % dst_filename)
+        elif mode_isdir(dst_entry[0]):
+            msg = "Source '{}' is a file and destination " \
+                  "'{}' is a directory. Ignoring"
+            print_err(msg.format(src_filename, dst_filename))
+            skipped.add(name)
+            continue
+        elif dst_entry[2] == src_hash:
+            continue
+        else:
+            msg = "{} differs from {} - copying"
+            print_func(msg.format(src_filename, dst_filename))
+        if not dry_run:
+            # Only a complete copy may be recorded in the manifest
+            if cp_succeeded(cp(src_filename, dst_filename)):
+                copied[dst_filename] = src_hash
+            else:
+                print_err("Unable to copy '{}' to '{}'".format(src_filename, dst_filename))
+
+    if mirror:  # May delete
+        removed = set()
+        for name in sorted(dst_files):
+            if name in src_files or name.rpartition('/')[0] in skipped:
+                continue
+            if name.rpartition('/')[0] in removed:
+                removed.add(name)
+                continue
+            dst_filename = dst_dir + '/' + name
+            print_func("Removing %s" % dst_filename)
+            removed.add(name)
+            if not dry_run:
+                rm(dst_filename, recursive=True, force=True)
+
+    dst_dev, _ = get_dev_and_path(dst_dir)
+    if dst_dev is not None and copied:
+        dst_dev.remote_eval(update_manifest,
+                            dict((get_dev_and_path(filename)[1], copied[filename])
+                                 for filename in copied))
+
 # rtc_time[0] - year    4 digit
 # rtc_time[1] - month   1..12
 # rtc_time[2] - day     1..31
@@ -1213,6 +1479,103 @@ def send_file_to_host(src_filename, dst_file, filesize):
         return False
 
 
+# The windowed protocol keeps up to XFER_WINDOW chunks in flight instead of
+# waiting for an ack after every chunk, which hides the USB round trip. The
+# remote starts with STX, the chunk size it picked (the largest of
+# BUFFER_SIZE, 2 * BUFFER_SIZE, ... up to XFER_CHUNK_SIZE that it has memory
+# for) and a newline, then streams the chunks. The host acks each chunk with
+# ACK followed by the chunk's sequence number (mod 256), and the remote stops
+# sending while XFER_WINDOW chunks are unacked. Only used with
+# sys.stdin.buffer, as the acks contain arbitrary bytes.
+
+def recv_file_from_remote_windowed(dev, src_filename, dst_file, filesize):
+    """Intended to be passed to the `remote` function as the xfer_func argument.
+       Matches up with send_file_to_host_windowed.
+    """
+    save_timeout = dev.timeout
+    dev.timeout = 2
+    start = dev.read(1)
+    if start != b'\x02':
+        # The remote failed before it could start the transfer (the rest of
+        # its output is picked up by remote)
+        sys.stderr.write("error starting transfer from remote: {!r}\n".format(start))
+        dev.timeout = save_timeout
+        return
+    header = b''
+    while not header.endswith(b'\n'):
+        char = dev.read(1)
+        if not char:
+            sys.stderr.write("timed out in transfer from remote\n")
+            sys.exit(2)
+        header += char
+    chunk_size = int(header)
+    if DEBUG:
+        print('Windowed transfer: chunk size %d, window %d' % (chunk_size, XFER_WINDOW))
+
+    bytes_remaining = filesize
+    seq = 0
+    while bytes_remaining > 0:
+        read_size = min(bytes_remaining, chunk_size)
+        buf = dev.read(read_size)
+        while len(buf) < read_size:
+            read_buf = dev.read(read_size - len(buf))
+            if not read_buf:
+                sys.stderr.write("timed out in transfer from remote\n")
+                sys.exit(2)
+            buf += read_buf
+        # Ack before writing so the remote can keep sending meanwhile
+        dev.write(bytes((0x06, seq & 0xff)))
+        dst_file.write(buf)
+        seq += 1
+        bytes_remaining -= read_size
+    dev.timeout = save_timeout
+
+
+def send_file_to_host_windowed(src_filename, dst_file, filesize):
+    """Function which runs on the pyboard. Matches up with recv_file_from_remote_windowed."""
+    import sys
+    import gc
+    try:
+        import micropython
+        # The acks may contain 0x03 bytes, which mustn't be taken as a Control-C
+        micropython.kbd_intr(-1)
+    except:
+        pass
+    try:
+        with open(src_filename, 'rb') as src_file:
+            gc.collect()
+            chunk_size = BUFFER_SIZE
+            while chunk_size * 2 <= XFER_CHUNK_SIZE and chunk_size * 8 <= gc.mem_free():
+                chunk_size *= 2
+            buf = bytearray(chunk_size)
+            sys.stdout.write('\x02%d\n' % chunk_size)
+            bytes_remaining = filesize
+            sent = 0
+            acked = 0
+            while bytes_remaining > 0 or acked < sent:
+                if bytes_remaining > 0 and sent - acked < XFER_WINDOW:
+                    read_size = min(bytes_remaining, chunk_size)
+                    if read_size < chunk_size:
+                        buf = bytearray(read_size)
+                    if src_file.readinto(buf) != read_size:
+                        # File shrank since its size was taken
+                        return False
+                    sys.stdout.buffer.write(buf)
+                    bytes_remaining -= read_size
+                    sent += 1
+                    continue
+                # Window full (or everything sent), wait for the oldest ack
+                char = sys.stdin.buffer.read(1)
+                if char != b'\x06':
+                    continue
+                if sys.stdin.buffer.read(1)[0] != acked & 0xff:
+                    return False
+                acked += 1
+        return True
+    except:
+        return False
+
+
 def test_buffer():
     """Checks the micropython firmware to see if sys.stdin.buffer exists."""
     import sys
@@ -1493,21 +1856,26 @@ class Device(object):
         self.time_offset = 0
         self.adjust_for_timezone = False
         self.sysname = ''
+        # The board's properties which don't depend on each other are
+        # retrieved in one go
+        test_func = test_unhexlify if ASCII_XFER else test_buffer
+        board_sysname, test_result, root_dirs, epoch_tuple = self.remote_eval_batch([
+            (sysname, ()), (test_func, ()), (listdir, ('/',)), (get_time_epoch, ())])
         QUIET or print('Retrieving sysname ... ', end='', flush=True)
-        self.sysname = self.remote_eval(sysname)
+        self.sysname = board_sysname
         QUIET or print(self.sysname)
         if not ASCII_XFER:
             QUIET or print('Testing if sys.stdin.buffer exists ... ', end='', flush=True)
-            self.has_buffer = self.remote_eval(test_buffer)
+            self.has_buffer = test_result
             QUIET or print('Y' if self.has_buffer else 'N')
         else:
             QUIET or print('Testing if ubinascii.unhexlify exists ... ', end='', flush=True)
-            unhexlify_exists = self.remote_eval(test_unhexlify)
+            unhexlify_exists = test_result
             QUIET or print('Y' if unhexlify_exists else 'N')
             if not unhexlify_exists:
                 raise ShellError('rshell needs MicroPython firmware with ubinascii.unhexlify')
         QUIET or print('Retrieving root directories ... ', end='', flush=True)
-        self.root_dirs = ['/{}/'.format(dir) for dir in self.remote_eval(listdir, '/')]
+        self.root_dirs = ['/{}/'.format(dir) for dir in root_dirs]
         QUIET or print(' '.join(self.root_dirs))
         QUIET or print('Setting time ... ', end='', flush=True)
         now = self.sync_time()
@@ -1521,7 +1889,6 @@ class Device(object):
             print('----')
         self.dev_name_short = self.name
         QUIET or print('Retrieving time epoch ... ', end='', flush=True)
-        epoch_tuple = self.remote_eval(get_time_epoch)
         if len(epoch_tuple) == 8:
             epoch_tuple = epoch_tuple + (0,)
         QUIET or print(time.strftime('%b %d, %Y', epoch_tuple))
@@ -1567,38 +1934,42 @@ class Device(object):
             self.close()
             raise DeviceError('serial port %s closed' % self.dev_name_short)
 
-    def remote(self, func, *args, xfer_func=None, **kwargs):
-        """Calls func with the indicated args on the micropython board."""
-        global HAS_BUFFER
-        HAS_BUFFER = self.has_buffer
-        if hasattr(func, 'extra_funcs'):
-          func_name = func.name
-          func_lines = []
-          for extra_func in func.extra_funcs:
-            func_lines += inspect.getsource(extra_func).split('\n')
-            func_lines += ['']
-          func_lines += filter(lambda line: line[:1] != '@', func.source.split('\n'))
-          func_src = '\n'.join(func_lines)
-        else:
-          func_name = func.__name__
-          func_src = inspect.getsource(func)
+    def remote_source(self, funcs):
+        """Returns the source code of funcs, and of the functions they
+           depend on, prepared to be run on the micropython board. Each
+           function is only included once.
+        """
+        names = set()
+        func_lines = []
+        for func in funcs:
+            if hasattr(func, 'extra_funcs'):
+                sources = [(extra_func.__name__, inspect.getsource(extra_func))
+                           for extra_func in func.extra_funcs]
+                sources.append((func.name, '\n'.join(filter(lambda line: line[:1] != '@',
+                                                             func.source.split('\n')))))
+            else:
+                sources = [(func.__name__, inspect.getsource(func))]
+            for name, source in sources:
+                if name not in names:
+                    names.add(name)
+                    func_lines += source.split('\n')
+                    func_lines += ['']
+        func_src = '\n'.join(func_lines)
         if self.sysname == 'rp2':
             func_src = func_src.replace('#rp2: ', '')
-        func_src = strip_source(func_src)
-        args_arr = [remote_repr(i) for i in args]
-        kwargs_arr = ["{}={}".format(k, remote_repr(v)) for k, v in kwargs.items()]
-        func_src += 'output = ' + func_name + '('
-        func_src += ', '.join(args_arr + kwargs_arr)
-        func_src += ')\n'
-        func_src += 'if output is None:\n'
-        func_src += '    print("None")\n'
-        func_src += 'else:\n'
-        func_src += '    print(output)\n'
+        return strip_source(func_src)
+
+    def remote_exec(self, func_src, xfer_func=None, *args, **kwargs):
+        """Runs func_src on the micropython board in a single raw REPL
+           session, and returns its output.
+        """
         time_offset = self.time_offset
         if self.adjust_for_timezone:
           time_offset -= time.localtime().tm_gmtoff
         func_src = func_src.replace('TIME_OFFSET', '{}'.format(time_offset))
         func_src = func_src.replace('HAS_BUFFER', '{}'.format(HAS_BUFFER))
+        func_src = func_src.replace('XFER_CHUNK_SIZE', '{}'.format(XFER_CHUNK_SIZE))
+        func_src = func_src.replace('XFER_WINDOW', '{}'.format(XFER_WINDOW))
         func_src = func_src.replace('BUFFER_SIZE', '{}'.format(BUFFER_SIZE))
         func_src = func_src.replace('IS_UPY', 'True')
         if DEBUG:
@@ -1625,6 +1996,50 @@ class Device(object):
             print('-----')
         return output
 
+    def remote(self, func, *args, xfer_func=None, **kwargs):
+        """Calls func with the indicated args on the micropython board."""
+        global HAS_BUFFER
+        HAS_BUFFER = self.has_buffer
+        func_name = func.name if hasattr(func, 'extra_funcs') else func.__name__
+        func_src = self.remote_source([func])
+        args_arr = [remote_repr(i) for i in args]
+        kwargs_arr = ["{}={}".format(k, remote_repr(v)) for k, v in kwargs.items()]
+        func_src += 'output = ' + func_name + '('
+        func_src += ', '.join(args_arr + kwargs_arr)
+        func_src += ')\n'
+        func_src += 'if output is None:\n'
+        func_src += '    print("None")\n'
+        func_src += 'else:\n'
+        func_src += '    print(output)\n'
+        return self.remote_exec(func_src, xfer_func, *args, **kwargs)
+
+    def remote_eval_batch(self, calls):
+        """Calls several functions on the micropython board in one go, and
+           converts each response back into python by using eval. calls is
+           a list of (func, args) or (func, args, kwargs) tuples. Returns the
+           list of results, in the same order. Anything else the functions
+           print is discarded.
+        """
+        global HAS_BUFFER
+        HAS_BUFFER = self.has_buffer
+        if not calls:
+            return []
+        func_src = self.remote_source([call[0] for call in calls])
+        func_src += 'outputs = []\n'
+        for call in calls:
+            func, args = call[0], call[1]
+            kwargs = call[2] if len(call) > 2 else {}
+            func_name = func.name if hasattr(func, 'extra_funcs') else func.__name__
+            args_arr = [remote_repr(i) for i in args]
+            kwargs_arr = ["{}={}".format(k, remote_repr(v)) for k, v in kwargs.items()]
+            # str() matches what remote prints, including for None
+            func_src += 'outputs.append(str(' + func_name + '('
+            func_src += ', '.join(args_arr + kwargs_arr)
+            func_src += ')))\n'
+        func_src += 'print(repr(outputs))\n'
+        outputs = self.remote_exec(func_src).split(b'\r\n')[-2]
+        return [eval(output) for output in eval(outputs)]
+
     def remote_eval(self, func, *args, **kwargs):
         """Calls func with the indicated args on the micropython board, and
            converts the response back into python by using eval.
@@ -2294,8 +2709,11 @@ class Shell(cmd.Cmd):
             if is_pattern(src_filename):
                 print_err("Only one pattern permitted.")
                 return
-            src_filename = resolve_path(src_filename)
-            src_mode = auto(get_mode, src_filename)
+        src_filenames = [resolve_path(src_filename) for src_filename in src_filenames]
+        src_stats = auto_batch(get_stat, src_filenames)
+
+        for src_filename, src_stat in zip(src_filenames, src_stats):
+            src_mode = stat_mode(src_stat)
             if not mode_exists(src_mode):
                 print_err("File '{}' doesn't exist".format(src_filename))
                 return
@@ -2326,7 +2744,7 @@ class Shell(cmd.Cmd):
             else:
                 dst_filename = dst_dirname
             self.print("Copying '{}' to '{}' ...".format(src_filename, dst_filename))
-            if not cp(src_filename, dst_filename):
+            if not cp(src_filename, dst_filename, stat_size(src_stat)):
                 err = "Unable to copy '{}' to '{}'"
                 print_err(err.format(src_filename, dst_filename))
                 break
@@ -2513,10 +2931,15 @@ class Shell(cmd.Cmd):
         args = self.line_to_args(line)
         if len(args.filenames) == 0:
             args.filenames = ['.']
+        # Stat every argument and list every directory in one go
+        filenames = [resolve_path(fn) for fn in args.filenames if not is_pattern(fn)]
+        stats = dict(zip(filenames, auto_batch(get_stat, filenames)))
+        dirnames = [filename for filename in stats if mode_isdir(stat_mode(stats[filename]))]
+        ldir_stats = dict(zip(dirnames, auto_batch(listdir_lstat, dirnames)))
         for idx, fn in enumerate(args.filenames):
             if not is_pattern(fn):
                 filename = resolve_path(fn)
-                stat = auto(get_stat, filename)
+                stat = stats[filename]
                 mode = stat_mode(stat)
                 if not mode_exists(mode):
                     err = "Cannot access '{}': No such file or directory"
@@ -2538,7 +2961,10 @@ class Shell(cmd.Cmd):
                 if filename is None: # An error was printed
                     continue
             files = []
-            ldir_stat = auto(listdir_lstat, filename)
+            if filename in ldir_stats:
+                ldir_stat = ldir_stats[filename]
+            else:
+                ldir_stat = auto(listdir_lstat, filename)
             if ldir_stat is None:
                 err = "Cannot access '{}': No such file or directory"
                 print_err(err.format(filename))
@@ -2756,12 +3182,13 @@ class Shell(cmd.Cmd):
             if filenames is None:
                 return
 
-        for filename in filenames:
-            filename = resolve_path(filename)
-            if not rm(filename, recursive=args.recursive, force=args.force):
-                if not args.force:
-                    print_err("Unable to remove '{}'".format(filename))
-                break
+        # All the files are removed in one go, so removal doesn't stop at
+        # the first file which can't be removed
+        filenames = [resolve_path(filename) for filename in filenames]
+        results = auto_batch(remove_file, filenames, args.recursive, args.force)
+        for filename, result in zip(filenames, results):
+            if not result and not args.force:
+                print_err("Unable to remove '{}'".format(filename))
 
     def do_shell(self, line):
         """!some-shell-command args
@@ -2782,6 +3209,15 @@ class Shell(cmd.Cmd):
             help='Don\'t ignore files starting with .',
             default=False
         ),
+        add_arg(
+            '-c', '--checksum',
+            dest='checksum',
+            action='store_true',
+            help="compares files by a hash of their contents instead of "
+                 "their modification times. The board caches the hashes "
+                 "of its files in a manifest.",
+            default=False
+        ),
         add_arg(
             '-m', '--mirror',
             dest='mirror',
@@ -2819,7 +3255,7 @@ class Shell(cmd.Cmd):
     )
 
     def do_rsync(self, line):
-        """rsync [-m|--mirror] [-n|--dry-run] [-q|--quiet] SRC_DIR DEST_DIR
+        """rsync [-c|--checksum] [-m|--mirror] [-n|--dry-run] [-q|--quiet] SRC_DIR DEST_DIR
 
            Synchronizes a destination directory tree with a source directory tree.
         """
@@ -2828,6 +3264,10 @@ class Shell(cmd.Cmd):
         dst_dir = resolve_path(args.dst_dir)
         verbose = not args.quiet
         pf = print if args.dry_run or verbose else lambda *args : None
+        if args.checksum:
+            rsync_checksum(src_dir, dst_dir, mirror=args.mirror, dry_run=args.dry_run,
+                           print_func=pf, sync_hidden=args.all)
+            return
         rsync(src_dir, dst_dir, mirror=args.mirror, dry_run=args.dry_run,
              print_func=pf, recursed=False, sync_hidden=args.all)
 
@@ -2848,7 +3288,7 @@ def real_main():
     default_editor = os.getenv('RSHELL_EDITOR') or os.getenv('VISUAL') or os.getenv('EDITOR') or 'vi'
     default_color = sys.stdout.isatty()
     default_nocolor = not default_color
-    global BUFFER_SIZE
+    global BUFFER_SIZE, XFER_WINDOW
     try:
         default_buffer_size = int(os.getenv('RSHELL_BUFFER_SIZE'))
     except:
@@ -2877,6 +3317,14 @@ def real_main():
              "(default = %d for USB, %d for UART)" %
              (USB_BUFFER_SIZE, UART_BUFFER_SIZE),
     )
+    parser.add_argument(
+        "--xfer-window",
+        dest="xfer_window",
+        action="store",
+        type=int,
+        help="Set the number of chunks in flight when copying from the board, "
+             "1 waits for an ack after every chunk (default = %d)" % XFER_WINDOW,
+    )
     parser.add_argument(
         "-p", "--port",
         dest="port",
@@ -2985,6 +3433,9 @@ def real_main():
     if args.buffer_size is not None:
         BUFFER_SIZE = args.buffer_size
 
+    if args.xfer_window is not None:
+        XFER_WINDOW = max(args.xfer_window, 1)
+
     if args.debug:
         print("Debug = %s" % args.debug)
         print("Port = %s" % args.port)
@@ -2998,6 +3449,7 @@ def real_main():
         print("Timing = %d" % args.timing)
         print("Quiet = %d" % args.quiet)
         print("BUFFER_SIZE = %d" % BUFFER_SIZE)
+        print("XFER_WINDOW = %d" % XFER_WINDOW)
         print("Cmd = [%s]" % ', '.join(args.cmd))
 
     if args.version:
@@ -37,6 +37,7 @@ Or:
 
 """
 
+import struct
 import sys
 import time
 
@@ -121,6 +122,7 @@ def parse_bool(str):
 
 class Pyboard:
     def __init__(self, device, baudrate=115200, user='micro', password='python', wait=0, rts='', dtr=''):
+        self.use_raw_paste = True
         if device and device[0].isdigit() and device[-1].isdigit() and device.count('.') == 3:
             # device looks like an IP address
             self.serial = TelnetToSerial(device, user, password, read_timeout=10)
@@ -238,6 +240,23 @@ class Pyboard:
         if not data.endswith(b'>'):
             raise PyboardError('could not enter raw repl')
 
+        if self.use_raw_paste:
+            # try to enter raw-paste mode
+            self.serial.write(b'\x05A\x01')
+            data = self.serial.read(2)
+            if data == b'R\x01':
+                # device supports raw-paste mode, write the command with flow control
+                return self.raw_paste_write(command_bytes)
+            if data != b'R\x00':
+                # device doesn't know raw-paste mode and took the request as
+                # input, so wait for the raw REPL prompt it prints again
+                data = self.read_until(1, b'w REPL; CTRL-B to exit\r\n>')
+                if not data.endswith(b'w REPL; CTRL-B to exit\r\n>'):
+                    print(data)
+                    raise PyboardError('could not enter raw repl')
+            # don't try raw-paste mode again on this connection
+            self.use_raw_paste = False
+
         # write command
         for i in range(0, len(command_bytes), 256):
             self.serial.write(command_bytes[i:min(i + 256, len(command_bytes))])
@@ -249,6 +268,36 @@ class Pyboard:
         if data != b'OK':
             raise PyboardError('could not exec command')
 
+    def raw_paste_write(self, command_bytes):
+        # the device starts with the size of its window, it then sends \x01
+        # each time another window's worth of data may be sent
+        data = self.serial.read(2)
+        window_size = struct.unpack('<H', data)[0]
+        window_remain = window_size
+
+        i = 0
+        while i < len(command_bytes):
+            while window_remain == 0 or self.serial.inWaiting():
+                data = self.serial.read(1)
+                if data == b'\x01':
+                    window_remain += window_size
+                elif data == b'\x04':
+                    # device ended the transfer early (e.g. on a syntax error), acknowledge it
+                    self.serial.write(b'\x04')
+                    return
+                else:
+                    raise PyboardError('unexpected read during raw paste: {!r}'.format(data))
+            chunk = command_bytes[i:min(i + window_remain, len(command_bytes))]
+            self.serial.write(chunk)
+            window_remain -= len(chunk)
+            i += len(chunk)
+
+        # end of data, wait for the device to acknowledge it
+        self.serial.write(b'\x04')
+        data = self.read_until(1, b'\x04')
+        if not data.endswith(b'\x04'):
+            raise PyboardError('could not complete raw paste: {!r}'.format(data))
+
     def exec_raw(self, command, timeout=10, data_consumer=None):
         self.exec_raw_no_follow(command);
         return self.follow(timeout, data_consumer)
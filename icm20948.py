@@ -1,9 +1,18 @@
 from machine import I2C
+from micropython import const
+from array import array
+from Kernels import decodeBurst, ahrsUpdate
 import time
 import math
 
-Gyro  = [0,0,0]
-Accel = [0,0,0]
+# Register constants are const() with a leading underscore, so they are
+# inlined by the compiler and take no space in the module's globals
+
+# Raw burst values (ax, ay, az, gx, gy, gz, temp), Accel/Gyro/Temp are views into it
+Raw   = array('i', [0,0,0,0,0,0,0])
+Accel = memoryview(Raw)[0:3]
+Gyro  = memoryview(Raw)[3:6]
+Temp  = memoryview(Raw)[6:7]
 Mag   = [0,0,0]
 pitch = 0.0
 roll  = 0.0
@@ -12,183 +21,182 @@ pu8data=[0,0,0,0,0,0,0,0]
 U8tempX=[0,0,0,0,0,0,0,0,0]
 U8tempY=[0,0,0,0,0,0,0,0,0]
 U8tempZ=[0,0,0,0,0,0,0,0,0]
-GyroOffset=[0,0,0]
+GyroOffset=array('i', [0,0,0])
 Ki = 1.0
 Kp = 4.50
 q0 = 1.0
 q1=q2=q3=0.0
+Quat = array('f', [1.0,0.0,0.0,0.0])    # AHRS state (q0, q1, q2, q3)
 angles=[0.0,0.0,0.0]
-true                                 =0x01
-false                                =0x00
+_true                                =const(0x01)
+_false                               =const(0x00)
 # define ICM-20948 Device I2C address
-I2C_ADD_ICM20948                     = 0x68
-I2C_ADD_ICM20948_AK09916             = 0x0C
-I2C_ADD_ICM20948_AK09916_READ        = 0x80
-I2C_ADD_ICM20948_AK09916_WRITE       = 0x00
+_I2C_ADD_ICM20948                    = const(0x68)
+_I2C_ADD_ICM20948_AK09916            = const(0x0C)
+_I2C_ADD_ICM20948_AK09916_READ       = const(0x80)
+_I2C_ADD_ICM20948_AK09916_WRITE      = const(0x00)
 # define ICM-20948 Register
 # user bank 0 register
-REG_ADD_WIA                          = 0x00
-REG_VAL_WIA                          = 0xEA
-REG_ADD_USER_CTRL                    = 0x03
-REG_VAL_BIT_DMP_EN                   = 0x80
-REG_VAL_BIT_FIFO_EN                  = 0x40
-REG_VAL_BIT_I2C_MST_EN               = 0x20
-REG_VAL_BIT_I2C_IF_DIS               = 0x10
-REG_VAL_BIT_DMP_RST                  = 0x08
-REG_VAL_BIT_DIAMOND_DMP_RST          = 0x04
-REG_ADD_PWR_MIGMT_1                  = 0x06
-REG_VAL_ALL_RGE_RESET                = 0x80
-REG_VAL_RUN_MODE                     = 0x01 # Non low-power mode
-REG_ADD_LP_CONFIG                    = 0x05
-REG_ADD_PWR_MGMT_1                   = 0x06
-REG_ADD_PWR_MGMT_2                   = 0x07
-REG_ADD_ACCEL_XOUT_H                 = 0x2D
-REG_ADD_ACCEL_XOUT_L                 = 0x2E
-REG_ADD_ACCEL_YOUT_H                 = 0x2F
-REG_ADD_ACCEL_YOUT_L                 = 0x30
-REG_ADD_ACCEL_ZOUT_H                 = 0x31
-REG_ADD_ACCEL_ZOUT_L                 = 0x32
-REG_ADD_GYRO_XOUT_H                  = 0x33
-REG_ADD_GYRO_XOUT_L                  = 0x34
-REG_ADD_GYRO_YOUT_H                  = 0x35
-REG_ADD_GYRO_YOUT_L                  = 0x36
-REG_ADD_GYRO_ZOUT_H                  = 0x37
-REG_ADD_GYRO_ZOUT_L                  = 0x38
-REG_ADD_EXT_SENS_DATA_00             = 0x3B
-REG_ADD_REG_BANK_SEL                 = 0x7F
-REG_VAL_REG_BANK_0                   = 0x00
-REG_VAL_REG_BANK_1                   = 0x10
-REG_VAL_REG_BANK_2                   = 0x20
-REG_VAL_REG_BANK_3                   = 0x30
+_REG_ADD_WIA                         = const(0x00)
+_REG_VAL_WIA                         = const(0xEA)
+_REG_ADD_USER_CTRL                   = const(0x03)
+_REG_VAL_BIT_DMP_EN                  = const(0x80)
+_REG_VAL_BIT_FIFO_EN                 = const(0x40)
+_REG_VAL_BIT_I2C_MST_EN              = const(0x20)
+_REG_VAL_BIT_I2C_IF_DIS              = const(0x10)
+_REG_VAL_BIT_DMP_RST                 = const(0x08)
+_REG_VAL_BIT_DIAMOND_DMP_RST         = const(0x04)
+_REG_ADD_PWR_MIGMT_1                 = const(0x06)
+_REG_VAL_ALL_RGE_RESET               = const(0x80)
+_REG_VAL_RUN_MODE                    = const(0x01) # Non low-power mode
+_REG_ADD_LP_CONFIG                   = const(0x05)
+_REG_ADD_PWR_MGMT_1                  = const(0x06)
+_REG_ADD_PWR_MGMT_2                  = const(0x07)
+_REG_ADD_ACCEL_XOUT_H                = const(0x2D)
+_REG_ADD_ACCEL_XOUT_L                = const(0x2E)
+_REG_ADD_ACCEL_YOUT_H                = const(0x2F)
+_REG_ADD_ACCEL_YOUT_L                = const(0x30)
+_REG_ADD_ACCEL_ZOUT_H                = const(0x31)
+_REG_ADD_ACCEL_ZOUT_L                = const(0x32)
+_REG_ADD_GYRO_XOUT_H                 = const(0x33)
+_REG_ADD_GYRO_XOUT_L                 = const(0x34)
+_REG_ADD_GYRO_YOUT_H                 = const(0x35)
+_REG_ADD_GYRO_YOUT_L                 = const(0x36)
+_REG_ADD_GYRO_ZOUT_H                 = const(0x37)
+_REG_ADD_GYRO_ZOUT_L                 = const(0x38)
+_REG_ADD_TEMP_OUT_H                  = const(0x39)
+_REG_ADD_TEMP_OUT_L                  = const(0x3A)
+_REG_ADD_EXT_SENS_DATA_00            = const(0x3B)
+_REG_ADD_REG_BANK_SEL                = const(0x7F)
+_REG_VAL_REG_BANK_0                  = const(0x00)
+_REG_VAL_REG_BANK_1                  = const(0x10)
+_REG_VAL_REG_BANK_2                  = const(0x20)
+_REG_VAL_REG_BANK_3                  = const(0x30)
 
 # user bank 1 register
 # user bank 2 register
-REG_ADD_GYRO_SMPLRT_DIV              = 0x00
-REG_ADD_GYRO_CONFIG_1                = 0x01
-REG_VAL_BIT_GYRO_DLPCFG_2            = 0x10  # bit[5:3]
-REG_VAL_BIT_GYRO_DLPCFG_4            = 0x20  # bit[5:3]
-REG_VAL_BIT_GYRO_DLPCFG_6            = 0x30  # bit[5:3]
-REG_VAL_BIT_GYRO_FS_250DPS           = 0x00  # bit[2:1]
-REG_VAL_BIT_GYRO_FS_500DPS           = 0x02  # bit[2:1]
-REG_VAL_BIT_GYRO_FS_1000DPS          = 0x04  # bit[2:1]
-REG_VAL_BIT_GYRO_FS_2000DPS          = 0x06  # bit[2:1]
-REG_VAL_BIT_GYRO_DLPF                = 0x01  # bit[0]
-REG_ADD_ACCEL_SMPLRT_DIV_2           = 0x11
-REG_ADD_ACCEL_CONFIG                 = 0x14
-REG_VAL_BIT_ACCEL_DLPCFG_2           = 0x10  # bit[5:3]
-REG_VAL_BIT_ACCEL_DLPCFG_4           = 0x20  # bit[5:3]
-REG_VAL_BIT_ACCEL_DLPCFG_6           = 0x30  # bit[5:3]
-REG_VAL_BIT_ACCEL_FS_2g              = 0x00  # bit[2:1]
-REG_VAL_BIT_ACCEL_FS_4g              = 0x02  # bit[2:1]
-REG_VAL_BIT_ACCEL_FS_8g              = 0x04  # bit[2:1]
-REG_VAL_BIT_ACCEL_FS_16g             = 0x06  # bit[2:1]
-REG_VAL_BIT_ACCEL_DLPF               = 0x01  # bit[0]
+_REG_ADD_GYRO_SMPLRT_DIV             = const(0x00)
+_REG_ADD_GYRO_CONFIG_1               = const(0x01)
+_REG_VAL_BIT_GYRO_DLPCFG_2           = const(0x10)  # bit[5:3]
+_REG_VAL_BIT_GYRO_DLPCFG_4           = const(0x20)  # bit[5:3]
+_REG_VAL_BIT_GYRO_DLPCFG_6           = const(0x30)  # bit[5:3]
+_REG_VAL_BIT_GYRO_FS_250DPS          = const(0x00)  # bit[2:1]
+_REG_VAL_BIT_GYRO_FS_500DPS          = const(0x02)  # bit[2:1]
+_REG_VAL_BIT_GYRO_FS_1000DPS         = const(0x04)  # bit[2:1]
+_REG_VAL_BIT_GYRO_FS_2000DPS         = const(0x06)  # bit[2:1]
+_REG_VAL_BIT_GYRO_DLPF               = const(0x01)  # bit[0]
+_REG_ADD_ACCEL_SMPLRT_DIV_2          = const(0x11)
+_REG_ADD_ACCEL_CONFIG                = const(0x14)
+_REG_VAL_BIT_ACCEL_DLPCFG_2          = const(0x10)  # bit[5:3]
+_REG_VAL_BIT_ACCEL_DLPCFG_4          = const(0x20)  # bit[5:3]
+_REG_VAL_BIT_ACCEL_DLPCFG_6          = const(0x30)  # bit[5:3]
+_REG_VAL_BIT_ACCEL_FS_2g             = const(0x00)  # bit[2:1]
+_REG_VAL_BIT_ACCEL_FS_4g             = const(0x02)  # bit[2:1]
+_REG_VAL_BIT_ACCEL_FS_8g             = const(0x04)  # bit[2:1]
+_REG_VAL_BIT_ACCEL_FS_16g            = const(0x06)  # bit[2:1]
+_REG_VAL_BIT_ACCEL_DLPF              = const(0x01)  # bit[0]
 
 # user bank 3 register
-REG_ADD_I2C_SLV0_ADDR                = 0x03
-REG_ADD_I2C_SLV0_REG                 = 0x04
-REG_ADD_I2C_SLV0_CTRL                = 0x05
-REG_VAL_BIT_SLV0_EN                  = 0x80
-REG_VAL_BIT_MASK_LEN                 = 0x07
-REG_ADD_I2C_SLV0_DO                  = 0x06
-REG_ADD_I2C_SLV1_ADDR                = 0x07
-REG_ADD_I2C_SLV1_REG                 = 0x08
-REG_ADD_I2C_SLV1_CTRL                = 0x09
-REG_ADD_I2C_SLV1_DO                  = 0x0A
+_REG_ADD_I2C_SLV0_ADDR               = const(0x03)
+_REG_ADD_I2C_SLV0_REG                = const(0x04)
+_REG_ADD_I2C_SLV0_CTRL               = const(0x05)
+_REG_VAL_BIT_SLV0_EN                 = const(0x80)
+_REG_VAL_BIT_MASK_LEN                = const(0x07)
+_REG_ADD_I2C_SLV0_DO                 = const(0x06)
+_REG_ADD_I2C_SLV1_ADDR               = const(0x07)
+_REG_ADD_I2C_SLV1_REG                = const(0x08)
+_REG_ADD_I2C_SLV1_CTRL               = const(0x09)
+_REG_ADD_I2C_SLV1_DO                 = const(0x0A)
 
 # define ICM-20948 Register  end
 
 # define ICM-20948 MAG Register
-REG_ADD_MAG_WIA1                     = 0x00
-REG_VAL_MAG_WIA1                     = 0x48
-REG_ADD_MAG_WIA2                     = 0x01
-REG_VAL_MAG_WIA2                     = 0x09
-REG_ADD_MAG_ST2                      = 0x10
-REG_ADD_MAG_DATA                     = 0x11
-REG_ADD_MAG_CNTL2                    = 0x31
-REG_VAL_MAG_MODE_PD                  = 0x00
-REG_VAL_MAG_MODE_SM                  = 0x01
-REG_VAL_MAG_MODE_10HZ                = 0x02
-REG_VAL_MAG_MODE_20HZ                = 0x04
-REG_VAL_MAG_MODE_50HZ                = 0x05
-REG_VAL_MAG_MODE_100HZ               = 0x08
-REG_VAL_MAG_MODE_ST                  = 0x10
+_REG_ADD_MAG_WIA1                    = const(0x00)
+_REG_VAL_MAG_WIA1                    = const(0x48)
+_REG_ADD_MAG_WIA2                    = const(0x01)
+_REG_VAL_MAG_WIA2                    = const(0x09)
+_REG_ADD_MAG_ST2                     = const(0x10)
+_REG_ADD_MAG_DATA                    = const(0x11)
+_REG_ADD_MAG_CNTL2                   = const(0x31)
+_REG_VAL_MAG_MODE_PD                 = const(0x00)
+_REG_VAL_MAG_MODE_SM                 = const(0x01)
+_REG_VAL_MAG_MODE_10HZ               = const(0x02)
+_REG_VAL_MAG_MODE_20HZ               = const(0x04)
+_REG_VAL_MAG_MODE_50HZ               = const(0x05)
+_REG_VAL_MAG_MODE_100HZ              = const(0x08)
+_REG_VAL_MAG_MODE_ST                 = const(0x10)
 # define ICM-20948 MAG Register  end
 
-MAG_DATA_LEN                         =6
+_MAG_DATA_LEN                        =const(6)
+# status 1, data, dummy and status 2 (reading status 2 releases the next sample)
+_MAG_FRAME_LEN                       =const(9)
+# accel, gyro and temperature are read in one burst
+_ACCEL_GYRO_TEMP_DATA_LEN            =const(14)
+# temperature in degC = TEMP_OUT / TEMP_SENSITIVITY + _TEMP_ROOM_OFFSET
+TEMP_SENSITIVITY                     =333.87
+_TEMP_ROOM_OFFSET                    =const(21)
 
 class ICM20948(object):
-  def __init__(self,address=I2C_ADD_ICM20948):
+  def __init__(self,address=_I2C_ADD_ICM20948):
     self._address = address
     self._bus = I2C(1)
+    self._wbuf = bytearray(1)                           # Preallocated so register access does not allocate
+    self._burst = bytearray(_ACCEL_GYRO_TEMP_DATA_LEN)
+    self._mag = bytearray(_MAG_FRAME_LEN)
+    self._bank = -1                                     # Register bank last selected, -1 until the first select
     bRet=self.icm20948Check()             #Initialization of the device multiple times after power on will result in a return error
-    # while true != bRet:
+    # while _true != bRet:
     #   print("ICM-20948 Error\n" )
     #   time.sleep(0.5)
     # print("ICM-20948 OK\n" )
     time.sleep(0.5)                       #We can skip this detection by delaying it by 500 milliseconds
     # user bank 0 register 
-    self._write_byte( REG_ADD_REG_BANK_SEL , REG_VAL_REG_BANK_0)
-    self._write_byte( REG_ADD_PWR_MIGMT_1 , REG_VAL_ALL_RGE_RESET)
+    self._write_byte( _REG_ADD_REG_BANK_SEL , _REG_VAL_REG_BANK_0)
+    self._write_byte( _REG_ADD_PWR_MIGMT_1 , _REG_VAL_ALL_RGE_RESET)
     time.sleep(0.1)
-    self._write_byte( REG_ADD_PWR_MIGMT_1 , REG_VAL_RUN_MODE)  
+    self._write_byte( _REG_ADD_PWR_MIGMT_1 , _REG_VAL_RUN_MODE)  
     #user bank 2 register
-    self._write_byte( REG_ADD_REG_BANK_SEL , REG_VAL_REG_BANK_2)
-    self._write_byte( REG_ADD_GYRO_SMPLRT_DIV , 0x07)
-    self._write_byte( REG_ADD_GYRO_CONFIG_1 , REG_VAL_BIT_GYRO_DLPCFG_6 | REG_VAL_BIT_GYRO_FS_1000DPS | REG_VAL_BIT_GYRO_DLPF)
-    self._write_byte( REG_ADD_ACCEL_SMPLRT_DIV_2 ,  0x07)
-    self._write_byte( REG_ADD_ACCEL_CONFIG , REG_VAL_BIT_ACCEL_DLPCFG_6 | REG_VAL_BIT_ACCEL_FS_2g | REG_VAL_BIT_ACCEL_DLPF)
+    self._write_byte( _REG_ADD_REG_BANK_SEL , _REG_VAL_REG_BANK_2)
+    self._write_byte( _REG_ADD_GYRO_SMPLRT_DIV , 0x07)
+    self._write_byte( _REG_ADD_GYRO_CONFIG_1 , _REG_VAL_BIT_GYRO_DLPCFG_6 | _REG_VAL_BIT_GYRO_FS_1000DPS | _REG_VAL_BIT_GYRO_DLPF)
+    self._write_byte( _REG_ADD_ACCEL_SMPLRT_DIV_2 ,  0x07)
+    self._write_byte( _REG_ADD_ACCEL_CONFIG , _REG_VAL_BIT_ACCEL_DLPCFG_6 | _REG_VAL_BIT_ACCEL_FS_2g | _REG_VAL_BIT_ACCEL_DLPF)
     #user bank 0 register
-    self._write_byte( REG_ADD_REG_BANK_SEL , REG_VAL_REG_BANK_0) 
+    self._write_byte( _REG_ADD_REG_BANK_SEL , _REG_VAL_REG_BANK_0) 
     time.sleep(0.1)
     self.gyroOffset()
     self.icm20948MagCheck()
-    self.writeSecondary( I2C_ADD_ICM20948_AK09916|I2C_ADD_ICM20948_AK09916_WRITE,REG_ADD_MAG_CNTL2, REG_VAL_MAG_MODE_20HZ)
+    self.writeSecondary( _I2C_ADD_ICM20948_AK09916|_I2C_ADD_ICM20948_AK09916_WRITE,_REG_ADD_MAG_CNTL2, _REG_VAL_MAG_MODE_20HZ)
+  def setSampleRate(self,rateHz):
+    # ODR = 1.1kHz/(1+div) for both gyro and accel, returns the rate set
+    div=int(1100/rateHz+0.5)-1
+    if div<0:
+      div=0
+    elif div>255:
+      div=255
+    self._write_byte( _REG_ADD_REG_BANK_SEL , _REG_VAL_REG_BANK_2)
+    self._write_byte( _REG_ADD_GYRO_SMPLRT_DIV , div)
+    self._write_byte( _REG_ADD_ACCEL_SMPLRT_DIV_2 , div)
+    self._write_byte( _REG_ADD_REG_BANK_SEL , _REG_VAL_REG_BANK_0)
+    return 1100/(1+div)
   def GyroAccelRead(self):
-    self._write_byte( REG_ADD_REG_BANK_SEL , REG_VAL_REG_BANK_0)
-    data =self._read_block(REG_ADD_ACCEL_XOUT_H, 12)
-    self._write_byte( REG_ADD_REG_BANK_SEL , REG_VAL_REG_BANK_2)
-    Accel[0] = (data[0]<<8)|data[1]
-    Accel[1] = (data[2]<<8)|data[3]
-    Accel[2] = (data[4]<<8)|data[5]
-    Gyro[0]  = ((data[6]<<8)|data[7]) - GyroOffset[0]
-    Gyro[1]  = ((data[8]<<8)|data[9]) - GyroOffset[1]
-    Gyro[2]  = ((data[10]<<8)|data[11]) - GyroOffset[2]
-    if Accel[0]>=32767:             #Solve the problem that Python shift will not overflow
-      Accel[0]=Accel[0]-65535
-    elif Accel[0]<=-32767:
-      Accel[0]=Accel[0]+65535
-    if Accel[1]>=32767:
-      Accel[1]=Accel[1]-65535
-    elif Accel[1]<=-32767:
-      Accel[1]=Accel[1]+65535
-    if Accel[2]>=32767:
-      Accel[2]=Accel[2]-65535
-    elif Accel[2]<=-32767:
-      Accel[2]=Accel[2]+65535
-    if Gyro[0]>=32767:
-      Gyro[0]=Gyro[0]-65535
-    elif Gyro[0]<=-32767:
-      Gyro[0]=Gyro[0]+65535
-    if Gyro[1]>=32767:
-      Gyro[1]=Gyro[1]-65535
-    elif Gyro[1]<=-32767:
-      Gyro[1]=Gyro[1]+65535
-    if Gyro[2]>=32767:
-      Gyro[2]=Gyro[2]-65535
-    elif Gyro[2]<=-32767:
-      Gyro[2]=Gyro[2]+65535
+    # Stays in bank 0 between samples, so the select is normally skipped
+    self._selectBank(_REG_VAL_REG_BANK_0)
+    data =self._read_into(_REG_ADD_ACCEL_XOUT_H, self._burst)
+    decodeBurst(data, Raw, GyroOffset)    # Sign extension and gyro offset, compiled on the Pico
+  def tempCelsius(self):
+    return Temp[0] / TEMP_SENSITIVITY + _TEMP_ROOM_OFFSET
   def magRead(self):
     counter=20
     while(counter>0):
       time.sleep(0.01)
-      self.readSecondary( I2C_ADD_ICM20948_AK09916|I2C_ADD_ICM20948_AK09916_READ , REG_ADD_MAG_ST2, 1)
+      self.readSecondary( _I2C_ADD_ICM20948_AK09916|_I2C_ADD_ICM20948_AK09916_READ , _REG_ADD_MAG_ST2, 1)
       if ((pu8data[0] & 0x01)!= 0):
         break
       counter-=1
     if counter!=0:
       for i in range(0,8):
-        self.readSecondary( I2C_ADD_ICM20948_AK09916|I2C_ADD_ICM20948_AK09916_READ , REG_ADD_MAG_DATA , MAG_DATA_LEN)
+        self.readSecondary( _I2C_ADD_ICM20948_AK09916|_I2C_ADD_ICM20948_AK09916_READ , _REG_ADD_MAG_DATA , _MAG_DATA_LEN)
         U8tempX[i] = (pu8data[1]<<8)|pu8data[0]
         U8tempY[i] = (pu8data[3]<<8)|pu8data[2]
         U8tempZ[i] = (pu8data[5]<<8)|pu8data[4]
@@ -207,56 +215,80 @@ class ICM20948(object):
       Mag[2]=Mag[2]-65535
     elif Mag[2]<=-32767:
       Mag[2]=Mag[2]+65535
+  def magStart(self):
+    # Let the I2C master read the magnetometer on its own, magFetch() then only reads EXT_SENS_DATA
+    # (magRead() and the secondary helpers switch the I2C master off again)
+    self._write_byte( _REG_ADD_REG_BANK_SEL, _REG_VAL_REG_BANK_3) #swtich bank3
+    self._write_byte( _REG_ADD_I2C_SLV1_CTRL, 0)                 #stop repeating the mode write
+    self._write_byte( _REG_ADD_I2C_SLV0_ADDR, _I2C_ADD_ICM20948_AK09916|_I2C_ADD_ICM20948_AK09916_READ)
+    self._write_byte( _REG_ADD_I2C_SLV0_REG,  _REG_ADD_MAG_ST2)
+    self._write_byte( _REG_ADD_I2C_SLV0_CTRL, _REG_VAL_BIT_SLV0_EN|_MAG_FRAME_LEN)
+    self._write_byte( _REG_ADD_REG_BANK_SEL, _REG_VAL_REG_BANK_0) #swtich bank0
+    u8Temp = self._read_byte(_REG_ADD_USER_CTRL)
+    self._write_byte( _REG_ADD_USER_CTRL, u8Temp|_REG_VAL_BIT_I2C_MST_EN)
+  def magFetch(self):
+    # Decode the last frame read by the I2C master into Mag (no sleeps, no allocation), False if it is not new
+    self._selectBank(_REG_VAL_REG_BANK_0)
+    data =self._read_into(_REG_ADD_EXT_SENS_DATA_00, self._mag)
+    if (data[0] & 0x01) == 0:
+      return False
+    x = data[1] | (data[2] << 8)
+    y = data[3] | (data[4] << 8)
+    z = data[5] | (data[6] << 8)
+    Mag[0] = x - 65536 if x >= 32768 else x
+    Mag[1] = -(y - 65536 if y >= 32768 else y)
+    Mag[2] = -(z - 65536 if z >= 32768 else z)
+    return True
   def readSecondary(self,u8I2CAddr,u8RegAddr,u8Len):
     u8Temp=0
-    self._write_byte( REG_ADD_REG_BANK_SEL,  REG_VAL_REG_BANK_3) #swtich bank3
-    self._write_byte( REG_ADD_I2C_SLV0_ADDR, u8I2CAddr)
-    self._write_byte( REG_ADD_I2C_SLV0_REG,  u8RegAddr)
-    self._write_byte( REG_ADD_I2C_SLV0_CTRL, REG_VAL_BIT_SLV0_EN|u8Len)
+    self._write_byte( _REG_ADD_REG_BANK_SEL,  _REG_VAL_REG_BANK_3) #swtich bank3
+    self._write_byte( _REG_ADD_I2C_SLV0_ADDR, u8I2CAddr)
+    self._write_byte( _REG_ADD_I2C_SLV0_REG,  u8RegAddr)
+    self._write_byte( _REG_ADD_I2C_SLV0_CTRL, _REG_VAL_BIT_SLV0_EN|u8Len)
 
-    self._write_byte( REG_ADD_REG_BANK_SEL, REG_VAL_REG_BANK_0) #swtich bank0
+    self._write_byte( _REG_ADD_REG_BANK_SEL, _REG_VAL_REG_BANK_0) #swtich bank0
     
-    u8Temp = self._read_byte(REG_ADD_USER_CTRL)
-    u8Temp |= REG_VAL_BIT_I2C_MST_EN
-    self._write_byte( REG_ADD_USER_CTRL, u8Temp)
+    u8Temp = self._read_byte(_REG_ADD_USER_CTRL)
+    u8Temp |= _REG_VAL_BIT_I2C_MST_EN
+    self._write_byte( _REG_ADD_USER_CTRL, u8Temp)
     time.sleep(0.01)
-    u8Temp &= ~REG_VAL_BIT_I2C_MST_EN
-    self._write_byte( REG_ADD_USER_CTRL, u8Temp)
+    u8Temp &= ~_REG_VAL_BIT_I2C_MST_EN
+    self._write_byte( _REG_ADD_USER_CTRL, u8Temp)
     
     for i in range(0,u8Len):
-      pu8data[i]= self._read_byte( REG_ADD_EXT_SENS_DATA_00+i)
+      pu8data[i]= self._read_byte( _REG_ADD_EXT_SENS_DATA_00+i)
 
-    self._write_byte( REG_ADD_REG_BANK_SEL, REG_VAL_REG_BANK_3) #swtich bank3
+    self._write_byte( _REG_ADD_REG_BANK_SEL, _REG_VAL_REG_BANK_3) #swtich bank3
     
-    u8Temp = self._read_byte(REG_ADD_I2C_SLV0_CTRL)
-    u8Temp &= ~((REG_VAL_BIT_I2C_MST_EN)&(REG_VAL_BIT_MASK_LEN))
-    self._write_byte( REG_ADD_I2C_SLV0_CTRL,  u8Temp)
+    u8Temp = self._read_byte(_REG_ADD_I2C_SLV0_CTRL)
+    u8Temp &= ~((_REG_VAL_BIT_I2C_MST_EN)&(_REG_VAL_BIT_MASK_LEN))
+    self._write_byte( _REG_ADD_I2C_SLV0_CTRL,  u8Temp)
     
-    self._write_byte( REG_ADD_REG_BANK_SEL, REG_VAL_REG_BANK_0) #swtich bank0
+    self._write_byte( _REG_ADD_REG_BANK_SEL, _REG_VAL_REG_BANK_0) #swtich bank0
   def writeSecondary(self,u8I2CAddr,u8RegAddr,u8data):
     u8Temp=0
-    self._write_byte( REG_ADD_REG_BANK_SEL,  REG_VAL_REG_BANK_3) #swtich bank3
-    self._write_byte( REG_ADD_I2C_SLV1_ADDR, u8I2CAddr)
-    self._write_byte( REG_ADD_I2C_SLV1_REG,  u8RegAddr)
-    self._write_byte( REG_ADD_I2C_SLV1_DO,   u8data)
-    self._write_byte( REG_ADD_I2C_SLV1_CTRL, REG_VAL_BIT_SLV0_EN|1)
+    self._write_byte( _REG_ADD_REG_BANK_SEL,  _REG_VAL_REG_BANK_3) #swtich bank3
+    self._write_byte( _REG_ADD_I2C_SLV1_ADDR, u8I2CAddr)
+    self._write_byte( _REG_ADD_I2C_SLV1_REG,  u8RegAddr)
+    self._write_byte( _REG_ADD_I2C_SLV1_DO,   u8data)
+    self._write_byte( _REG_ADD_I2C_SLV1_CTRL, _REG_VAL_BIT_SLV0_EN|1)
 
-    self._write_byte( REG_ADD_REG_BANK_SEL, REG_VAL_REG_BANK_0) #swtich bank0
+    self._write_byte( _REG_ADD_REG_BANK_SEL, _REG_VAL_REG_BANK_0) #swtich bank0
 
-    u8Temp = self._read_byte(REG_ADD_USER_CTRL)
-    u8Temp |= REG_VAL_BIT_I2C_MST_EN
-    self._write_byte( REG_ADD_USER_CTRL, u8Temp)
+    u8Temp = self._read_byte(_REG_ADD_USER_CTRL)
+    u8Temp |= _REG_VAL_BIT_I2C_MST_EN
+    self._write_byte( _REG_ADD_USER_CTRL, u8Temp)
     time.sleep(0.01)
-    u8Temp &= ~REG_VAL_BIT_I2C_MST_EN
-    self._write_byte( REG_ADD_USER_CTRL, u8Temp)
+    u8Temp &= ~_REG_VAL_BIT_I2C_MST_EN
+    self._write_byte( _REG_ADD_USER_CTRL, u8Temp)
 
-    self._write_byte( REG_ADD_REG_BANK_SEL, REG_VAL_REG_BANK_3) #swtich bank3
+    self._write_byte( _REG_ADD_REG_BANK_SEL, _REG_VAL_REG_BANK_3) #swtich bank3
 
-    u8Temp = self._read_byte(REG_ADD_I2C_SLV0_CTRL)
-    u8Temp &= ~((REG_VAL_BIT_I2C_MST_EN)&(REG_VAL_BIT_MASK_LEN))
-    self._write_byte( REG_ADD_I2C_SLV0_CTRL,  u8Temp)
+    u8Temp = self._read_byte(_REG_ADD_I2C_SLV0_CTRL)
+    u8Temp &= ~((_REG_VAL_BIT_I2C_MST_EN)&(_REG_VAL_BIT_MASK_LEN))
+    self._write_byte( _REG_ADD_I2C_SLV0_CTRL,  u8Temp)
 
-    self._write_byte( REG_ADD_REG_BANK_SEL, REG_VAL_REG_BANK_0) #swtich bank0
+    self._write_byte( _REG_ADD_REG_BANK_SEL, _REG_VAL_REG_BANK_0) #swtich bank0
   def gyroOffset(self):
     s32TempGx = 0
     s32TempGy = 0
@@ -276,94 +308,46 @@ class ICM20948(object):
   def _read_block(self, reg, length=1):
     rec=self._bus.readfrom_mem(int(self._address),int(reg),length)
     return rec
+  def _read_into(self, reg, buf):
+    self._bus.readfrom_mem_into(self._address,reg,buf)
+    return buf
   def _read_u16(self,cmd):
     LSB = self._bus.readfrom_mem(int(self._address),int(cmd),1)
     MSB = self._bus.readfrom_mem(int(self._address),int(cmd)+1,1)
     return (MSB[0] << 8) + LSB[0]
 
   def _write_byte(self,cmd,val):
-    self._bus.writeto_mem(int(self._address),int(cmd),bytes([int(val)]))
+    self._wbuf[0]=val
+    self._bus.writeto_mem(self._address,cmd,self._wbuf)
+    if cmd == _REG_ADD_REG_BANK_SEL:
+      self._bank = val
     time.sleep(0.0001)
-  def imuAHRSupdate(self,gx, gy,gz,ax,ay,az,mx,my,mz):    
-    norm=0.0
-    hx = hy = hz = bx = bz = 0.0
-    vx = vy = vz = wx = wy = wz = 0.0
-    exInt = eyInt = ezInt = 0.0
-    ex=ey=ez=0.0 
-    halfT = 0.024
+  def _selectBank(self,bank):
+    # Hot path bank select: only written when the bank changes, and without the settling sleep of
+    # configuration writes (REG_BANK_SEL is available in every bank and takes effect immediately)
+    if bank != self._bank:
+      self._wbuf[0]=bank
+      self._bus.writeto_mem(self._address,_REG_ADD_REG_BANK_SEL,self._wbuf)
+      self._bank = bank
+  def imuAHRSupdate(self,gx, gy,gz,ax,ay,az,mx,my,mz,halfT=0.024):
     global q0
     global q1
     global q2
     global q3
-    q0q0 = q0 * q0
-    q0q1 = q0 * q1
-    q0q2 = q0 * q2
-    q0q3 = q0 * q3
-    q1q1 = q1 * q1
-    q1q2 = q1 * q2
-    q1q3 = q1 * q3
-    q2q2 = q2 * q2   
-    q2q3 = q2 * q3
-    q3q3 = q3 * q3          
-
-    norm = float(1/math.sqrt(ax * ax + ay * ay + az * az))     
-    ax = ax * norm
-    ay = ay * norm
-    az = az * norm
-
-    norm = float(1/math.sqrt(mx * mx + my * my + mz * mz))      
-    mx = mx * norm
-    my = my * norm
-    mz = mz * norm
-
-    # compute reference direction of flux
-    hx = 2 * mx * (0.5 - q2q2 - q3q3) + 2 * my * (q1q2 - q0q3) + 2 * mz * (q1q3 + q0q2)
-    hy = 2 * mx * (q1q2 + q0q3) + 2 * my * (0.5 - q1q1 - q3q3) + 2 * mz * (q2q3 - q0q1)
-    hz = 2 * mx * (q1q3 - q0q2) + 2 * my * (q2q3 + q0q1) + 2 * mz * (0.5 - q1q1 - q2q2)         
-    bx = math.sqrt((hx * hx) + (hy * hy))
-    bz = hz     
-
-    # estimated direction of gravity and flux (v and w)
-    vx = 2 * (q1q3 - q0q2)
-    vy = 2 * (q0q1 + q2q3)
-    vz = q0q0 - q1q1 - q2q2 + q3q3
-    wx = 2 * bx * (0.5 - q2q2 - q3q3) + 2 * bz * (q1q3 - q0q2)
-    wy = 2 * bx * (q1q2 - q0q3) + 2 * bz * (q0q1 + q2q3)
-    wz = 2 * bx * (q0q2 + q1q3) + 2 * bz * (0.5 - q1q1 - q2q2)  
-
-    # error is sum of cross product between reference direction of fields and direction measured by sensors
-    ex = (ay * vz - az * vy) + (my * wz - mz * wy)
-    ey = (az * vx - ax * vz) + (mz * wx - mx * wz)
-    ez = (ax * vy - ay * vx) + (mx * wy - my * wx)
-
-    if (ex != 0.0 and ey != 0.0 and ez != 0.0):
-      exInt = exInt + ex * Ki * halfT
-      eyInt = eyInt + ey * Ki * halfT  
-      ezInt = ezInt + ez * Ki * halfT
-
-      gx = gx + Kp * ex + exInt
-      gy = gy + Kp * ey + eyInt
-      gz = gz + Kp * ez + ezInt
-
-    q0 = q0 + (-q1 * gx - q2 * gy - q3 * gz) * halfT
-    q1 = q1 + (q0 * gx + q2 * gz - q3 * gy) * halfT
-    q2 = q2 + (q0 * gy - q1 * gz + q3 * gx) * halfT
-    q3 = q3 + (q0 * gz + q1 * gy - q2 * gx) * halfT  
-
-    norm = float(1/math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3))
-    q0 = q0 * norm
-    q1 = q1 * norm
-    q2 = q2 * norm
-    q3 = q3 * norm
+    ahrsUpdate(Quat, gx, gy, gz, ax, ay, az, mx, my, mz, Kp, Ki, halfT)
+    q0 = Quat[0]
+    q1 = Quat[1]
+    q2 = Quat[2]
+    q3 = Quat[3]
   def icm20948Check(self):
-    bRet=false
-    if REG_VAL_WIA == self._read_byte(REG_ADD_WIA):
-      bRet = true
+    bRet=_false
+    if _REG_VAL_WIA == self._read_byte(_REG_ADD_WIA):
+      bRet = _true
     return bRet
   def icm20948MagCheck(self):
-    self.readSecondary( I2C_ADD_ICM20948_AK09916|I2C_ADD_ICM20948_AK09916_READ,REG_ADD_MAG_WIA1, 2)
-    if (pu8data[0] == REG_VAL_MAG_WIA1) and ( pu8data[1] == REG_VAL_MAG_WIA2) :
-        bRet = true
+    self.readSecondary( _I2C_ADD_ICM20948_AK09916|_I2C_ADD_ICM20948_AK09916_READ,_REG_ADD_MAG_WIA1, 2)
+    if (pu8data[0] == _REG_VAL_MAG_WIA1) and ( pu8data[1] == _REG_VAL_MAG_WIA2) :
+        bRet = _true
         return bRet
   def calcAvgValue(self):
     MotionVal[0]=Gyro[0]/32.8
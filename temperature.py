@@ -2,67 +2,157 @@
 This file is for reading temperature data
 off of the raspberry pi pico's temperature
 sensor
+
+The sensor is sampled in the background by a machine.Timer.
+Each timer tick reads the ADC, every OVERSAMPLE reads are summed
+into one decimated value and the last AVERAGE decimated values are
+kept as a moving average. Everything is done with integers, so the
+latest temperature can be read at any time without blocking and
+without float math.
 """
 
 import machine
 import time
 import sys
 
-temp_sensor = machine.ADC(4)     # Port for temp sensor
+ADC_TEMP_SENSOR = 4 # ADC port for temp sensor
 
 """
-3.3v/2^(16)-1. Because ADC port has a 12-bit bus but
-Pico pads it into a 16-bit bus. ADC requires 3.3v,
-it outputs all 1's if powered and all 0's if not powered.
-If bus is 16 bits and all bits are set to 1, than max number
-is 2^(16)-1 or 65535.
+The ADC has a 12-bit resolution but read_u16() pads it to 16 bits,
+so every reading is shifted down to 12 bits. OVERSAMPLE (16) 12-bit
+readings are summed and shifted down by 2, giving one 14-bit value
+(0 - 16380) with 2 extra bits of resolution.
 """
-conversion_ratio = 3.3 / 65535
+OVERSAMPLE = 16
+AVERAGE = 8 # Decimated values in the moving average
+ADC_14BIT_MAX = 16380
+
+# Sensor voltage in 0.1 mV units is 33000 (3.3v) at ADC_14BIT_MAX
+ADC_REF = 33000
+
+# 27 C at 0.706v, -1.721 mV per degree C (in 0.1 mV units)
+SENSOR_V27 = 7060
+SENSOR_SLOPE = 1721 # 17.21 * 100
+
+# Background temperature sampler
+class TempSampler:
+
+    """
+    Initialize sampler
+
+    rateHz: ADC reads per second
+    """
+    def __init__(self, rateHz=160):
+        self.sensor = machine.ADC(ADC_TEMP_SENSOR)
+        self.rateHz = rateHz
+        self.timer = None
+
+        # Oversampling accumulator
+        self.acc = 0
+        self.accCount = 0
+
+        # Moving average ring buffer of decimated values
+        self.ring = [0] * AVERAGE
+        self.ringIdx = 0
+        self.ringSum = 0
+        self.filled = 0
+
+        # Latest temperature in hundredths of a degree C
+        self.centiC = 0
+
+        # Bound method is created once so the callback never allocates
+        self.callback = self.sample
+
+    # Start sampling in the background
+    def start(self):
+        # Prime the filter with one blocking read
+        raw = self.sensor.read_u16() >> 4
+        for i in range(AVERAGE):
+            self.ring[i] = raw << 2
+        self.ringSum = (raw << 2) * AVERAGE
+        self.filled = AVERAGE
+        self.centiC = self.toCentiC(raw << 2)
+
+        self.timer = machine.Timer()
+        self.timer.init(freq=self.rateHz, mode=machine.Timer.PERIODIC, callback=self.callback)
+
+    # Stop background sampling
+    def stop(self):
+        if self.timer is not None:
+            self.timer.deinit()
+            self.timer = None
+
+    # Timer callback, one ADC read
+    def sample(self, timer):
+        self.acc += self.sensor.read_u16() >> 4
+        self.accCount += 1
+
+        if self.accCount < OVERSAMPLE:
+            return
 
-# Probe temperature from sensor
+        # Decimate to one 14-bit value
+        value = self.acc >> 2
+        self.acc = 0
+        self.accCount = 0
+
+        # Update moving average
+        self.ringSum += value - self.ring[self.ringIdx]
+        self.ring[self.ringIdx] = value
+        self.ringIdx += 1
+        if self.ringIdx >= AVERAGE:
+            self.ringIdx = 0
+
+        self.centiC = self.toCentiC(self.ringSum // AVERAGE)
+
+    # Convert a 14-bit ADC value to hundredths of a degree C
+    def toCentiC(self, value):
+        voltage = value * ADC_REF // ADC_14BIT_MAX # 0.1 mV
+        return 2700 - (voltage - SENSOR_V27) * 10000 // SENSOR_SLOPE
+
+    # Latest temperature in hundredths of a degree C (never blocks)
+    def latest(self):
+        return self.centiC
+
+    # Latest temperature in degrees C
+    def celsius(self):
+        return self.centiC / 100
+
+    # Latest temperature in degrees F
+    def fahrenheit(self):
+        return self.centiC * 9 / 500 + 32
+
+
+# Shared sampler used by getTemp()
+sampler = None
+
+# Get current temperature
 def getTemp(unit):
-    global temp_sensor, conversion_ratio
-    
-    # Get temperature reading from sensor
-    sensor_reading = temp_sensor.read_u16() * conversion_ratio
-    
-    # Convert to celcius
-    temp = 27 - (sensor_reading - 0.706)/0.001721
-    
+    global sampler
+
+    # Start background sampling on first use
+    if sampler is None:
+        sampler = TempSampler()
+        sampler.start()
+
     # Check if unit needs to be converted
     if unit == 'f' or unit == "F":
-        # Convert to Fahrenheit
-        temp = (temp * 1.8) + 32
-        
-    return temp
+        return sampler.fahrenheit()
+
+    return sampler.celsius()
 
 def main():
-    
-    # Get temperature unit from user
-    unit = input("Select temp. unit (c=celcius,f=fahrenheit): \t")
-    print("\nTemperature unit set!\n")
-    time.sleep(1)
-    
-    
+    sampler = TempSampler()
+    sampler.start()
+
+    # Print current temperature every second
     while True:
-        u_input = input("Press enter to get current temperature\n")
-        temp = 0
-        
-        # Pressed enter
-        if u_input == "":
-            temp = getTemp(unit)
-            
-            if unit == "f" or unit == "F":
-                print("Temperature = %.2f F" % temp)
-            else:
-                print("Temperature = %.2f C" % temp)
-                
-        print()
-# 
+        print("Temperature = %.2f C (%.2f F)" % (sampler.celsius(), sampler.fahrenheit()))
+        time.sleep(1)
+
+#
 # if __name__ == "__main__":
 #     try:
 #         main()
 #     except KeyboardInterrupt:
 #         print("\n\nKeyboardInterruptException\n")
 #         sys.exit()
-    
\ No newline at end of file